@@ -11,6 +11,27 @@ from coffea.util import load, save
 from coffea import processor
 from coffea.nanoevents import PFNanoAODSchema
 from BTVNanoCommissioning.workflows import workflows
+from BTVNanoCommissioning.workflows.fanout import NanoProcessor as FanOutProcessor
+from BTVNanoCommissioning.utils.reader import SelectionIndex
+from BTVNanoCommissioning.utils.skim import SkimStore
+from BTVNanoCommissioning.utils.array_writer import finalise_arrays, WriterPolicy
+from BTVNanoCommissioning.utils.storage import retry_uploads
+
+
+def workflow_output(path, workflow, name):
+    """output path of one workflow of a comma-separated workflow list"""
+    dirname, basename = os.path.split(path)
+    if workflow in basename:
+        return os.path.join(dirname, basename.replace(workflow, name))
+    return os.path.join(dirname, basename.replace(".coffea", "") + f"_{name}.coffea")
+
+
+def save_output(output, path, workflow):
+    if "," not in workflow:
+        save(output, path)
+        return
+    for name, out in output.items():
+        save(out, workflow_output(path, workflow, name))
 
 
 def validate(file):
@@ -53,8 +74,7 @@ def get_main_parser():
         "--wf",
         "--workflow",
         dest="workflow",
-        choices=list(workflows.keys()),
-        help="Which processor to run",
+        help=f"Which processor to run, comma-separated workflows are run together on a single read of the files (one output per workflow), from {list(workflows.keys())}",
         required=True,
     )
     parser.add_argument(
@@ -98,12 +118,60 @@ def get_main_parser():
         help="Run with systematics, all, weights_only(no JERC uncertainties included),JERC_split, None",
     )
     parser.add_argument("--isArray", action="store_true", help="Output root files")
+    parser.add_argument(
+        "--arrayMaxSize",
+        default=None,
+        type=float,
+        help="With --isArray, append the chunks to per-dataset and shift root files rolled over at this size (MB), instead of writing one file per chunk",
+    )
+    parser.add_argument(
+        "--compression",
+        default=None,
+        type=str,
+        help="Compression of the output root files, codec[:level] with codec in zlib, lz4, zstd, lzma, e.g. lz4:4 (default: zlib:1)",
+    )
+    parser.add_argument(
+        "--basketSize",
+        default=None,
+        type=float,
+        help="Maximum uncompressed basket size of the branches of the output root files in kB (default: one basket per chunk)",
+    )
+    parser.add_argument(
+        "--destination",
+        default=None,
+        type=str,
+        help="BTA workflows: base of the output destination, xrootd url or local directory (default: helpers.BTA_helper.BTA_destination)",
+    )
     parser.add_argument(
         "--noHist", action="store_true", help="Not output coffea histogram"
     )
     parser.add_argument(
         "--overwrite", action="store_true", help="Overwrite existing files"
     )
+    parser.add_argument(
+        "--selIndex",
+        default=None,
+        type=str,
+        help="Directory (readable by the workers) to store the entries passing the workflow prefilter, reruns only read the stored entries. Clear it when the prefilter changes",
+    )
+    parser.add_argument(
+        "--skim",
+        default=None,
+        type=str,
+        help="Local directory to store the selected objects and weights of each shift to, to fill the histograms again with --fromSkim",
+    )
+    parser.add_argument(
+        "--skimFormat",
+        default="parquet",
+        choices=SkimStore.formats,
+        help="Format of the --skim files: parquet (columnar, readable without coffea) or coffea (pickled, does not need pyarrow)",
+    )
+    parser.add_argument(
+        "--fromSkim",
+        default=None,
+        type=str,
+        help="Fill the histograms from the skim written with --skim in this directory instead of processing the NanoAOD files",
+    )
     # Scale out
     parser.add_argument(
         "--executor",
@@ -225,6 +293,9 @@ def get_main_parser():
 if __name__ == "__main__":
     parser = get_main_parser()
     args = parser.parse_args()
+    for wf in args.workflow.split(","):
+        if wf not in workflows:
+            parser.error(f"argument --wf/--workflow: invalid choice: '{wf}'")
     print("Running with the following options:")
     print(args)
     ogoutput = args.output
@@ -287,6 +358,12 @@ if __name__ == "__main__":
                 if args.only in sample_dict[key]:
                     sample_dict = dict([(key, [args.only])])
 
+    if args.fromSkim is not None:
+        if args.executor == "dask/lxplus":
+            raise ValueError(
+                "--fromSkim fills the histograms locally, it cannot be split with dask/lxplus"
+            )
+
     # Scan if files can be opened
     if args.validate:
         start = time.time()
@@ -333,15 +410,70 @@ if __name__ == "__main__":
         sys.exit(0)
 
     # load workflow
-    processor_instance = workflows[args.workflow](
-        args.year,
-        args.campaign,
-        outdir,
-        args.isSyst,
-        args.isArray,
-        args.noHist,
-        args.chunk,
-    )
+    wf_kwargs = {}
+    if args.destination is not None:
+        if not all(wf.startswith("BTA") for wf in args.workflow.split(",")):
+            raise Exception("--destination is only used by the BTA workflows")
+        wf_kwargs["destination"] = args.destination
+    if "," not in args.workflow:
+        processor_instance = workflows[args.workflow](
+            args.year,
+            args.campaign,
+            outdir,
+            args.isSyst,
+            args.isArray,
+            args.noHist,
+            args.chunk,
+            **wf_kwargs,
+        )
+    else:
+        processor_instance = FanOutProcessor(
+            {
+                wf: workflows[wf](
+                    args.year,
+                    args.campaign,
+                    workflow_output(outdir, args.workflow, wf),
+                    args.isSyst,
+                    args.isArray,
+                    args.noHist,
+                    args.chunk,
+                    **wf_kwargs,
+                )
+                for wf in args.workflow.split(",")
+            }
+        )
+    if args.arrayMaxSize is not None:
+        for proc in getattr(
+            processor_instance, "processors", {"": processor_instance}
+        ).values():
+            proc.array_max_size = int(args.arrayMaxSize * 1024**2)
+    if args.compression is not None or args.basketSize is not None:
+        policy = WriterPolicy.from_string(
+            args.compression or "zlib:1",
+            None if args.basketSize is None else int(args.basketSize * 1024),
+        )
+        for proc in getattr(
+            processor_instance, "processors", {"": processor_instance}
+        ).values():
+            proc.writer_policy = policy
+    # list the outputs already at the destination once, the index is shipped to the workers with the processor
+    for proc in getattr(
+        processor_instance, "processors", {"": processor_instance}
+    ).values():
+        if hasattr(proc, "produced"):
+            proc.produced.build()
+            print(f"{len(proc.produced)} outputs already at {proc.destination.url('')}")
+    if args.skim is not None:
+        for wf, proc in getattr(
+            processor_instance, "processors", {args.workflow: processor_instance}
+        ).items():
+            if not hasattr(proc, "fill_histograms"):
+                raise Exception(f"--skim is not supported by {wf}")
+            proc.skim = SkimStore(f"{args.skim}/{wf}_{args.campaign}", args.skimFormat)
+    if args.selIndex is not None:
+        processor_instance.selection_index = SelectionIndex(
+            f"{args.selIndex}/{args.workflow}_{args.campaign}"
+        )
 
     ## create tmp directory and check file exist or not
     from os import path
@@ -427,7 +559,19 @@ if __name__ == "__main__":
 
     #########
     # Execute
-    if args.executor in ["futures", "iterative"]:
+    if args.fromSkim is not None:
+        # the histograms are filled from the stored objects, no event is read
+        output = {
+            wf: SkimStore(f"{args.fromSkim}/{wf}_{args.campaign}").run(
+                proc, sample_dict.keys()
+            )
+            for wf, proc in getattr(
+                processor_instance, "processors", {args.workflow: processor_instance}
+            ).items()
+        }
+        if "," not in args.workflow:
+            output = output[args.workflow]
+    elif args.executor in ["futures", "iterative"]:
         if args.executor == "iterative":
             _exec = processor.iterative_executor
         else:
@@ -813,15 +957,33 @@ if __name__ == "__main__":
                             maxchunks=args.max,
                         )
                         if args.noHist == False:
-                            save(
+                            save_output(
                                 output,
                                 coffeaoutput.replace(
                                     ".coffea", f"_{sindex}_{findex}.coffea"
                                 ),
+                                args.workflow,
                             )
     if not "lxplus" in args.executor:
+        if any(
+            hasattr(proc, "destination")
+            for proc in getattr(
+                processor_instance, "processors", {"": processor_instance}
+            ).values()
+        ):
+            failed = retry_uploads()
+            if len(failed) > 0:
+                print(
+                    f"{len(failed)} outputs could not be uploaded, rerun to retry:",
+                    failed,
+                )
+        if args.isArray and args.arrayMaxSize is not None:
+            for proc in getattr(
+                processor_instance, "processors", {"": processor_instance}
+            ).values():
+                finalise_arrays(proc.name)
         if args.noHist == False:
-            save(output, coffeaoutput)
+            save_output(output, coffeaoutput, args.workflow)
     if args.noHist == False:
         # print(output)
         print(f"Saving output to {coffeaoutput}")
@@ -0,0 +1,100 @@
+"""Benchmark of utils.merger against hadd on synthetic array_writer files
+
+Chunk files with the structure written by array_writer (Events with jagged
+collections and flat branches, TotalEventCount, TotalEventWeight) are written
+to a temporary directory, for several systematics and samples, then merged
+with merge_dir and, if hadd is found, with one hadd per sample run in parallel.
+
+python scripts/benchmark_merge.py --samples 4 --systs 2 --files 50 -j 4
+"""
+
+import argparse, os, shutil, subprocess, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import awkward as ak
+import uproot
+from BTVNanoCommissioning.utils.merger import merge_dir, merge_jobs
+
+
+def make_file(path, nevents, rng):
+    branches = {}
+    for name, (mult, nfields) in {"Jet": (4, 12), "Muon": (2, 6)}.items():
+        counts = rng.poisson(mult, nevents)
+        branches[name] = ak.zip(
+            {
+                f"var{i}": ak.unflatten(
+                    rng.random(counts.sum()).astype(np.float32), counts
+                )
+                for i in range(nfields)
+            }
+        )
+    for i in range(10):
+        branches[f"weight{i}"] = rng.random(nevents)
+    with uproot.recreate(path) as fout:
+        fout["Events"] = branches
+        fout["TotalEventCount"] = ak.Array([nevents * 10])
+        fout["TotalEventWeight"] = ak.Array([float(nevents * 10)])
+
+
+def make_dir(indir, systs, samples, files, nevents, seed=42):
+    rng = np.random.default_rng(seed)
+    for syst in range(systs):
+        for samp in range(samples):
+            outdir = os.path.join(indir, f"syst{syst}", f"sample{samp}")
+            os.makedirs(outdir)
+            for f in range(files):
+                make_file(os.path.join(outdir, f"chunk_{f}.root"), nevents, rng)
+
+
+def size(paths):
+    return sum(os.path.getsize(p) for p in paths)
+
+
+def run_hadd(indir, workers):
+    jobs = merge_jobs(indir)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(
+            pool.map(
+                lambda job: subprocess.run(
+                    ["hadd", "-f", "-v", "0", job[0]] + job[1], check=True
+                ),
+                jobs.items(),
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--systs", type=int, default=2)
+    parser.add_argument("--samples", type=int, default=4)
+    parser.add_argument("--files", type=int, default=50, help="Files per sample")
+    parser.add_argument("-n", "--nevents", type=int, default=5000, help="per file")
+    parser.add_argument("-j", "--workers", type=int, default=4)
+    parser.add_argument("--step", default="100 MB")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        make_dir(tmp, args.systs, args.samples, args.files, args.nevents)
+        jobs = merge_jobs(tmp)
+        inputs = [p for paths in jobs.values() for p in paths]
+        nevents = len(inputs) * args.nevents
+        print(
+            f"{len(inputs)} files, {len(jobs)} outputs, {nevents} events, "
+            f"{size(inputs) / 1024**2:.1f} MB"
+        )
+        tools = [("merger", lambda: merge_dir(tmp, args.workers, args.step))]
+        if shutil.which("hadd") is not None:
+            tools.append(("hadd", lambda: run_hadd(tmp, args.workers)))
+        else:
+            print("hadd not found, only the merger is timed")
+        for name, function in tools:
+            start = time.perf_counter()
+            function()
+            elapsed = time.perf_counter() - start
+            merged = sum(uproot.open(p)["Events"].num_entries for p in jobs.keys())
+            assert merged == nevents, (name, merged, nevents)
+            print(
+                f"{name:8s} {elapsed:8.2f} s, {nevents / elapsed:10.0f} events/s, "
+                f"{size(inputs) / 1024**2 / elapsed:8.1f} MB/s, "
+                f"output {size(jobs.keys()) / 1024**2:.1f} MB"
+            )
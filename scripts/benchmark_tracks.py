@@ -0,0 +1,131 @@
+"""Benchmark of the track-jet association of BTA_producer on a synthetic PFNano file
+
+Jets and JetPFCands (tracks spread around their jet, with the hit, chi2 and
+impact parameter fields used by the JP categories) are written to a temporary
+file, read with PFNanoAODSchema and associated with the ak.cartesian product
+used before and with helpers.BTA_helper.associate_tracks. Both results are
+compared and the time and the number of (jet, track) pairs built are reported.
+
+python scripts/benchmark_tracks.py -n 5000 --tracks 20
+"""
+
+import argparse, os, tempfile, time, warnings
+import numpy as np
+import awkward as ak
+import uproot
+from coffea.nanoevents import NanoEventsFactory, PFNanoAODSchema
+from BTVNanoCommissioning.helpers.BTA_helper import (
+    JP_track_categories,
+    associate_tracks,
+)
+
+
+def make_file(path, nevents, tracks, seed=42):
+    rng = np.random.default_rng(seed)
+    njet = rng.poisson(6, nevents)
+    nj = njet.sum()
+    jet = {
+        "pt": rng.exponential(40, nj).astype(np.float32) + 15,
+        "eta": rng.uniform(-2.7, 2.7, nj).astype(np.float32),
+        "phi": rng.uniform(-np.pi, np.pi, nj).astype(np.float32),
+        "mass": rng.uniform(1, 10, nj).astype(np.float32),
+    }
+    # the tracks of each jet, stored in event order
+    jet_of = np.repeat(np.arange(nj), rng.poisson(tracks, nj))
+    event_of = np.repeat(np.arange(nevents), njet)[jet_of]
+    ntrk = np.bincount(event_of, minlength=nevents)
+    n = len(jet_of)
+    eta = jet["eta"][jet_of] + rng.normal(0, 0.25, n).astype(np.float32)
+    phi = jet["phi"][jet_of] + rng.normal(0, 0.25, n).astype(np.float32)
+    pf = {
+        "pt": rng.exponential(5, n).astype(np.float32) + 0.5,
+        "eta": eta,
+        "phi": phi,
+        "mass": np.full(n, 0.14, np.float32),
+        "trkPt": rng.exponential(5, n).astype(np.float32) + 0.5,
+        "trkEta": eta,
+        "trkPhi": phi,
+        "lostInnerHits": rng.integers(-1, 2, n).astype(np.int32),
+        "numberOfPixelHits": rng.integers(0, 8, n).astype(np.int32),
+        "numberOfHits": rng.integers(0, 30, n).astype(np.int32),
+        "trkChi2": rng.exponential(2, n).astype(np.float32),
+    }
+    first_jet = np.concatenate([[0], np.cumsum(njet)])[:-1]
+    cands = {
+        "jetIdx": (jet_of - first_jet[event_of]).astype(np.int32),
+        "pFCandsIdx": (np.arange(n) - np.repeat(np.cumsum(ntrk) - ntrk, ntrk)).astype(
+            np.int32
+        ),
+        "pt": pf["pt"],
+    }
+    with uproot.recreate(path) as fout:
+        fout["Events"] = {
+            "Jet": ak.zip({k: ak.unflatten(v, njet) for k, v in jet.items()}),
+            "PFCands": ak.zip({k: ak.unflatten(v, ntrk) for k, v in pf.items()}),
+            "JetPFCands": ak.zip({k: ak.unflatten(v, ntrk) for k, v in cands.items()}),
+            "event": np.arange(nevents, dtype=np.uint64),
+        }
+
+
+def cartesian(jet, trkj):
+    """association and categories as done before associate_tracks"""
+    pair = ak.cartesian([jet, trkj], axis=1, nested=True)
+    matched = (pair["0"].pt_orig == pair["1"].jet.pt) & (
+        pair["0"].delta_r(pair["1"].pf) < 0.4
+    )
+    trk = pair["1"][matched]
+    p = trk.pf.trkPt * np.cosh(trk.pf.trkEta)
+    isHitL1 = trk.pf.lostInnerHits == -1
+    category = ak.zeros_like(trk.pt, dtype=int) - 1
+    for idx, cat in enumerate(JP_track_categories):
+        passed = (
+            (((cat[0] == 1) & isHitL1) | ((cat[0] == -1) & ~isHitL1) | (cat[0] == 0))
+            & (trk.pf.numberOfPixelHits >= cat[1])
+            & (trk.pf.numberOfPixelHits <= cat[2])
+            & (abs(trk.pf.trkEta) >= cat[3])
+            & (abs(trk.pf.trkEta) <= cat[4])
+            & (p >= cat[5])
+            & (p <= cat[6])
+            & (trk.pf.numberOfHits >= cat[7])
+            & (trk.pf.numberOfHits <= cat[8])
+            & (trk.pf.trkChi2 >= cat[9])
+            & (trk.pf.trkChi2 <= cat[10])
+        )
+        category = ak.where((category == -1) & passed, idx, category)
+    trk["category"] = category
+    return trk, ak.sum(ak.num(trkj) * ak.num(jet))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-n", "--nevents", type=int, default=5000)
+    parser.add_argument("--tracks", type=int, default=20, help="Mean tracks per jet")
+    args = parser.parse_args()
+
+    warnings.filterwarnings("ignore", message="Missing cross-reference")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "pfnano.root")
+        make_file(path, args.nevents, args.tracks)
+        events = NanoEventsFactory.from_root(path, schemaclass=PFNanoAODSchema).events()
+        jet = events.Jet[(events.Jet.pt > 20.0) & (abs(events.Jet.eta) < 2.5)]
+        jet["pt_orig"] = jet.pt
+        trkj = events.JetPFCands
+        # read the inputs once, only the association is timed
+        inputs = [jet.eta, jet.phi, trkj.jet.pt] + [
+            trkj.pf[f] for f in events.PFCands.fields
+        ]
+        associate_tracks(jet[:1], trkj[:1], 0.4, JP_track_categories)  # compile
+
+        start = time.perf_counter()
+        old, npairs = cartesian(jet, trkj)
+        elapsed_old = time.perf_counter() - start
+        start = time.perf_counter()
+        new = associate_tracks(jet, trkj, 0.4, JP_track_categories)
+        elapsed_new = time.perf_counter() - start
+
+        assert ak.to_list(ak.num(old, axis=2)) == ak.to_list(ak.num(new, axis=2))
+        assert ak.to_list(old.category) == ak.to_list(new.category)
+        nmatched = ak.sum(ak.num(new, axis=2))
+        print(f"{args.nevents} events, {ak.sum(ak.num(trkj))} tracks")
+        print(f"cartesian        {elapsed_old:7.2f} s, {npairs} pairs built")
+        print(f"associate_tracks {elapsed_new:7.2f} s, {nmatched} pairs built")
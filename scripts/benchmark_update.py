@@ -0,0 +1,113 @@
+"""Benchmark of helpers.func.update against the ak.with_field loop it replaces
+
+A PFNano-like file (collections and branch multiplicities of a PFNano chunk,
+random content) is written to a temporary directory and read back with
+NanoEvents. Both functions swap the Jet/MET/Muon collections, as done for each
+shift in the workflows, on the full and on masked events.
+
+python scripts/benchmark_update.py -n 50000 --repeat 20
+"""
+
+import argparse, os, tempfile, time, warnings
+import numpy as np
+import awkward as ak
+import uproot
+from coffea.nanoevents import NanoEventsFactory, PFNanoAODSchema
+from BTVNanoCommissioning.helpers.func import update
+
+warnings.filterwarnings("ignore", module="coffea")
+
+# collection: (mean multiplicity, number of float branches)
+collections = {
+    "Jet": (6, 60),
+    "FatJet": (1, 40),
+    "Muon": (2, 45),
+    "Electron": (2, 50),
+    "Photon": (1, 30),
+    "Tau": (1, 30),
+    "SV": (3, 20),
+    "PFCands": (150, 15),
+    "JetPFCands": (60, 5),
+    "JetSVs": (3, 15),
+    "GenPart": (60, 10),
+    "GenJet": (6, 8),
+    "TrigObj": (8, 10),
+}
+singletons = {"MET": 20, "PuppiMET": 20, "PV": 8, "Pileup": 6, "Flag": 20, "HLT": 300}
+
+
+def make_file(path, nevents, seed=42):
+    rng = np.random.default_rng(seed)
+    branches = {
+        "run": np.ones(nevents, np.uint32),
+        "luminosityBlock": np.ones(nevents, np.uint32),
+        "event": np.arange(nevents, dtype=np.uint64),
+    }
+    for name, (mult, nfields) in collections.items():
+        counts = rng.poisson(mult, nevents)
+        fields = {"pt": rng.exponential(30, counts.sum()).astype(np.float32)}
+        for i in range(nfields):
+            fields[f"var{i}"] = rng.random(counts.sum()).astype(np.float32)
+        fields.update(
+            {k: rng.random(counts.sum()).astype(np.float32) for k in ["eta", "phi"]}
+        )
+        fields["mass"] = np.zeros(counts.sum(), np.float32)
+        branches[name] = ak.zip({k: ak.unflatten(v, counts) for k, v in fields.items()})
+    for name, nfields in singletons.items():
+        for i in range(nfields):
+            branches[f"{name}_var{i}"] = rng.random(nevents).astype(np.float32)
+    for k in ["pt", "phi"]:
+        branches[f"MET_{k}"] = rng.random(nevents).astype(np.float32)
+    with uproot.recreate(path) as f:
+        f["Events"] = branches
+
+
+def loop_update(events, collections):
+    out = events
+    for name, value in collections.items():
+        out = ak.with_field(out, value, name)
+    return out
+
+
+def bench(function, events, shifts, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for collections in shifts:
+            out = function(events, collections)
+    elapsed = (time.perf_counter() - start) / repeat / len(shifts)
+    # reading a field back, through the rebuilt record
+    start = time.perf_counter()
+    ak.sum(out.Jet.pt)
+    return elapsed, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-n", "--nevents", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--nshifts", type=int, default=5, help="Number of shifts")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "pfnano.root")
+        make_file(path, args.nevents)
+        events = NanoEventsFactory.from_root(path, schemaclass=PFNanoAODSchema).events()
+        print(f"{len(events)} events, {len(events.fields)} top-level fields")
+        for label, evts in [
+            ("full", events),
+            ("masked", events[ak.num(events.Jet) >= 4]),
+        ]:
+            shifts = []
+            for i in range(args.nshifts):
+                jets = evts.Jet
+                jets["pt"] = jets.pt * (1 + 0.01 * i)
+                shifts.append({"Jet": jets, "MET": evts.MET, "Muon": evts.Muon})
+            for name, function in [
+                ("with_field loop", loop_update),
+                ("update", update),
+            ]:
+                per_shift, access = bench(function, evts, shifts, args.repeat)
+                print(
+                    f"{label:6s} {name:16s} {1e3 * per_shift:8.3f} ms/shift, "
+                    f"first access {1e3 * access:8.3f} ms"
+                )
@@ -0,0 +1,92 @@
+"""Benchmark of the writer policies (codec, level, basket size) on BTA-style trees
+
+A tree with the collections of the BTA producer (event variables, PV, Jet,
+TagVarCSV, Track, TrkInc) filled with random content of realistic shape
+(float64 kinematics and IP, small integers, flags) is written with each
+policy through WriterPolicy, as done by the producers. The write throughput
+(uncompressed MB/s) and the file size are reported.
+
+python scripts/benchmark_writer.py -n 20000 --policies zlib:1 lz4:4 zstd:5
+"""
+
+import argparse, os, tempfile, time
+import numpy as np
+import awkward as ak
+from BTVNanoCommissioning.utils.array_writer import WriterPolicy, _nbytes
+
+# collection: (mean multiplicity, float64 fields, float32 fields, int fields)
+collections = {
+    "PV": (25, 3, 2, 2),
+    "Jet": (6, 20, 20, 10),
+    "TagVarCSV": (6, 10, 10, 4),
+    "Track": (80, 25, 5, 8),
+    "TrkInc": (10, 8, 4, 2),
+}
+
+
+def make_branches(nevents, seed=42):
+    rng = np.random.default_rng(seed)
+    branches = {
+        "Run": np.full(nevents, 367000, np.int64),
+        "Evt": np.arange(nevents, dtype=np.int64),
+        "nPVs": rng.poisson(40, nevents).astype(np.int64),
+        "BitTrigger": ak.unflatten(rng.integers(0, 2**31, 2 * nevents), 2),
+    }
+    for name, (mult, nf64, nf32, nint) in collections.items():
+        counts = rng.poisson(mult, nevents)
+        n = counts.sum()
+        fields = {}
+        for i in range(nf64):
+            # kinematics and impact parameters: smooth, full float64 precision
+            fields[f"f64_{i}"] = rng.exponential(10, n) * rng.choice([-1, 1], n)
+        for i in range(nf32):
+            fields[f"f32_{i}"] = rng.normal(0, 1, n).astype(np.float32)
+        for i in range(nint):
+            # hit counts, categories, flags
+            fields[f"int_{i}"] = rng.poisson(3, n).astype(np.int64)
+        branches[name] = ak.zip({k: ak.unflatten(v, counts) for k, v in fields.items()})
+    return branches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-n", "--nevents", type=int, default=20000)
+    parser.add_argument(
+        "--policies",
+        nargs="+",
+        default=["zlib:1", "zlib:4", "lz4:1", "lz4:4", "zstd:1", "zstd:5"],
+        help="codec:level to compare",
+    )
+    parser.add_argument(
+        "--basketSize",
+        nargs="+",
+        type=float,
+        default=[0],
+        help="Maximum basket sizes per branch (kB) to compare, 0: one basket per write",
+    )
+    args = parser.parse_args()
+
+    branches = make_branches(args.nevents)
+    nbytes = _nbytes(branches)
+    print(f"{args.nevents} events, {nbytes / 1024**2:.1f} MB uncompressed")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bta.root")
+        for compression in args.policies:
+            for basket in args.basketSize:
+                try:
+                    policy = WriterPolicy.from_string(
+                        compression, int(basket * 1024) if basket > 0 else None
+                    )
+                    start = time.perf_counter()
+                    with policy.recreate(path) as fout:
+                        policy.write(fout, "btagana/ttree", branches)
+                    elapsed = time.perf_counter() - start
+                except ImportError as e:
+                    print(f"{compression:8s} skipped, {str(e).splitlines()[0]}")
+                    continue
+                size = os.path.getsize(path)
+                print(
+                    f"{compression:8s} basket {basket:6.0f} kB {elapsed:7.2f} s "
+                    f"{nbytes / 1024**2 / elapsed:8.1f} MB/s, "
+                    f"{size / 1024**2:7.1f} MB ({size / nbytes:.2f} of uncompressed)"
+                )
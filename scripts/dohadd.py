@@ -1,25 +1,65 @@
-import os, sys
+import argparse, os
 from glob import glob
 
-indir = sys.argv[1]
+from BTVNanoCommissioning.utils.array_writer import WriterPolicy
+from BTVNanoCommissioning.utils.merger import merge_dir
 
-systs = os.listdir(indir)
+parser = argparse.ArgumentParser(
+    description="Merge the root files of --isArray per systematic and sample"
+)
+parser.add_argument("indir", help="array output directory, {indir}/{syst}/{sample}/")
+parser.add_argument(
+    "-j", "--workers", type=int, default=4, help="Number of samples merged at once"
+)
+parser.add_argument(
+    "--step",
+    default="100 MB",
+    help="Size of the batches of events read at once, e.g. 100 MB or 50000 (events)",
+)
+parser.add_argument(
+    "--compression",
+    default="zlib:1",
+    help="Compression of the merged files, codec[:level] with codec in zlib, lz4, zstd, lzma",
+)
+parser.add_argument(
+    "--basketSize",
+    default=None,
+    type=float,
+    help="Maximum uncompressed basket size of the branches of the merged files in kB",
+)
+parser.add_argument(
+    "--hadd",
+    action="store_true",
+    help="Only write hadd.sh, to merge with hadd from a ROOT environment",
+)
+args = parser.parse_args()
+indir = args.indir
 
-outfile = open("hadd.sh", "w")
+if not args.hadd:
+    step = int(args.step) if args.step.isdigit() else args.step
+    policy = WriterPolicy.from_string(
+        args.compression,
+        None if args.basketSize is None else int(args.basketSize * 1024),
+    )
+    merge_dir(indir, args.workers, step, policy)
+else:
+    systs = os.listdir(indir)
 
-for syst in systs:
-    roots = glob(f"{indir}/{syst}/*/*.root")
-    if len(roots) == 0:
-        print(f"Skipping {indir}/{syst}. Not the right directory structure.")
-        continue
-    samps = os.listdir(f"{indir}/{syst}")
-    for samp in samps:
-        if len(glob(f"{indir}/{syst}/{samp}/*.root")) == 0:
+    outfile = open("hadd.sh", "w")
+
+    for syst in systs:
+        roots = glob(f"{indir}/{syst}/*/*.root")
+        if len(roots) == 0:
+            print(f"Skipping {indir}/{syst}. Not the right directory structure.")
             continue
-        outfile.write(
-            f"hadd -v 0 {indir}/{syst}/{samp}.root {indir}/{syst}/{samp}/*.root\n"
-        )
+        samps = os.listdir(f"{indir}/{syst}")
+        for samp in samps:
+            if len(glob(f"{indir}/{syst}/{samp}/*.root")) == 0:
+                continue
+            outfile.write(
+                f"hadd -v 0 {indir}/{syst}/{samp}.root {indir}/{syst}/{samp}/*.root\n"
+            )
 
-print(
-    "Now run `parallel :::: hadd.sh` from an environment with ROOT installed. E.g. \nconda activate rootenv\nparallel :::: hadd.sh\nconda activate btv_coffea"
-)
+    print(
+        "Now run `parallel :::: hadd.sh` from an environment with ROOT installed. E.g. \nconda activate rootenv\nparallel :::: hadd.sh\nconda activate btv_coffea"
+    )
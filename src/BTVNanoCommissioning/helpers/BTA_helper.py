@@ -58,6 +58,52 @@ BTA_ttbar_HLT_chns = [
     ("Mu23_TrkIsoVVL_Ele12_CaloIdL_TrackIdL_IsoVL", "em"),
 ]
 
+##################
+#  Output types  #
+##################
+# (branch pattern, type[, mantissa bits]), first match applies, see utils.array_writer.cast_branches
+BTA_dtypes = [
+    # event number and trigger words use the full 64 bits
+    ("Evt", None),
+    ("BitTrigger", None),
+    ("ttbar_trigWord", None),
+    # track-level variables, 12 mantissa bits: relative precision 1e-4
+    ("Track_*", "float32", 12),
+    ("TrkInc_*", "float32", 12),
+    # hits, categories
+    ("Track_*", "int16"),
+    ("*", "float32"),
+    ("*", "int32"),
+]
+
+##################
+#  Destination   #
+##################
+# base of the BTA outputs, {BTA_destination}/{BTA|BTA_ttbar...}/{campaign}/, xrootd url or local directory
+BTA_destination = "root://eoscms.cern.ch//eos/cms/store/group/phys_btag/milee"
+
+#########################
+#  JP track categories  #
+#########################
+# findCat in BTA, a track gets the first category it passes, -1 if none
+# withFirstPixel (1: hit on the first pixel layer, -1: no hit, 0: any), then the
+# inclusive ranges of: number of pixel hits, |eta|, p, number of hits, chi2
+JP_track_categories = np.array(
+    [
+        [-1, 1, 99, 0.0, 4.5, 1.0, 999.0, 1, 50, 0, 5],
+        [1, 1, 3, 0.0, 4.5, 1.0, 999.0, 1, 50, 0, 5],
+        [1, 4, 99, 0.0, 1.0, 1.0, 3.0, 1, 50, 0, 5],
+        [1, 4, 99, 0.0, 1.0, 3.0, 6.0, 1, 50, 0, 5],
+        [1, 4, 99, 0.0, 1.0, 6.0, 999.0, 1, 50, 0, 5],
+        [1, 4, 99, 1.0, 2.0, 1.0, 6.0, 1, 50, 0, 5],
+        [1, 4, 99, 1.0, 2.0, 6.0, 12.0, 1, 50, 0, 5],
+        [1, 4, 99, 1.0, 2.0, 12.0, 999.0, 1, 50, 0, 5],
+        [1, 4, 99, 2.0, 4.5, 1.0, 18.0, 1, 50, 0, 5],
+        [1, 4, 99, 2.0, 4.5, 18.0, 999.0, 1, 50, 0, 5],
+    ],
+    dtype=np.float32,
+)
+
 ################
 #  Mass table  #
 ################
@@ -77,66 +123,170 @@ hadron_mass_table = {**main, **{k: v for k, v in backup.items() if k not in main
 ###############
 #  Functions  #
 ###############
-def is_from_GSP(GenPart):
-    QGP = ak.zeros_like(GenPart.genPartIdxMother)
-    QGP = (
-        (GenPart.genPartIdxMother >= 0)
-        & (GenPart.genPartIdxMother2 == -1)
-        & (abs(GenPart.parent.pdgId) == 21)
-        & (
-            (abs(GenPart.parent.pdgId) == abs(GenPart.pdgId))
-            | abs(GenPart.parent.pdgId)
-            == 21
-        )
-        & ~(
-            (abs(GenPart.pdgId) == abs(GenPart.parent.pdgId))
-            & (GenPart.parent.status >= 21)
-            & (GenPart.parent.status <= 29)
-        )
-    )
-    rest_QGP = ak.mask(GenPart, ~QGP)
-    restGenPart = rest_QGP.parent
-    while ak.any(ak.is_none(restGenPart.parent.pdgId, axis=-1) == False):
-        mask_forbad = (
-            (restGenPart.genPartIdxMother >= 0)
-            & (restGenPart.genPartIdxMother2 == -1)
-            & (
-                (abs(restGenPart.parent.pdgId) == abs(restGenPart.pdgId))
-                | abs(restGenPart.parent.pdgId)
-                == 21
-            )
-            & ~(
-                (abs(restGenPart.pdgId) == abs(GenPart.parent.pdgId))
-                & (restGenPart.parent.status >= 21)
-                & (restGenPart.parent.status <= 29)
+@nb.njit(cache=True)
+def _first_ancestor(sel, mother, mask, max_depth):
+    out = np.full(len(sel), -1, np.int64)
+    for n in range(len(sel)):
+        p, depth = mother[sel[n]], 1
+        while p >= 0 and depth <= max_depth:
+            if mask[p]:
+                out[n] = p
+                break
+            p, depth = mother[p], depth + 1
+    return out
+
+
+@nb.njit(cache=True)
+def _descendants(sel, offsets, daughters, mask, max_depth):
+    out = np.empty(len(sel), np.int64)
+    counts = np.zeros(len(sel), np.int64)
+    n = 0
+    for s in range(len(sel)):
+        frontier = sel[s : s + 1]
+        for _ in range(max_depth):
+            size = 0
+            for p in frontier:
+                size += offsets[p + 1] - offsets[p]
+            if size == 0:
+                break
+            # next generation, in the order of .children.children...
+            generation = np.empty(size, np.int64)
+            k = 0
+            for p in frontier:
+                for d in daughters[offsets[p] : offsets[p + 1]]:
+                    generation[k] = d
+                    k += 1
+                    if mask[d]:
+                        if n == len(out):
+                            out = np.concatenate((out, np.empty(n + 1, np.int64)))
+                        out[n] = d
+                        n += 1
+                        counts[s] += 1
+            frontier = generation
+    return out[:n], counts
+
+
+@nb.njit(cache=True)
+def _from_GSP(sel, mother, mother2, pdgId, status):
+    # as the awkward implementation used before, including its operator precedence:
+    # ((|pdgId(mother)| == |pdgId|) | |pdgId(mother)|) == 21
+    out = np.zeros(len(sel), np.bool_)
+    for n in range(len(sel)):
+        i = sel[n]
+        m = mother[i]
+        if m < 0:
+            continue
+        if (
+            mother2[i] == -1
+            and abs(pdgId[m]) == 21
+            and ((abs(pdgId[m]) == abs(pdgId[i])) | abs(pdgId[m])) == 21
+            and not (abs(pdgId[i]) == abs(pdgId[m]) and 21 <= status[m] <= 29)
+        ):
+            out[n] = True
+            continue
+        # walk up while the ancestors pass, a gluon ancestor flags the GSP
+        r = m
+        while mother[r] >= 0:
+            pr = mother[r]
+            passed = (
+                mother2[r] == -1
+                and ((abs(pdgId[pr]) == abs(pdgId[r])) | abs(pdgId[pr])) == 21
+                and not (abs(pdgId[r]) == abs(pdgId[m]) and 21 <= status[pr] <= 29)
             )
+            if passed and pdgId[r] == 21:
+                out[n] = True
+            if out[n] or not passed:
+                break
+            r = pr
+    return out
+
+
+class GenPartIndex:
+    """mother/daughter index of the GenPart collection of a chunk
+
+    Built once from genPartIdxMother, with indices global over the chunk:
+    mother[i] is the mother of particle i (-1 if none), its daughters are
+    daughters[offsets[i]:offsets[i + 1]], in the order of GenPart.children.
+    The ancestry routines are compiled, instead of .parent/.children chains.
+    sel and mask are boolean arrays of the GenPart shape, the results have the
+    shape of GenPart[sel] and refer to particles by their index in GenPart[mask].
+    """
+
+    def __init__(self, GenPart):
+        flat = lambda array: ak.to_numpy(ak.flatten(array))
+        self.counts = ak.to_numpy(ak.num(GenPart))
+        self.starts = np.cumsum(self.counts) - self.counts
+        self.event = np.repeat(np.arange(len(self.counts)), self.counts)
+        mother = flat(GenPart.genPartIdxMother).astype(np.int64)
+        self.mother = np.where(mother >= 0, mother + self.starts[self.event], -1)
+        # daughters grouped by mother, stable: increasing index
+        order = np.argsort(self.mother, kind="stable")
+        nroots = np.count_nonzero(self.mother < 0)
+        self.daughters = order[nroots:]
+        self.offsets = np.concatenate(
+            [
+                [0],
+                np.cumsum(
+                    np.bincount(self.mother[self.daughters], minlength=len(mother))
+                ),
+            ]
         )
-        mask_forbad = ak.fill_none(mask_forbad, False)
-        QGP = (mask_forbad & ak.fill_none((abs(restGenPart.pdgId == 21)), False)) | QGP
+        self.mother2 = flat(GenPart.genPartIdxMother2)
+        self.pdgId = flat(GenPart.pdgId)
+        self.status = flat(GenPart.status)
 
-        rest_QGP = ak.mask(restGenPart, (~QGP) & (mask_forbad))
-        restGenPart = rest_QGP.parent
-        if ak.all(restGenPart.parent.pdgId == True):
-            break
+    def _flat(self, mask):
+        return ak.to_numpy(ak.flatten(mask)).astype(bool)
 
-    return ak.fill_none(QGP, False)
+    def _selected(self, sel):
+        sel = self._flat(sel)
+        return np.flatnonzero(sel), np.bincount(
+            self.event[sel], minlength=len(self.counts)
+        )
 
+    def _rank(self, mask):
+        """index in GenPart[mask] of the particles, by global index"""
+        before = np.concatenate([[0], np.cumsum(mask)])
+        return before[1:] - 1 - before[self.starts][self.event]
 
-@nb.njit
-def to_bitwise_trigger(pass_trig, builder):
-    for it in pass_trig:
-        # group by every 32 bits
-        builder.begin_list()
-        for bitidx in range(len(it) // 32 + 1):
-            trig = 0
-            start = bitidx * 32
-            end = min((bitidx + 1) * 32, len(it))
-            for i, b in enumerate(it[start:end]):
-                trig += b << i
-            builder.integer(trig)
-        builder.end_list()
+    def n_daughters(self, mask):
+        """number of daughters passing mask, for every particle"""
+        mask = self._flat(mask) & (self.mother >= 0)
+        return ak.unflatten(
+            np.bincount(self.mother[mask], minlength=len(self.mother)), self.counts
+        )
 
-    return builder
+    def first_ancestor(self, sel, mask, max_depth=-1):
+        """first ancestor passing mask within max_depth generations (all if < 0), -1 if none"""
+        index, counts = self._selected(sel)
+        mask = self._flat(mask)
+        ancestor = _first_ancestor(
+            index,
+            self.mother,
+            mask,
+            # no walk is longer than the number of particles
+            len(self.mother) if max_depth < 0 else max_depth,
+        )
+        return ak.unflatten(
+            np.where(ancestor >= 0, self._rank(mask)[ancestor], -1), counts
+        )
+
+    def descendants(self, sel, mask, max_depth=1):
+        """descendants passing mask within max_depth generations, by generation, dim: (event, sel, descendant)"""
+        index, counts = self._selected(sel)
+        mask = self._flat(mask)
+        found, ndesc = _descendants(
+            index, self.offsets, self.daughters, mask, max_depth
+        )
+        return ak.unflatten(ak.unflatten(self._rank(mask)[found], ndesc), counts)
+
+    def from_GSP(self, sel):
+        """particles from gluon splitting"""
+        index, counts = self._selected(sel)
+        return ak.unflatten(
+            _from_GSP(index, self.mother, self.mother2, self.pdgId, self.status),
+            counts,
+        )
 
 
 @nb.vectorize([nb.float64(nb.int64)], forceobj=True)
@@ -156,6 +306,154 @@ def cumsum(array):
     return cumsum_array
 
 
+@nb.njit(cache=True)
+def _track_category(isHitL1, npixel, abseta, p, nhits, chi2, categories):
+    for icat in range(len(categories)):
+        cat = categories[icat]
+        if (cat[0] == 1 and not isHitL1) or (cat[0] == -1 and isHitL1):
+            continue
+        if (
+            cat[1] <= npixel <= cat[2]
+            and cat[3] <= abseta <= cat[4]
+            and cat[5] <= p <= cat[6]
+            and cat[7] <= nhits <= cat[8]
+            and cat[9] <= chi2 <= cat[10]
+        ):
+            return icat
+    return -1
+
+
+@nb.njit(cache=True)
+def _associate_tracks(
+    jet_offsets,
+    jet_eta,
+    jet_phi,
+    jet_key,
+    trk_offsets,
+    trk_eta,
+    trk_phi,
+    trk_key,
+    dr,
+    trk_vars,
+    categories,
+):
+    """matched (jet, track) pairs, per event ordered by jet then by track index
+
+    The tracks of an event are sorted in eta once, each jet only visits the
+    tracks of its eta window. Returns the track index in the event and the
+    category of each pair, and the number of tracks of each jet.
+    """
+    pi, twopi = np.float32(np.pi), np.float32(2 * np.pi)
+    # the eta window is widened by a margin against rounding, deltaR decides
+    window = dr + np.float32(1e-3)
+    index = np.empty(len(trk_eta), np.int64)
+    category = np.empty(len(trk_eta), np.int64)
+    jet_counts = np.zeros(len(jet_eta), np.int64)
+    n = 0
+    for i in range(len(jet_offsets) - 1):
+        t0, t1 = trk_offsets[i], trk_offsets[i + 1]
+        if t0 == t1:
+            continue
+        order = np.argsort(trk_eta[t0:t1], kind="mergesort")
+        sorted_eta = trk_eta[t0:t1][order]
+        for j in range(jet_offsets[i], jet_offsets[i + 1]):
+            start = n
+            k = np.searchsorted(sorted_eta, jet_eta[j] - window)
+            while k < t1 - t0 and sorted_eta[k] <= jet_eta[j] + window:
+                t = t0 + order[k]
+                k += 1
+                if trk_key[t] != jet_key[j]:
+                    continue
+                # as coffea delta_r, in the precision of the inputs
+                deta = jet_eta[j] - trk_eta[t]
+                dphi = (jet_phi[j] - trk_phi[t] + pi) % twopi - pi
+                if np.hypot(deta, dphi) >= dr:
+                    continue
+                if n == len(index):
+                    index = np.concatenate((index, np.empty(n + 1, np.int64)))
+                    category = np.concatenate((category, np.empty(n + 1, np.int64)))
+                index[n] = t - t0
+                category[n] = (
+                    _track_category(
+                        trk_vars[t, 0] == -1,
+                        trk_vars[t, 1],
+                        abs(trk_vars[t, 2]),
+                        trk_vars[t, 3] * np.cosh(trk_vars[t, 2]),
+                        trk_vars[t, 4],
+                        trk_vars[t, 5],
+                        categories,
+                    )
+                    if len(categories) > 0
+                    else -1
+                )
+                n += 1
+            # keep the track order of the event within each jet
+            jet_order = np.argsort(index[start:n], kind="mergesort")
+            index[start:n] = index[start:n][jet_order]
+            category[start:n] = category[start:n][jet_order]
+            jet_counts[j] = n - start
+    return index[:n], category[:n], jet_counts
+
+
+def _offsets(array):
+    return np.concatenate([[0], np.cumsum(ak.to_numpy(ak.num(array)))])
+
+
+def associate_tracks(jet, trk, dr=0.4, categories=None):
+    """tracks of trk (JetPFCands) associated with each jet, dim: (event, jet, track)
+
+    A track is associated with the jet it belongs to in JetPFCands
+    (trk.jet.pt == jet.pt_orig) if deltaR(jet, track) < dr. With categories
+    (e.g. JP_track_categories), the "category" field holds the first category
+    passed by the track, -1 if none. Only the matched pairs are built, instead
+    of the full (jet, track) cartesian product.
+    """
+    # float32 as in NanoAOD, missing cross-references as nan
+    flat = lambda array: np.ma.filled(
+        ak.to_numpy(ak.flatten(array)).astype(np.float32), np.nan
+    )
+    if categories is None:
+        categories = np.zeros((0, 11), np.float32)
+        trk_vars = np.zeros((0, 6), np.float32)
+    else:
+        trk_vars = np.stack(
+            [
+                flat(trk.pf[field])
+                for field in [
+                    "lostInnerHits",
+                    "numberOfPixelHits",
+                    "trkEta",
+                    "trkPt",
+                    "numberOfHits",
+                    "trkChi2",
+                ]
+            ],
+            axis=1,
+        )
+    index, category, jet_counts = _associate_tracks(
+        _offsets(jet),
+        flat(jet.eta),
+        flat(jet.phi),
+        flat(jet.pt_orig),
+        _offsets(trk),
+        flat(trk.pf.eta),
+        flat(trk.pf.phi),
+        flat(trk.jet.pt),
+        np.float32(dr),
+        trk_vars,
+        categories,
+    )
+    event_counts = ak.sum(ak.unflatten(jet_counts, ak.num(jet)), axis=1)
+    # (event, pair) -> (jet, track) -> (event, jet, track), axis 0 keeps the jets without tracks
+    nest = lambda pairs: ak.unflatten(
+        ak.unflatten(ak.flatten(pairs), jet_counts), ak.num(jet)
+    )
+    tracks = nest(trk[ak.unflatten(index, event_counts)])
+    if len(categories) > 0:
+        tracks["category"] = nest(ak.unflatten(category, event_counts))
+    return tracks
+
+
 def calc_ip_vector(obj, dxy, dz, is_3d=False):
     """Calculate the 2D or 3D impact parameter vector, given the track obj (with 4-mom),
     and its dxy and dz, taking the standard definition from NanoAOD"""
@@ -1,5 +1,6 @@
 import awkward as ak
 import numpy as np
+import numba as nb
 from coffea import processor
 import psutil, os
 import uproot
@@ -25,15 +26,191 @@ def normalize(val, cut):
         return ar
 
 
+_indexed_types = (
+    ak.layout.IndexedArray64,
+    ak.layout.IndexedArray32,
+    ak.layout.IndexedArrayU32,
+)
+
+
+def _record_layout(array):
+    """underlying record and index of a (virtual, indexed) record array layout"""
+    layout, index = array.layout, None
+    while isinstance(layout, (ak.layout.VirtualArray,) + _indexed_types):
+        if isinstance(layout, ak.layout.VirtualArray):
+            layout = layout.array
+            continue
+        index = (
+            np.asarray(layout.index)
+            if index is None
+            else np.asarray(layout.index)[index]
+        )
+        layout = layout.content
+    return layout, index
+
+
 def update(events, collections):
-    """Return a shallow copy of events array with some collections swapped out"""
-    out = events
-    for name, value in collections.items():
-        out = ak.with_field(out, value, name)
-    return out
+    """Return a shallow copy of events array with some collections swapped out
+
+    The record is rebuilt once for all the collections, the other fields keep
+    their (lazy) content, only reindexed if the events are masked.
+    """
+    record, index = _record_layout(events)
+    values = {
+        name: value.layout if isinstance(value, ak.Array) else None
+        for name, value in collections.items()
+    }
+    if (
+        not isinstance(record, ak.layout.RecordArray)
+        or record.istuple
+        or any(value is None or len(value) != len(events) for value in values.values())
+    ):
+        out = events
+        for name, value in collections.items():
+            out = ak.with_field(out, value, name)
+        return out
+    # same field order as with_field: the swapped collections move to the end
+    keys = [key for key in record.keys() if key not in values]
+    contents = []
+    for key in keys:
+        content = record.field(key)
+        if len(content) != len(record):
+            content = content[: len(record)]
+        if index is not None:
+            content = ak.layout.IndexedArray64(ak.layout.Index64(index), content)
+        contents.append(content)
+    return ak.Array(
+        ak.layout.RecordArray(
+            contents + list(values.values()),
+            keys + list(values.keys()),
+            len(events),
+            parameters=record.parameters,
+        ),
+        behavior=events.behavior,
+    )
+
+
+def _lazy_field(function, flat, dtype):
+    return ak.layout.NumpyArray(np.asarray(function(flat), dtype=dtype))
+
+
+def lazy_update(collection, fields, dtype=np.float32):
+    """Return collection with derived fields only computed when first accessed
+
+    fields: {name: function}, each function is called with the (flattened, if
+    jagged) collection and returns the flat values of the field, which are
+    cached afterwards. Nothing is read from the file until the field is used.
+    """
+    jagged = collection.ndim > 1
+    flat = ak.flatten(collection) if jagged else collection
+    # with_field would materialize the new fields on a virtual or indexed
+    # (masked) record, they are added to the underlying record and reindexed
+    layout, index = _record_layout(flat)
+    content = ak.Array(layout, behavior=flat.behavior)
+    for name, function in fields.items():
+        content = ak.with_field(
+            content,
+            ak.virtual(
+                _lazy_field,
+                args=(function, content, dtype),
+                length=len(content),
+                form=ak.forms.Form.from_numpy(np.dtype(dtype)),
+            ),
+            name,
+        )
+    if index is not None:
+        content = ak.Array(
+            ak.layout.IndexedArray64(ak.layout.Index64(index), content.layout),
+            behavior=flat.behavior,
+        )
+    return ak.unflatten(content, ak.num(collection)) if jagged else content
 
 
 # return run & lumiblock in pairs
+class SelectedEvents:
+    """Events passing the selection of a shift, masked once
+
+    Columns given as dotted names (e.g. "Pileup.nTrueInt") are gathered once
+    into packed arrays and returned by ``selev[column]``. Any other attribute
+    falls back on the masked events, so it can be used as ``events[event_level]``
+    """
+
+    def __init__(self, events, event_level, columns=[]):
+        self.events = events[event_level]
+        self._columns = {}
+        for column in columns:
+            self[column]
+
+    def __getitem__(self, column):
+        if column not in self._columns:
+            array = self.events
+            for field in column.split("."):
+                array = array[field]
+            self._columns[column] = ak.packed(array)
+        return self._columns[column]
+
+    def __getattr__(self, name):
+        if name.startswith("_") or name == "events":
+            raise AttributeError(name)
+        return getattr(self.events, name)
+
+    def __len__(self):
+        return len(self.events)
+
+
+@nb.njit
+def _gather_jet_pfcands(sel_idx, sel_counts, jpf_jet, jpf_cand, jpf_counts, pf_counts):
+    # global PFCands index of the candidates of each selected jet, in JetPFCands order
+    ncand = np.zeros(len(sel_idx), np.int64)
+    s0, k0 = 0, 0
+    for ev in range(len(sel_counts)):
+        for k in range(k0, k0 + jpf_counts[ev]):
+            for s in range(s0, s0 + sel_counts[ev]):
+                if sel_idx[s] == jpf_jet[k]:
+                    ncand[s] += 1
+        s0 += sel_counts[ev]
+        k0 += jpf_counts[ev]
+    cursor = np.zeros(len(sel_idx), np.int64)
+    cursor[1:] = np.cumsum(ncand)[:-1]
+    cands = np.empty(ncand.sum(), np.int64)
+    s0, k0, p0 = 0, 0, 0
+    for ev in range(len(sel_counts)):
+        for k in range(k0, k0 + jpf_counts[ev]):
+            for s in range(s0, s0 + sel_counts[ev]):
+                if sel_idx[s] == jpf_jet[k]:
+                    cands[cursor[s]] = p0 + jpf_cand[k]
+                    cursor[s] += 1
+        s0 += sel_counts[ev]
+        k0 += jpf_counts[ev]
+        p0 += pf_counts[ev]
+    return ncand, cands
+
+
+def jet_pfcands(events, jet_index):
+    """PFCands of the selected jets, gathered in a single pass
+
+    jet_index: indices in events.Jet of the selected jets, either (event, jet)
+    giving (event, jet, PFCands), or one jet per event giving (event, PFCands).
+    Missing (None) jets get no candidates.
+    """
+    single = jet_index.ndim == 1
+    if single:
+        jet_index = ak.singletons(jet_index)
+    jet_index = ak.fill_none(jet_index, -1)
+    ncand, cands = _gather_jet_pfcands(
+        ak.to_numpy(ak.flatten(jet_index)).astype(np.int64),
+        ak.to_numpy(ak.num(jet_index)),
+        ak.to_numpy(ak.flatten(events.JetPFCands.jetIdx)).astype(np.int64),
+        ak.to_numpy(ak.flatten(events.JetPFCands.pFCandsIdx)).astype(np.int64),
+        ak.to_numpy(ak.num(events.JetPFCands)),
+        ak.to_numpy(ak.num(events.PFCands)),
+    )
+    pfcands = ak.unflatten(ak.flatten(events.PFCands)[cands], ncand)
+    if single:
+        return ak.flatten(ak.unflatten(pfcands, ak.num(jet_index)), axis=2)
+    return ak.unflatten(pfcands, ak.num(jet_index))
+
+
 def dump_lumi(events, output):
     pairs = np.vstack((events.run.to_numpy(), events.luminosityBlock.to_numpy()))
     # remove replicas
@@ -47,6 +224,17 @@ def dump_lumi(events, output):
     return output
 
 
+def dump_sumw(events, lumiMask):
+    """sum of weights and certified lumi blocks of the chunk, before any event is dropped"""
+    output = {}
+    if not hasattr(events, "genWeight"):
+        output["sumw"] = len(events)
+        events = events[lumiMask(events.run, events.luminosityBlock)]
+    else:
+        output["sumw"] = ak.sum(events.genWeight)
+    return dump_lumi(events, output)
+
+
 def num(ar):
     return ak.num(ak.fill_none(ar[~ak.is_none(ar)], 0), axis=0)
 
@@ -65,8 +253,15 @@ def _is_rootcompat(a):
     return False
 
 
-def uproot_writeable(events, include=["events", "run", "luminosityBlock"]):
-    ev = {}
+def writeable_plan(events, include=["events", "run", "luminosityBlock"]):
+    """fields of events kept by uproot_writeable for the include list
+
+    Returns [(branch, None)] for the flat branches and [(collection, [(field,
+    check)])] for the collections, check marks the fields which are not flat or
+    1-d jagged and are only kept if they flatten to one value per event. It only
+    depends on the fields and types, so it can be computed once per schema.
+    """
+    plan = []
     include = np.array(include)
     no_filter = False
     if len(include) == 1 and include[0] == "*":
@@ -75,11 +270,9 @@ def uproot_writeable(events, include=["events", "run", "luminosityBlock"]):
         if not events[bname].fields:
             if not no_filter and bname not in include:
                 continue
-            ev[bname] = ak.fill_none(
-                ak.packed(ak.without_parameters(events[bname])), -99
-            )
+            plan.append((bname, None))
         else:
-            b_nest = {}
+            nested = []
             no_filter_nest = False
             if all(np.char.startswith(include, bname) == False):
                 continue
@@ -104,18 +297,37 @@ def uproot_writeable(events, include=["events", "run", "luminosityBlock"]):
                     and "Flavor" not in n
                 ):
                     continue
-                evnums = ak.num(events[bname][n], axis=0)
-                if not isinstance(evnums, int):
-                    continue
-                if not _is_rootcompat(events[bname][n]) and evnums != len(
-                    flatten(events[bname][n])
-                ):
-                    continue
                 # skip IdxG
                 if "IdxG" in n:
                     continue
-                b_nest[n] = ak.fill_none(
-                    ak.packed(ak.without_parameters(events[bname][n])), -99
-                )
-            ev[bname] = ak.zip(b_nest)
+                nested.append((n, not _is_rootcompat(events[bname][n])))
+            plan.append((bname, nested))
+    return plan
+
+
+def writeable_signature(events):
+    """fields of events and the forms of its collections, the plan of uproot_writeable is reused for the same signature"""
+    # writeable_plan checks the types of the fields, the forms give them without reading the arrays
+    return tuple((bname, events[bname].layout.form.tojson()) for bname in events.fields)
+
+
+def uproot_writeable(events, include=["events", "run", "luminosityBlock"], plan=None):
+    """branches of events to write with uproot, selected by the include list or a plan from writeable_plan"""
+    if plan is None:
+        plan = writeable_plan(events, include)
+    ev = {}
+    for bname, nested in plan:
+        if nested is None:
+            ev[bname] = ak.fill_none(
+                ak.packed(ak.without_parameters(events[bname])), -99
+            )
+            continue
+        b_nest = {}
+        for n, check in nested:
+            if check and len(events) != len(flatten(events[bname][n])):
+                continue
+            b_nest[n] = ak.fill_none(
+                ak.packed(ak.without_parameters(events[bname][n])), -99
+            )
+        ev[bname] = ak.zip(b_nest)
     return ev
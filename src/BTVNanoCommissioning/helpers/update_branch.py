@@ -1,8 +1,31 @@
-from BTVNanoCommissioning.helpers.func import update
+from BTVNanoCommissioning.helpers.func import lazy_update
 from BTVNanoCommissioning.utils.correction import add_jec_variables
 import numpy as np
 
 
+## derived fields of missing_branch, computed on the flat jets when first accessed
+def _deepflav_b(jet):
+    return jet.btagDeepFlavB_b + jet.btagDeepFlavB_bb + jet.btagDeepFlavB_lepb
+
+
+def _deepflav_c(jet):
+    return (jet.btagDeepFlavCvL / (1.0 - jet.btagDeepFlavCvL)) * jet.btagDeepFlavB
+
+
+def _deepflav_cvl(jet):
+    cvl = jet.btagDeepFlavC / (1.0 - jet.btagDeepFlavB)
+    return np.maximum(
+        np.minimum(np.where((cvl > 0) & (jet.pt > 15), cvl, -1), 0.999999), -1
+    )
+
+
+def _deepflav_cvb(jet):
+    cvb = jet.btagDeepFlavC / (jet.btagDeepFlavC + jet.btagDeepFlavB)
+    return np.maximum(
+        np.minimum(np.where((cvb > 0) & (jet.pt > 15), cvb, -1), 0.999999), -1
+    )
+
+
 def missing_branch(events):
     events["fixedGridRhoFastjetAll"] = (
         events.fixedGridRhoFastjetAll
@@ -12,84 +35,30 @@ def missing_branch(events):
     ## calculate missing nodes
 
     if not hasattr(events.Jet, "btagDeepFlavB"):
-        jets = events.Jet
-        jets["btagDeepFlavB"] = (
-            events.Jet.btagDeepFlavB_b
-            + events.Jet.btagDeepFlavB_bb
-            + events.Jet.btagDeepFlavB_lepb
-        )
-        events.Jet = update(
-            events.Jet,
-            {"btagDeepFlavB": jets.btagDeepFlavB},
-        )
+        events.Jet = lazy_update(events.Jet, {"btagDeepFlavB": _deepflav_b})
     if hasattr(events.Jet, "btagDeepFlavCvL") and not hasattr(
         events.Jet, "btagDeepFlavC"
     ):
-        jets = events.Jet
-        jets["btagDeepFlavC"] = (
-            events.Jet.btagDeepFlavCvL / (1.0 - events.Jet.btagDeepFlavCvL)
-        ) * events.Jet.btagDeepFlavB
-        events.Jet = update(
-            events.Jet,
-            {"btagDeepFlavC": jets.btagDeepFlavC},
-        )
+        events.Jet = lazy_update(events.Jet, {"btagDeepFlavC": _deepflav_c})
     if hasattr(events.Jet, "btagDeepFlavC") and not hasattr(
         events.Jet, "btagDeepFlavCvL"
     ):
-        jets = events.Jet
-        jets["btagDeepFlavCvL"] = np.maximum(
-            np.minimum(
-                np.where(
-                    ((events.Jet.btagDeepFlavC / (1.0 - events.Jet.btagDeepFlavB)) > 0)
-                    & (events.Jet.pt > 15),
-                    (events.Jet.btagDeepFlavC / (1.0 - events.Jet.btagDeepFlavB)),
-                    -1,
-                ),
-                0.999999,
-            ),
-            -1,
-        )
-        jets["btagDeepFlavCvB"] = np.maximum(
-            np.minimum(
-                np.where(
-                    (
-                        (
-                            events.Jet.btagDeepFlavC
-                            / (events.Jet.btagDeepFlavC + events.Jet.btagDeepFlavB)
-                        )
-                        > 0
-                    )
-                    & (events.Jet.pt > 15),
-                    (
-                        events.Jet.btagDeepFlavC
-                        / (events.Jet.btagDeepFlavC + events.Jet.btagDeepFlavB)
-                    ),
-                    -1,
-                ),
-                0.999999,
-            ),
-            -1,
-        )
-        events.Jet = update(
+        events.Jet = lazy_update(
             events.Jet,
-            {
-                "btagDeepFlavCvL": jets.btagDeepFlavCvL,
-                "btagDeepFlavCvB": jets.btagDeepFlavCvB,
-            },
+            {"btagDeepFlavCvL": _deepflav_cvl, "btagDeepFlavCvB": _deepflav_cvb},
         )
     if hasattr(events, "METFixEE2017"):
         events.MET = events.METFixEE2017
     if hasattr(events.PuppiMET, "ptUnclusteredUp") and not hasattr(
         events.PuppiMET, "MetUnclustEnUpDeltaX"
     ):
-        met = events.PuppiMET
-        met["MetUnclustEnUpDeltaX"] = met.ptUnclusteredUp * np.cos(met.phiUnclusteredUp)
-        met["MetUnclustEnUpDeltaY"] = met.ptUnclusteredUp * np.sin(met.phiUnclusteredUp)
-        events.PuppiMET = update(
+        events.PuppiMET = lazy_update(
             events.PuppiMET,
             {
-                "MetUnclustEnUpDeltaX": met.MetUnclustEnUpDeltaX,
-                "MetUnclustEnUpDeltaY": met.MetUnclustEnUpDeltaY,
+                "MetUnclustEnUpDeltaX": lambda met: met.ptUnclusteredUp
+                * np.cos(met.phiUnclusteredUp),
+                "MetUnclustEnUpDeltaY": lambda met: met.ptUnclusteredUp
+                * np.sin(met.phiUnclusteredUp),
             },
         )
     return events
@@ -1,7 +1,413 @@
-from BTVNanoCommissioning.helpers.func import uproot_writeable
+from BTVNanoCommissioning.helpers.func import (
+    uproot_writeable,
+    writeable_plan,
+    writeable_signature,
+)
+from BTVNanoCommissioning.utils.reader import chunk_name
 import numpy as np
 import awkward as ak
-import os, uproot
+import fnmatch, glob, os, socket, uproot, threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class WriterPolicy:
+    """compression and basket size of the ROOT files written by the workflows
+
+    codec: ZLIB, LZ4, ZSTD or LZMA (LZ4 needs the lz4 and xxhash packages, ZSTD
+    the zstandard package), level: compression level, basket_size: maximum
+    uncompressed size of the baskets of a branch in bytes, larger writes are
+    split, None lets uproot write one basket per write. Set with --compression
+    codec:level and --basketSize.
+
+    dtypes: output types of the branches, see cast_branches. Declared by the
+    workflows as branch_dtypes.
+    """
+
+    def __init__(self, codec="ZLIB", level=1, basket_size=None, dtypes=None):
+        self.codec = codec.upper()
+        self.level = level
+        self.basket_size = basket_size
+        self.dtypes = dtypes
+        if not hasattr(uproot, self.codec):
+            raise ValueError(f"Unknown compression {codec}")
+
+    @classmethod
+    def from_string(cls, compression, basket_size=None):
+        """WriterPolicy from codec[:level], e.g. lz4:4 or zstd"""
+        codec, _, level = compression.partition(":")
+        return cls(codec, int(level) if level else 1, basket_size)
+
+    @property
+    def compression(self):
+        return getattr(uproot, self.codec)(self.level)
+
+    def recreate(self, path):
+        return uproot.recreate(path, compression=self.compression)
+
+    def write(self, fout, name, branches, extend=False):
+        """write (extend=False) or extend the tree name with branches, in baskets of at most basket_size"""
+        if not isinstance(branches, dict):
+            # a tree written from a single array has one unnamed branch
+            if extend:
+                fout[name].extend({"": branches})
+            else:
+                fout[name] = branches
+            return
+        if self.dtypes is not None:
+            branches = cast_branches(branches, self.dtypes)
+        nentries = _length(branches)
+        step = nentries
+        if self.basket_size is not None and nentries > 0:
+            # the largest branch sets the number of entries per basket
+            step = max(
+                1, int(self.basket_size * nentries / max(_max_nbytes(branches), 1))
+            )
+        for start in range(0, max(nentries, 1), max(step, 1)):
+            batch = {
+                key: value[start : start + step] for key, value in branches.items()
+            }
+            if not extend and start == 0:
+                fout[name] = batch
+            else:
+                fout[name].extend(batch)
+
+
+def writer_policy(processor):
+    """writer policy of a processor, the uproot defaults if not set, with the branch types declared by the processor"""
+    policy = getattr(processor, "writer_policy", None) or WriterPolicy()
+    dtypes = getattr(processor, "branch_dtypes", None)
+    if dtypes is not None and policy.dtypes is None:
+        policy = WriterPolicy(policy.codec, policy.level, policy.basket_size, dtypes)
+    return policy
+
+
+def truncate_mantissa(array, bits):
+    """float32 values rounded to the nearest value with bits mantissa bits (out of 23)"""
+    array = np.asarray(array, dtype=np.float32)
+    drop = 23 - bits
+    if drop <= 0:
+        return array
+    raw = array.view(np.uint32)
+    rounded = ((raw + np.uint32(1 << (drop - 1))) >> drop) << drop
+    return np.where(np.isfinite(array), rounded, raw).view(np.float32)
+
+
+def _cast(name, leaf, dtypes):
+    flat = ak.to_numpy(ak.flatten(leaf, axis=None))
+    for rule in dtypes:
+        if not fnmatch.fnmatchcase(name, rule[0]):
+            continue
+        if rule[1] is None:
+            return leaf
+        dtype = np.dtype(rule[1])
+        # float rules apply to floats, int/bool rules to ints and bools, only downcasting
+        if (dtype.kind == "f") != (flat.dtype.kind == "f"):
+            continue
+        if dtype.itemsize > flat.dtype.itemsize or (
+            dtype.itemsize == flat.dtype.itemsize and dtype.kind == flat.dtype.kind
+        ):
+            if len(rule) < 3:
+                return leaf
+        elif dtype.kind == "b":
+            if not np.all((flat == 0) | (flat == 1)):
+                raise ValueError(f"{name} is not boolean, it cannot be written as bool")
+        elif dtype.kind in "iu" and len(flat) > 0:
+            info = np.iinfo(dtype)
+            if flat.min() < info.min or flat.max() > info.max:
+                raise ValueError(f"{name} does not fit in {dtype}")
+        if len(rule) < 3 or dtype != np.float32:
+            return ak.values_astype(leaf, dtype)
+        flat = truncate_mantissa(flat, rule[2])
+        if leaf.ndim == 1:
+            return flat
+        if leaf.ndim == 2:
+            return ak.unflatten(flat, ak.num(leaf))
+        raise ValueError(
+            f"{name}: mantissa truncation is only done on flat or jagged arrays"
+        )
+    return leaf
+
+
+def cast_branches(branches, dtypes):
+    """branches converted to the output types declared in dtypes
+
+    dtypes: [(pattern, dtype) or (pattern, "float32", mantissa bits)], the
+    first rule matching the branch name (as written, e.g. Jet_pt) and of the
+    same kind (float rule for float branches, int or bool rule for int and bool
+    branches) applies, a dtype of None keeps the branch as it is. Branches are
+    only downcast, ints and bools are checked to fit in the declared type. The
+    mantissa bits round float32 values, for variables with a limited precision.
+    """
+    out = {}
+    for key, value in branches.items():
+        if isinstance(value, ak.Array) and len(value.fields) > 0:
+            out[key] = ak.zip(
+                {f: _cast(f"{key}_{f}", value[f], dtypes) for f in value.fields}
+            )
+        else:
+            out[key] = _cast(key, value, dtypes)
+    return out
+
+
+class WriterPool:
+    """bounded pool of background threads writing the output ROOT files
+
+    The compute thread hands the prepared (materialized) branches over with
+    submit() and continues with the next shift, compression and I/O happen in
+    the pool. submit() blocks while more than max_queued bytes wait to be
+    written, so a slow disk cannot exhaust the worker memory. flush() waits for
+    the files submitted by the calling thread and raises their errors, it is
+    called before a chunk is returned so the chunk is only done once written.
+
+    The branches of append() are staged until flush(): a chunk is only added to
+    the per-dataset files once all its shifts succeeded. reset() drops the
+    branches staged by the calling thread, it is called when a chunk starts so
+    the branches of a failed attempt are not written with those of its retry.
+    """
+
+    def __init__(self, threads=2, max_queued=1024**3):
+        self.max_queued = max_queued
+        self._executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="array_writer"
+        )
+        self._queued = 0
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._staged = {}
+        self._appenders = {}
+
+    def _reserve(self, nbytes):
+        with self._cond:
+            # a single payload larger than the limit still goes through alone
+            while self._queued > 0 and self._queued + nbytes > self.max_queued:
+                self._cond.wait()
+            self._queued += nbytes
+
+    def _release(self, nbytes):
+        with self._cond:
+            self._queued -= nbytes
+            self._cond.notify_all()
+
+    def _write(self, path, branches, nbytes, policy):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with policy.recreate(path) as fout:
+                for key, value in branches.items():
+                    policy.write(fout, key, value)
+        finally:
+            self._release(nbytes)
+
+    def _append(self, appender, branches, nbytes):
+        try:
+            appender.append(branches)
+        finally:
+            self._release(nbytes)
+
+    def submit(self, path, branches, policy=None):
+        nbytes = _nbytes(branches)
+        self._reserve(nbytes)
+        future = self._executor.submit(
+            self._write, path, branches, nbytes, policy or WriterPolicy()
+        )
+        self._pending.setdefault(threading.get_ident(), []).append(future)
+        return future
+
+    def appender(self, outdir, max_size, policy=None):
+        if outdir not in self._appenders:
+            self._appenders[outdir] = ArrayAppender(
+                outdir, max_size, policy or WriterPolicy()
+            )
+        return self._appenders[outdir]
+
+    def append(self, chunk, appender, branches):
+        thread = threading.get_ident()
+        if thread in self._staged and self._staged[thread][0] != chunk:
+            self._discard(thread)
+        nbytes = _nbytes(branches)
+        self._reserve(nbytes)
+        self._staged.setdefault(thread, (chunk, []))[1].append(
+            (appender, branches, nbytes)
+        )
+
+    def _discard(self, thread):
+        for _, _, nbytes in self._staged.pop(thread, (None, []))[1]:
+            self._release(nbytes)
+
+    def reset(self):
+        self._discard(threading.get_ident())
+
+    def flush(self):
+        thread = threading.get_ident()
+        for appender, branches, nbytes in self._staged.pop(thread, (None, []))[1]:
+            self._pending.setdefault(thread, []).append(
+                self._executor.submit(self._append, appender, branches, nbytes)
+            )
+        for future in self._pending.pop(thread, []):
+            future.result()
+
+    def close(self):
+        for appender in self._appenders.values():
+            appender.close()
+        self._appenders.clear()
+
+
+class ArrayAppender:
+    """appends the chunks of a dataset and shift to files of at most max_size bytes
+
+    Files are written as {host}_{pid}_{n}.root.part, the file stays readable
+    after every chunk. It is renamed to .root once complete: when it reaches
+    max_size, when the structure of the branches changes, or by
+    finalise_arrays() at the end of the job.
+    """
+
+    def __init__(self, outdir, max_size, policy):
+        self.outdir = outdir
+        self.max_size = max_size
+        self.policy = policy
+        self.path = None
+        self._file = None
+        self._types = {}
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def _open(self):
+        os.makedirs(self.outdir, exist_ok=True)
+        self.path = os.path.join(
+            self.outdir,
+            f"{socket.gethostname()}_{os.getpid()}_{self._count}.root.part",
+        )
+        self._count += 1
+        self._file = self.policy.recreate(self.path)
+        self._types = {}
+
+    def append(self, branches):
+        with self._lock:
+            types = {tree: _types(value) for tree, value in branches.items()}
+            if self._file is not None and any(
+                self._types.get(tree, types[tree]) != types[tree] for tree in types
+            ):
+                self._close()
+            if self._file is None:
+                self._open()
+            for tree, value in branches.items():
+                if _length(value) == 0:
+                    continue
+                self.policy.write(self._file, tree, value, extend=tree in self._types)
+                self._types[tree] = types[tree]
+            if os.path.getsize(self.path) >= self.max_size:
+                self._close()
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            os.replace(self.path, self.path[: -len(".part")])
+            self._file = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+def _nbytes(value):
+    if isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+    return value.nbytes if isinstance(value, (ak.Array, np.ndarray)) else 0
+
+
+def _max_nbytes(value):
+    if isinstance(value, dict):
+        return max((_max_nbytes(v) for v in value.values()), default=0)
+    if isinstance(value, ak.Array) and len(value.fields) > 0:
+        return max(_max_nbytes(value[field]) for field in value.fields)
+    return _nbytes(value)
+
+
+def _types(value):
+    if isinstance(value, dict):
+        return {key: _types(v) for key, v in value.items()}
+    return str(ak.type(ak.Array(value)).type)
+
+
+def _length(value):
+    if isinstance(value, dict):
+        return min((_length(v) for v in value.values()), default=0)
+    return len(value)
+
+
+_pools = {}
+
+
+def writer_pool():
+    """writer pool of the current worker process"""
+    # the pool threads are not inherited by forked workers, one pool per process
+    if os.getpid() not in _pools:
+        _pools.clear()
+        _pools[os.getpid()] = WriterPool()
+    return _pools[os.getpid()]
+
+
+def reset_writers():
+    """drop the branches staged by array_writer in the current thread, before a chunk starts"""
+    if os.getpid() in _pools:
+        _pools[os.getpid()].reset()
+
+
+def flush_writers():
+    """wait for the files written by array_writer in the current thread"""
+    if os.getpid() in _pools:
+        _pools[os.getpid()].flush()
+
+
+def finalise_arrays(outdir):
+    """rename the per-dataset files left open by the workers once the job is done
+
+    Files which cannot be read back (worker killed while writing) are kept as
+    .part and reported.
+    """
+    if os.getpid() in _pools:
+        _pools[os.getpid()].close()
+    for path in glob.glob(os.path.join(outdir, "**", "*.root.part"), recursive=True):
+        try:
+            with uproot.open(path) as fin:
+                fin.keys()
+        except Exception as e:
+            print(path, "cannot be read, kept as .part:", e)
+            continue
+        os.replace(path, path[: -len(".part")])
+
+
+# plans of uproot_writeable, the processor is unpickled again for every chunk
+_plans = {}
+
+
+def _out_branch(
+    pruned_event, nano_event, isRealData, remove, kinOnly, kins, othersData, othersMC
+):
+    # Get only the variables that were added newly
+    out_branch = np.setdiff1d(
+        np.array(pruned_event.fields), np.array(nano_event.fields)
+    )
+
+    # Handle kinOnly vars
+    for v in remove:
+        out_branch = np.delete(out_branch, np.where((out_branch == v)))
+
+    for kin in kins:
+        for obj in kinOnly:
+            if "MET" in obj and ("pt" != kin or "phi" != kin):
+                continue
+            if (obj != "Muon" and obj != "SoftMuon") and (
+                "pfRelIso04_all" == kin or "d" in kin
+            ):
+                continue
+            out_branch = np.append(out_branch, [f"{obj}_{kin}"])
+
+    # Handle data vars
+    out_branch = np.append(out_branch, othersData)
+
+    if not isRealData:
+        out_branch = np.append(out_branch, othersMC)
+    return out_branch
 
 
 def array_writer(
@@ -11,6 +417,7 @@ def array_writer(
     systname,  # name of systematic shift
     dataset,  # dataset name
     isRealData,  # boolean
+    sumw,  # sum of genWeight of the whole chunk, before any event is dropped
     remove=[
         "SoftMuon",
         "MuonJet",
@@ -51,45 +458,55 @@ def array_writer(
 ):
     if empty:
         print("WARNING: No events selected. Writing blank file.")
-        out_branch = []
     else:
-        # Get only the variables that were added newly
-        out_branch = np.setdiff1d(
-            np.array(pruned_event.fields), np.array(nano_event.fields)
+        # the selected branches only depend on the options, the data type and
+        # the fields and types of the events, they are planned once per worker process
+        key = (
+            isRealData,
+            writeable_signature(pruned_event),
+            tuple(nano_event.fields),
+            tuple(remove),
+            tuple(kinOnly),
+            tuple(kins),
+            tuple(othersData),
+            tuple(othersMC),
         )
+        if key not in _plans:
+            _plans[key] = writeable_plan(
+                pruned_event,
+                include=_out_branch(
+                    pruned_event,
+                    nano_event,
+                    isRealData,
+                    remove,
+                    kinOnly,
+                    kins,
+                    othersData,
+                    othersMC,
+                ),
+            )
+        plan = _plans[key]
 
-        # Handle kinOnly vars
-        for v in remove:
-            out_branch = np.delete(out_branch, np.where((out_branch == v)))
-
-        for kin in kins:
-            for obj in kinOnly:
-                if "MET" in obj and ("pt" != kin or "phi" != kin):
-                    continue
-                if (obj != "Muon" and obj != "SoftMuon") and (
-                    "pfRelIso04_all" == kin or "d" in kin
-                ):
-                    continue
-                out_branch = np.append(out_branch, [f"{obj}_{kin}"])
-
-        # Handle data vars
-        out_branch = np.append(out_branch, othersData)
-
-        if not isRealData:
-            out_branch = np.append(out_branch, othersMC)
-
-    # Write to root files
-    # print("Branches to write:", out_branch)
+    # Write to root files, in the background writer pool
     outdir = f"{processor_class.name}/{systname}/{dataset}/"
-    os.system(f"mkdir -p {outdir}")
-
-    with uproot.recreate(
-        f"{outdir}/{nano_event.metadata['filename'].split('/')[-1].replace('.root','')}_{int(nano_event.metadata['entrystop']/processor_class.chunksize)}.root"
-    ) as fout:
-        if not empty:
-            fout["Events"] = uproot_writeable(pruned_event, include=out_branch)
-        fout["TotalEventCount"] = ak.Array(
-            [nano_event.metadata["entrystop"] - nano_event.metadata["entrystart"]]
+    branches = {}
+    if not empty:
+        branches["Events"] = uproot_writeable(pruned_event, plan=plan)
+    branches["TotalEventCount"] = ak.Array(
+        [nano_event.metadata["entrystop"] - nano_event.metadata["entrystart"]]
+    )
+    if not isRealData:
+        branches["TotalEventWeight"] = ak.Array([sumw])
+    fname = f"{nano_event.metadata['filename'].split('/')[-1].replace('.root','')}_{int(nano_event.metadata['entrystop']/processor_class.chunksize)}.root"
+    max_size = getattr(processor_class, "array_max_size", None)
+    if max_size is None:
+        writer_pool().submit(
+            f"{outdir}/{fname}", branches, writer_policy(processor_class)
+        )
+    else:
+        pool = writer_pool()
+        pool.append(
+            chunk_name(nano_event.metadata),
+            pool.appender(outdir, max_size, writer_policy(processor_class)),
+            branches,
         )
-        if not isRealData:
-            fout["TotalEventWeight"] = ak.Array([ak.sum(nano_event.genWeight)])
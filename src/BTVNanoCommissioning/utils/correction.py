@@ -684,6 +684,99 @@ def Roccor_shifts(shifts, correct_map, events, isRealData, systematic=False):
     return shifts
 
 
+def common_shifts(
+    events,
+    correct_map,
+    campaign,
+    year,
+    isRealData,
+    systematic=False,
+    exclude_jetveto=False,
+):
+    """Jet/MET/Muon collections of the nominal and shifted variations, as used by the workflows"""
+    shifts = []
+    if "JME" in correct_map.keys() or (
+        exclude_jetveto and "jetveto" in correct_map.keys()
+    ):
+        if systematic == "JERC_split":
+            systematic = "split"
+        shifts = JME_shifts(
+            shifts,
+            correct_map,
+            events,
+            campaign,
+            isRealData,
+            systematic,
+            exclude_jetveto,
+        )
+    else:
+        if int(year) < 2020:
+            shifts = [
+                ({"Jet": events.Jet, "MET": events.MET, "Muon": events.Muon}, None)
+            ]
+        else:
+            shifts = [
+                (
+                    {"Jet": events.Jet, "MET": events.PuppiMET, "Muon": events.Muon},
+                    None,
+                )
+            ]
+    if "roccor" in correct_map.keys():
+        shifts = Roccor_shifts(shifts, correct_map, events, isRealData, False)
+    else:
+        shifts[0][0]["Muon"] = events.Muon
+    return shifts
+
+
+def shift_names(correct_map, systematic=False):
+    """Names of the MC shifts of common_shifts, known from the config before any event is read"""
+    if "JME" not in correct_map.keys() or systematic == False:
+        return []
+    split = systematic in ["split", "JERC_split"]
+    if "JME_cfg" in correct_map.keys():
+        # correctionlib only provides the total JES uncertainty
+        sources = [] if split else ["JES"]
+    else:
+        uncertainties = correct_map["JME"]["jet_factory"]["mc"].uncertainties()
+        if split:
+            sources = [u for u in uncertainties if "JES" in u and "Total" not in u]
+        else:
+            sources = (
+                (["JES"] if "JES_Total" in uncertainties else [])
+                + ["UES"]
+                + (["JER"] if "JER" in uncertainties else [])
+            )
+    return [f"{source}{var}" for source in sources for var in ["Up", "Down"]]
+
+
+def weight_variations(correct_map, sfs, syst=False):
+    """Names of the weight variations added by puwei, muSFs, eleSFs and btagSFs
+
+    sfs are the SF_map keys (PU, MUO, EGM, BTV) the workflow applies.
+    """
+    if syst == False:
+        return []
+    names = []
+    if "PU" in sfs and "PU" in correct_map.keys():
+        names += ["puweight"]
+    if "MUO" in sfs and "MUO" in correct_map.keys():
+        names += [
+            sf.split(" ")[0]
+            for sf in correct_map["MUO_cfg"].keys()
+            if "HLT" not in sf and "low" not in sf
+        ]
+    if "EGM" in sfs and "EGM" in correct_map.keys():
+        names += [
+            sf.split(" ")[0]
+            for sf in correct_map["EGM_cfg"].keys()
+            if "HLT" not in sf and "low" not in sf and "high" not in sf
+        ]
+    if "BTV" in sfs and "BTV" in correct_map.keys():
+        for SFtype in ["DeepJetC", "DeepJetB", "DeepCSVB", "DeepCSVC"]:
+            names += [f"{SFtype}_{sys}" for sys in btag_systs[SFtype[-1]]]
+    return [f"{name}{var}" for name in dict.fromkeys(names) for var in ["Up", "Down"]]
+
+
 ## PU weight
 def puwei(nPU, correct_map, weights, syst=False):
     if "correctionlib" in str(type(correct_map["PU"])):
@@ -719,34 +812,38 @@ def puwei(nPU, correct_map, weights, syst=False):
             weights.add("puweight", correct_map["PU"]["PU"](nPU))
 
 
+# uncertainty sources of the c-tag (C) and b-tag (B) shape SFs
+btag_systs = {
+    "C": [
+        "Extrap",
+        "Interp",
+        "LHEScaleWeight_muF",
+        "LHEScaleWeight_muR",
+        "PSWeightFSR",
+        "PSWeightISR",
+        "PUWeight",
+        "Stat",
+        "XSec_BRUnc_DYJets_b",
+        "XSec_BRUnc_DYJets_c",
+        "XSec_BRUnc_WJets_c",
+        "jer",
+        "jesTotal",
+    ],
+    "B": [
+        "hf",
+        "lf",
+        "cferr1",
+        "cferr2",
+        "hfstat1",
+        "hfstat2",
+        "lfstats1",
+        "lfstats2",
+    ],
+}
+
+
 def btagSFs(jet, correct_map, weights, SFtype, syst=False):
-    if SFtype.endswith("C"):
-        systlist = [
-            "Extrap",
-            "Interp",
-            "LHEScaleWeight_muF",
-            "LHEScaleWeight_muR",
-            "PSWeightFSR",
-            "PSWeightISR",
-            "PUWeight",
-            "Stat",
-            "XSec_BRUnc_DYJets_b",
-            "XSec_BRUnc_DYJets_c",
-            "XSec_BRUnc_WJets_c",
-            "jer",
-            "jesTotal",
-        ]
-    elif SFtype.endswith("B"):
-        systlist = [
-            "hf",
-            "lf",
-            "cferr1",
-            "cferr2",
-            "hfstat1",
-            "hfstat2",
-            "lfstats1",
-            "lfstats2",
-        ]
+    systlist = btag_systs[SFtype[-1]]
     sfs_up_all, sfs_down_all = {}, {}
     alljet = jet if jet.ndim > 1 else ak.singletons(jet)
     for i, sys in enumerate(systlist):
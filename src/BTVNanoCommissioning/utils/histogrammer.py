@@ -1,12 +1,50 @@
 from BTVNanoCommissioning.helpers.definitions import definitions, SV_definitions
+from BTVNanoCommissioning.utils.correction import shift_names, weight_variations
 import hist as Hist
+import numpy as np
+import pickle
 
+# pickled empty histograms, per workflow and available Jet branches
+_hist_prototypes = {}
 
-def histogrammer(events, workflow):
+
+def syst_categories(correct_map, isSyst, sfs=[]):
+    """Ordered syst categories of the MC histograms, fixed by the workflow config
+
+    nominal, the variations of the ``sfs`` weights and the JME shifts, so that
+    every chunk, empty or not, books the same layout. Reference categories only
+    filled in some histograms (noSF, noPU) are left to grow, so that they only
+    appear where they are filled.
+    """
+    if isSyst == False:
+        return ["nominal"]
+    return (
+        ["nominal"]
+        + weight_variations(correct_map, sfs, isSyst)
+        + shift_names(correct_map, isSyst)
+    )
+
+
+def histogrammer(events, workflow, systematics=[]):
+    """Empty histograms of the workflow, booked once and cloned for each chunk
+
+    The syst axis is booked with the ordered ``systematics`` categories, other
+    names can still be added on fill.
+    """
+    key = (workflow, tuple(events.Jet.fields), tuple(systematics))
+    if key not in _hist_prototypes:
+        _hist_prototypes[key] = pickle.dumps(
+            _book_histograms(events.Jet.fields, workflow, systematics),
+            pickle.HIGHEST_PROTOCOL,
+        )
+    return pickle.loads(_hist_prototypes[key])
+
+
+def _book_histograms(jet_fields, workflow, systematics):
     _hist_dict = {}
     ## Common variables
     flav_axis = Hist.axis.IntCategory([0, 1, 4, 5, 6], name="flav", label="Genflavour")
-    syst_axis = Hist.axis.StrCategory([], name="syst", growth=True)
+    syst_axis = Hist.axis.StrCategory(list(systematics), name="syst", growth=True)
     pt_axis = Hist.axis.Regular(60, 0, 300, name="pt", label=" $p_{T}$ [GeV]")
     jpt_axis = Hist.axis.Regular(300, 0, 3000, name="pt", label=" $p_{T}$ [GeV]")
     softlpt_axis = Hist.axis.Regular(25, 0, 25, name="pt", label=" $p_{T}$ [GeV]")
@@ -429,7 +467,7 @@ def histogrammer(events, workflow):
     ### Btag input variables & PFCands
     bininfo = definitions()
     for d in bininfo.keys():
-        if d not in events.Jet.fields:
+        if d not in jet_fields:
             continue
         ranges = bininfo[d]["manual_ranges"]
         binning = bininfo[d]["bins"]
@@ -561,7 +599,7 @@ def histogrammer(events, workflow):
         "ProbaN",
     ]
     for disc in disc_list:
-        if disc not in events.Jet.fields and "Trans" not in disc:
+        if disc not in jet_fields and "Trans" not in disc:
             continue
         njet = 1
         if "ttdilep_sf" in workflow:
@@ -648,3 +686,45 @@ def histogrammer(events, workflow):
                         Hist.storage.Weight(),
                     )
     return _hist_dict
+
+
+def syst_weights(weights, systematics, shift_name=None):
+    """Stack the event weights of all systematics into a (n_syst, n_event) matrix"""
+    return np.stack(
+        [
+            (
+                weights.weight()
+                if syst == "nominal" or syst == shift_name
+                else weights.weight(modifier=syst)
+            )
+            for syst in systematics
+        ]
+    )
+
+
+def fill_syst(h, systematics, *args, weight, counts=None, **kwargs):
+    """Fill all the systematic variations of a histogram in a single call
+
+    The syst axis is given as the list of systematics, the remaining axes as
+    per-entry arrays (or scalars) shared by all systematics. ``weight`` is either
+    the (n_syst, n_event) matrix from ``syst_weights`` or a single weight array
+    shared by all systematics. If ``counts`` is given, the per-event weights are
+    repeated onto the ``counts`` objects of each event.
+    """
+    weight = np.asarray(weight)
+    if counts is not None:
+        weight = np.repeat(weight, np.asarray(counts), axis=-1)
+    nsyst, nentry = len(systematics), weight.shape[-1]
+    if nsyst == 1:
+        return h.fill(systematics[0], *args, weight=weight.reshape(-1), **kwargs)
+
+    def _tile(value):
+        value = np.asarray(value)
+        return value if value.ndim == 0 else np.tile(value, nsyst)
+
+    h.fill(
+        np.repeat(np.asarray(systematics), nentry),
+        *[_tile(arg) for arg in args],
+        weight=np.broadcast_to(weight, (nsyst, nentry)).reshape(-1),
+        **{key: _tile(value) for key, value in kwargs.items()},
+    )
@@ -0,0 +1,101 @@
+import glob, os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import awkward as ak
+import numpy as np
+import uproot
+
+from BTVNanoCommissioning.utils.array_writer import WriterPolicy
+
+counters = ["TotalEventCount", "TotalEventWeight"]
+
+
+def _writeable(batch):
+    """batch read with how="zip" back to the structure given to uproot: the
+    collections are records and their n{collection} counters are dropped"""
+    return {
+        field: batch[field]
+        for field in batch.fields
+        if not (field.startswith("n") and field[1:] in batch.fields)
+    }
+
+
+def merge_files(
+    inputs, output, step_size="100 MB", buffer_size=100 * 1024**2, policy=None
+):
+    """merge the array_writer files into output
+
+    Events are streamed in batches of step_size and written once buffer_size
+    bytes are buffered, so the memory does not depend on the number or size of
+    the inputs and the output baskets are not limited by the input file size.
+    The counter trees are summed into a single entry. The output is written as
+    .tmp and renamed once complete. Returns the number of merged events.
+    policy: WriterPolicy of the output, zlib:1 by default.
+    """
+    policy = policy or WriterPolicy()
+    totals, nevents, written = {}, 0, False
+    buffer = []
+    tmp = f"{output}.tmp"
+
+    def write():
+        nonlocal written
+        branches = _writeable(ak.concatenate(buffer) if len(buffer) > 1 else buffer[0])
+        policy.write(fout, "Events", branches, extend=written)
+        written = True
+        buffer.clear()
+
+    with policy.recreate(tmp) as fout:
+        for path in inputs:
+            with uproot.open(path) as fin:
+                for name in counters:
+                    if name in fin:
+                        totals[name] = totals.get(name, 0) + np.sum(
+                            fin[name].arrays(library="np")[""]
+                        )
+                if "Events" not in fin or fin["Events"].num_entries == 0:
+                    continue
+                for batch in fin["Events"].iterate(step_size=step_size, how="zip"):
+                    if len(buffer) > 0 and batch.fields != buffer[0].fields:
+                        raise ValueError(
+                            f"{path} does not have the branches of the other files of {output}"
+                        )
+                    buffer.append(batch)
+                    nevents += len(batch)
+                    if sum(b.nbytes for b in buffer) >= buffer_size:
+                        write()
+        if len(buffer) > 0:
+            write()
+        for name in counters:
+            if name in totals:
+                fout[name] = ak.Array([totals[name]])
+    os.replace(tmp, output)
+    return nevents
+
+
+def merge_jobs(indir):
+    """{output: inputs} for the {indir}/{syst}/{sample}/*.root layout of array_writer"""
+    jobs = {}
+    for syst in sorted(os.listdir(indir)):
+        if not os.path.isdir(os.path.join(indir, syst)):
+            continue
+        for samp in sorted(os.listdir(os.path.join(indir, syst))):
+            inputs = sorted(glob.glob(os.path.join(indir, syst, samp, "*.root")))
+            if len(inputs) == 0:
+                continue
+            jobs[os.path.join(indir, syst, f"{samp}.root")] = inputs
+    return jobs
+
+
+def merge_dir(indir, workers=4, step_size="100 MB", policy=None):
+    """merge every sample and systematic of indir, in parallel"""
+    jobs = merge_jobs(indir)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(merge_files, inputs, output, step_size, policy=policy): output
+            for output, inputs in jobs.items()
+        }
+        for future in as_completed(futures):
+            print(
+                f"{futures[future]}: {future.result()} events from {len(jobs[futures[future]])} files"
+            )
+    return list(jobs)
@@ -0,0 +1,178 @@
+import os, hashlib
+from types import SimpleNamespace
+
+import awkward as ak
+import numpy as np
+import uproot
+from coffea.nanoevents import NanoEventsFactory, PFNanoAODSchema
+from coffea.nanoevents.mapping import UprootSourceMapping
+from coffea.nanoevents.mapping.preloaded import SimplePreloadedColumnSource
+
+
+class _SelectedBranch:
+    """branch restricted to a sorted list of entries, only the baskets holding them are read
+
+    Stands in for the awkward array of a column of SelectedSource: from_preloaded
+    takes its form from layout.form and slices it when the column is accessed.
+    """
+
+    def __init__(self, branch, entries, form):
+        self.branch = branch
+        self.entries = entries
+        self.layout = SimpleNamespace(form=form)
+
+    def __getitem__(self, where):
+        entries = self.entries[where]
+        if len(entries) == 0:
+            return self.branch.array(entry_start=0, entry_stop=0, library="ak")
+        offsets = np.asarray(self.branch.entry_offsets)
+        baskets = np.unique(np.searchsorted(offsets, entries, side="right") - 1)
+        # merge consecutive baskets into ranges read in one go
+        starts = baskets[np.r_[True, np.diff(baskets) > 1]]
+        stops = baskets[np.r_[np.diff(baskets) > 1, True]] + 1
+        arrays = []
+        for start, stop in zip(offsets[starts], offsets[stops]):
+            inrange = entries[(entries >= start) & (entries < stop)]
+            array = self.branch.array(entry_start=start, entry_stop=stop, library="ak")
+            arrays.append(array[inrange - start])
+        # NanoEvents takes the content of the jagged branches as is, it has to be packed
+        return ak.packed(arrays[0] if len(arrays) == 1 else ak.concatenate(arrays))
+
+
+class SelectedSource(SimplePreloadedColumnSource):
+    """column source of a tree restricted to the selected entries, for NanoEventsFactory.from_preloaded
+
+    The uuid is a digest of the file uuid and the entries, identical in every
+    worker and rerun, so that the NanoEvents cache keys are stable.
+    """
+
+    def __init__(self, tree, entries, uuid=""):
+        columns = {}
+        for key, branch in tree.iteritems():
+            if "," in key or "!" in key or len(branch) or key in columns:
+                continue
+            try:
+                form = branch.interpretation.awkward_form(None)
+            except (
+                uproot.interpretation.objects.CannotBeAwkward,
+                NotImplementedError,
+                AttributeError,
+            ):
+                continue
+            columns[key] = _SelectedBranch(
+                branch, entries, uproot._util.awkward_form_remove_uproot(ak, form)
+            )
+        digest = hashlib.sha1(np.asarray(entries, dtype=np.int64).tobytes())
+        super().__init__(
+            columns,
+            f"{uuid}-{digest.hexdigest()}",
+            len(entries),
+            tree.object_path,
+        )
+        self.uuid = self.metadata["uuid"]
+
+
+def _factory_tree(events, treename):
+    """tree the NanoEvents factory of events reads from, None if it is not an uproot tree
+
+    The executor opens the file with its own options (timeout, file handler)
+    and keeps it open while the chunk is processed, its tree is reused instead
+    of opening the file again.
+    """
+    factory = events.behavior.get("__events_factory__")
+    mapping = getattr(factory, "_mapping", None)
+    if not isinstance(mapping, UprootSourceMapping):
+        return None
+    for source in mapping._cache.values():
+        if isinstance(source, uproot.behaviors.TTree.TTree) and source.name == treename:
+            return source
+    return None
+
+
+def read_selected(events, mask, max_fraction=0.5, schemaclass=PFNanoAODSchema):
+    """events passing mask, reading the remaining branches only where they are needed
+
+    The mask should only depend on light branches (run, lumi, trigger and flag
+    bits, lepton IDs), which NanoEvents already read lazily. If the selection
+    is tight enough, the events are rebuilt from the tree of the chunk with
+    every other branch read only for the baskets holding selected entries
+    instead of the whole chunk. Otherwise, or if the events are not read from
+    a ROOT file by NanoEventsFactory, this is simply events[mask].
+    """
+    mask = np.asarray(mask, dtype=bool)
+    metadata = dict(events.metadata)
+    if not 0 < mask.sum() <= max_fraction * len(mask) or "entrystart" not in metadata:
+        return events[mask]
+    tree = _factory_tree(events, metadata.get("treename", "Events"))
+    if tree is None:
+        return events[mask]
+    entries = metadata["entrystart"] + np.flatnonzero(mask)
+    source = SelectedSource(tree, entries, metadata.get("fileuuid", ""))
+    return NanoEventsFactory.from_preloaded(
+        source,
+        runtime_cache={},
+        schemaclass=schemaclass,
+        metadata=metadata,
+    ).events()
+
+
+def chunk_name(metadata):
+    """dataset/file/entry range of a chunk, used to name the files stored per chunk"""
+    name = (
+        metadata.get("fileuuid")
+        or hashlib.sha1(metadata["filename"].encode()).hexdigest()
+    )
+    return os.path.join(
+        metadata["dataset"],
+        f"{name}_{metadata['entrystart']}_{metadata['entrystop']}",
+    )
+
+
+class SelectionIndex:
+    """entries of the events passing the prefilter, one delta-encoded sidecar file per (file, chunk)
+
+    The files only depend on the input file, the chunk and the prefilter, so a
+    rerun with other histograms, weights or SFs reads back the list instead of
+    evaluating the prefilter and only reads the selected entries.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _filename(self, metadata):
+        return os.path.join(self.path, f"{chunk_name(metadata)}.npz")
+
+    def load(self, metadata):
+        try:
+            with np.load(self._filename(metadata)) as index:
+                deltas = index["deltas"]
+        except (OSError, KeyError):
+            return None
+        return metadata["entrystart"] + np.cumsum(deltas, dtype=np.int64)
+
+    def save(self, metadata, entries):
+        deltas = np.diff(entries - metadata["entrystart"], prepend=0)
+        for dtype in (np.uint8, np.uint16, np.uint32, np.int64):
+            if len(deltas) == 0 or deltas.max() <= np.iinfo(dtype).max:
+                break
+        filename = self._filename(metadata)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # several workers can write the same directory, only publish complete files
+        with open(f"{filename}.{os.getpid()}.tmp", "wb") as f:
+            np.savez_compressed(f, deltas=deltas.astype(dtype))
+        os.replace(f"{filename}.{os.getpid()}.tmp", filename)
+
+
+def prefiltered(events, prefilter, index=None):
+    """events passing prefilter, see read_selected, using the selection index if given"""
+    entries = None if index is None else index.load(events.metadata)
+    if entries is None:
+        mask = np.asarray(prefilter(events), dtype=bool)
+        if index is not None:
+            index.save(
+                events.metadata, events.metadata["entrystart"] + np.flatnonzero(mask)
+            )
+    else:
+        mask = np.zeros(len(events), dtype=bool)
+        mask[entries - events.metadata["entrystart"]] = True
+    return read_selected(events, mask)
@@ -1,71 +1,228 @@
 import awkward as ak
+import numpy as np
+import numba as nb
+from BTVNanoCommissioning.utils.trigger import flag_mask, trigger_mask
+
+
+@nb.njit
+def _dr_kernel(a_eta, a_phi, a_counts, b_eta, b_phi, b_counts):
+    # min/max deltaR of each a to the (non-NaN) b of the same event, and the nearest b
+    mindr = np.full(len(a_eta), np.inf)
+    maxdr = np.full(len(a_eta), -np.inf)
+    nearest = np.full(len(a_eta), -1, np.int64)
+    i0, j0 = 0, 0
+    for ev in range(len(a_counts)):
+        for i in range(i0, i0 + a_counts[ev]):
+            for j in range(j0, j0 + b_counts[ev]):
+                if np.isnan(b_eta[j]):
+                    continue
+                deta = a_eta[i] - b_eta[j]
+                dphi = (a_phi[i] - b_phi[j] + np.pi) % (2 * np.pi) - np.pi
+                dr = np.sqrt(deta * deta + dphi * dphi)
+                if dr < mindr[i]:
+                    mindr[i] = dr
+                    nearest[i] = j - j0
+                if dr > maxdr[i]:
+                    maxdr[i] = dr
+        i0 += a_counts[ev]
+        j0 += b_counts[ev]
+    return mindr, nearest, maxdr
+
+
+def _dr_table(a, b):
+    a_eta = ak.to_numpy(ak.flatten(ak.fill_none(a.eta, np.nan)))
+    a_phi = ak.to_numpy(ak.flatten(ak.fill_none(a.phi, np.nan)))
+    b_eta = ak.to_numpy(ak.flatten(ak.fill_none(b.eta, np.nan)))
+    b_phi = ak.to_numpy(ak.flatten(ak.fill_none(b.phi, np.nan)))
+    a_counts = ak.to_numpy(ak.fill_none(ak.num(a), 0))
+    b_counts = ak.to_numpy(ak.fill_none(ak.num(b), 0))
+    return [
+        ak.unflatten(column, a_counts)
+        for column in _dr_kernel(a_eta, a_phi, a_counts, b_eta, b_phi, b_counts)
+    ]
+
+
+def min_dr(a, b):
+    """deltaR of each object of a to the closest object of b, and the index of that object in b
+
+    Events without any b give inf and -1.
+    """
+    mindr, nearest, _ = _dr_table(a, b)
+    return mindr, nearest
+
+
+def max_dr(a, b):
+    """deltaR of each object of a to the farthest object of b, -inf if no b"""
+    return _dr_table(a, b)[2]
+
+
+def dr_clean(a, b, cut=0.4, mask_identity=False):
+    """objects of a farther than cut from every object of b
+
+    Same as ak.all(a.metric_table(b) > cut, axis=2); with mask_identity,
+    objects in events without any b are rejected instead of kept.
+    """
+    mindr, _ = min_dr(a, b)
+    if mask_identity:
+        return (mindr > cut) & (mindr < np.inf)
+    return mindr > cut
+
+
+def dr_matched(a, b, cut=0.4, mask_identity=False):
+    """objects of a within cut of every object of b, see dr_clean"""
+    maxdr = max_dr(a, b)
+    if mask_identity:
+        return (maxdr <= cut) & (maxdr > -np.inf)
+    return maxdr <= cut
+
+
+## Object IDs: the clauses on the branches of a collection, all of them are required and a
+## clause given as a tuple of cuts passes if any of its cuts does. A cut is (branch, op,
+## threshold), the branch can be abs(x) or x/y and a threshold given as a string is a keyword
+## parameter of the ID. Evaluated by a compiled kernel over the flat content of the collection
+id_cuts = {
+    "jet_id": ("Jet", [("pt", ">", 20), ("abs(eta)", "<=", 2.5), ("jetId", ">=", 5)]),
+    "jet_id_puid": (
+        "Jet",
+        [
+            ("pt", ">", 20),
+            ("abs(eta)", "<=", 2.5),
+            ("jetId", ">=", 5),
+            (("pt", ">", 50), ("puId", ">=", 7)),
+        ],
+    ),
+    # ECAL barrel and endcap, without the transition region
+    "ele_cuttightid": (
+        "Electron",
+        [
+            ("abs(eta)", "<", 2.5),
+            (("abs(eta)", "<", 1.4442), ("abs(eta)", ">", 1.566)),
+            ("cutBased", ">", 3),
+        ],
+    ),
+    "ele_mvatightid": (
+        "Electron",
+        [
+            ("abs(eta)", "<", 2.5),
+            (("abs(eta)", "<", 1.4442), ("abs(eta)", ">", 1.566)),
+            ("mvaIso_WP80", ">", 0.5),
+        ],
+    ),
+    "softmu_mask": (
+        "Muon",
+        [
+            ("pt", "<", 25),
+            ("abs(eta)", "<", 2.4),
+            ("tightId", ">", 0.5),
+            ("pfRelIso04_all", ">", 0.2),
+            ("abs(dxy/dxyErr)", ">", "dxySigCut"),
+            ("jetIdx", "!=", -1),
+        ],
+    ),
+    "mu_idiso": (
+        "Muon",
+        [("abs(eta)", "<", 2.4), ("tightId", ">", 0.5), ("pfRelIso04_all", "<=", 0.15)],
+    ),
+    "btag_mu_idiso": (
+        "Muon",
+        [("abs(eta)", "<", 2.4), ("tightId", ">", 0.5), ("pfRelIso04_all", "<", 0.12)],
+    ),
+}
+_ops = {"<": 0, "<=": 1, ">": 2, ">=": 3, "!=": 4}
+
+
+@nb.njit
+def _cut_kernel(columns, column, op, threshold, clause):
+    # one cut at a time over all the objects, the cuts of a clause are consecutive
+    out = np.ones(columns.shape[1], dtype=np.bool_)
+    passed = np.zeros(columns.shape[1], dtype=np.bool_)
+    for k in range(len(op)):
+        x, cut = columns[column[k]], threshold[k]
+        if op[k] == 0:
+            for i in range(len(x)):
+                passed[i] |= x[i] < cut
+        elif op[k] == 1:
+            for i in range(len(x)):
+                passed[i] |= x[i] <= cut
+        elif op[k] == 2:
+            for i in range(len(x)):
+                passed[i] |= x[i] > cut
+        elif op[k] == 3:
+            for i in range(len(x)):
+                passed[i] |= x[i] >= cut
+        else:
+            for i in range(len(x)):
+                passed[i] |= x[i] != cut
+        if k == len(op) - 1 or clause[k + 1] != clause[k]:
+            for i in range(len(x)):
+                out[i] &= passed[i]
+                passed[i] = False
+    return out
+
+
+def _branch(flat, name):
+    if name.startswith("abs("):
+        return np.abs(_branch(flat, name[4:-1]))
+    if "/" in name:
+        num, den = name.split("/")
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return _branch(flat, num) / _branch(flat, den)
+    return ak.to_numpy(flat[name])
+
+
+def object_mask(events, cut, **params):
+    """mask of the objects passing one of the id_cuts, with the jagged structure of the collection"""
+    collection, clauses = id_cuts[cut]
+    flat = ak.flatten(events[collection])
+    columns, column, op, threshold, clause = {}, [], [], [], []
+    for n, cuts in enumerate(clauses):
+        for name, cmp, value in cuts if isinstance(cuts[0], tuple) else [cuts]:
+            if name not in columns:
+                columns[name] = _branch(flat, name)
+            value = params[value] if isinstance(value, str) else value
+            # float32 branches are compared to a float32 threshold, as numpy does for a python float
+            if columns[name].dtype == np.float32:
+                value = np.float32(value)
+            threshold.append(value)
+            column.append(list(columns).index(name))
+            op.append(_ops[cmp])
+            clause.append(n)
+    out = _cut_kernel(
+        np.array(list(columns.values()), dtype=np.float64).reshape(len(columns), -1),
+        np.array(column, dtype=np.int64),
+        np.array(op, dtype=np.int64),
+        np.array(threshold, dtype=np.float64),
+        np.array(clause, dtype=np.int64),
+    )
+    return ak.unflatten(out, ak.num(events[collection]))
 
 
 ## Jet pu ID not exist in Winter22Run3 sample
 def jet_id(events, campaign):
     if campaign == "Rereco17_94X":
-        jetmask = (
-            (events.Jet.pt > 20)
-            & (abs(events.Jet.eta) <= 2.5)
-            & (events.Jet.jetId >= 5)
-            & ((events.Jet.pt > 50) | (events.Jet.puId >= 7))
-        )
-    else:
-        jetmask = (
-            (events.Jet.pt > 20)
-            & (abs(events.Jet.eta) <= 2.5)
-            & (events.Jet.jetId >= 5)
-        )
-    return jetmask
+        return object_mask(events, "jet_id_puid")
+    return object_mask(events, "jet_id")
 
 
 ## FIXME: Electron cutbased Id & MVA ID not exist in Winter22Run3 sample
 def ele_cuttightid(events, campaign):
-    elemask = (
-        (abs(events.Electron.eta) < 1.4442)
-        | ((abs(events.Electron.eta) < 2.5) & (abs(events.Electron.eta) > 1.566))
-    ) & (events.Electron.cutBased > 3)
-    return elemask
+    return object_mask(events, "ele_cuttightid")
 
 
 def ele_mvatightid(events, campaign):
-    elemask = (
-        (abs(events.Electron.eta) < 1.4442)
-        | ((abs(events.Electron.eta) < 2.5) & (abs(events.Electron.eta) > 1.566))
-    ) & (events.Electron.mvaIso_WP80 > 0.5)
-
-    return elemask
+    return object_mask(events, "ele_mvatightid")
 
 
 def softmu_mask(events, campaign, dxySigCut=0):
-    softmumask = (
-        (events.Muon.pt < 25)
-        & (abs(events.Muon.eta) < 2.4)
-        & (events.Muon.tightId > 0.5)
-        & (events.Muon.pfRelIso04_all > 0.2)
-        & (abs(events.Muon.dxy / events.Muon.dxyErr) > dxySigCut)
-        & (events.Muon.jetIdx != -1)
-    )
-
-    return softmumask
+    return object_mask(events, "softmu_mask", dxySigCut=dxySigCut)
 
 
 def mu_idiso(events, campaign):
-    mumask = (
-        (abs(events.Muon.eta) < 2.4)
-        & (events.Muon.tightId > 0.5)
-        & (events.Muon.pfRelIso04_all <= 0.15)
-    )
-    return mumask
+    return object_mask(events, "mu_idiso")
 
 
 def btag_mu_idiso(events, campaign):
-    mumask = (
-        (abs(events.Muon.eta) < 2.4)
-        & (events.Muon.tightId > 0.5)
-        & (events.Muon.pfRelIso04_all < 0.12)
-    )
-    return mumask
+    return object_mask(events, "btag_mu_idiso")
 
 
 def jet_cut(events, campaign):
@@ -75,12 +232,14 @@ def jet_cut(events, campaign):
     return multijetmask
 
 
+def met_flags(events, campaign):
+    return flag_mask(events, met_filters[campaign]["data" if "Run" else "mc"])
+
+
 def MET_filters(events, campaign):
     # apply MET filter
-    metfilter = ak.ones_like(events.run, dtype=bool)
+    metfilter = met_flags(events, campaign)
     print(metfilter)
-    for flag in met_filters[campaign]["data" if "Run" else "mc"]:
-        metfilter = events.Flag[flag] & metfilter
     ## Flag_ecalBadCalibFilter
     badjet = (
         (events.Jet.pt > 50)
@@ -102,6 +261,28 @@ def MET_filters(events, campaign):
     return metfilter
 
 
+def prefilter_mask(
+    events, campaign, lumiMask=None, triggers=[], metfilter=False, nobjects=[]
+):
+    """event mask of the shift-independent requirements of a selection
+
+    Meant to drop events before the JME/Rochester corrections: only cuts that do
+    not depend on the corrected jets, MET and muon momenta can be used, i.e.
+    lumimask, OR of the triggers (missing paths are ignored), MET filter flags and
+    lower bounds on the number of objects passing an ID, given as (mask, n).
+    """
+    req = np.ones(len(events), dtype=bool)
+    if lumiMask is not None:
+        req &= lumiMask(events.run, events.luminosityBlock)
+    if len(triggers) > 0:
+        req &= trigger_mask(events, triggers, required=False)
+    if metfilter:
+        req &= ak.to_numpy(met_flags(events, campaign))
+    for mask, n in nobjects:
+        req &= ak.to_numpy(ak.sum(mask, axis=-1) >= n)
+    return req
+
+
 def btag_wp(jets, campaign, tagger, borc, wp):
     WP = btag_wp_dict[campaign]
     if borc == "b":
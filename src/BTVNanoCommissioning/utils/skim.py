@@ -0,0 +1,208 @@
+import glob, json, os
+
+import awkward as ak
+import numpy as np
+from coffea import processor
+from coffea.nanoevents.methods import nanoaod
+from coffea.util import load, save
+
+from BTVNanoCommissioning.utils.reader import chunk_name
+
+_option_forms = (
+    ak.forms.IndexedOptionForm,
+    ak.forms.IndexedForm,
+    ak.forms.ByteMaskedForm,
+    ak.forms.BitMaskedForm,
+    ak.forms.UnmaskedForm,
+)
+_option_layouts = (
+    ak.layout.IndexedOptionArray32,
+    ak.layout.IndexedOptionArray64,
+    ak.layout.IndexedArray32,
+    ak.layout.IndexedArrayU32,
+    ak.layout.IndexedArray64,
+    ak.layout.ByteMaskedArray,
+    ak.layout.BitMaskedArray,
+    ak.layout.UnmaskedArray,
+)
+
+
+def _restore_parameters(layout, form):
+    """set the parameters of form (behavior names of the records) on layout, in place
+
+    Parquet only keeps the structure and the types, the option and indexed
+    nodes are skipped on both sides since Arrow does not keep them as they are.
+    """
+    while isinstance(form, _option_forms):
+        form = form.content
+    while isinstance(layout, _option_layouts):
+        layout = layout.content
+    for key, value in form.parameters.items():
+        layout.setparameter(key, value)
+    if isinstance(form, ak.forms.RecordForm):
+        for key in layout.keys():
+            _restore_parameters(layout.field(key), form.contents[key])
+    elif hasattr(form, "content"):
+        _restore_parameters(layout.content, form.content)
+
+
+class _ZeroBuffers(dict):
+    """buffers of a length-zero array for ak.from_buffers, a zero offset for the lists"""
+
+    def __missing__(self, key):
+        return np.zeros(8, np.uint8)
+
+
+class SkimStore:
+    """local store of the selected objects of a workflow, one file per chunk and shift
+
+    process_shift of the workflows writes the objects its histograms are filled
+    from, after the corrections of the shift, with the jet flavour and the event
+    weights of the systematics, to <dataset>/<shift>/<chunk>.parquet. The sum of
+    weights and the lumi blocks of each chunk, computed before any event is
+    dropped, are stored in <dataset>/<chunk>.coffea. run() fills the histograms
+    again from the store with fill_histograms of the workflow, without reading
+    the NanoAOD: a change of the histograms does not need the events to be
+    processed again, a change of the corrections or the selection does.
+
+    The Parquet files have one row per event, a column per field of the
+    objects and the weights of the systematics in "weight", and can be read
+    column by column with ak.from_parquet(name, columns=[...]) or any Arrow
+    reader. The systematics and the form of the objects, with the behavior
+    names Parquet does not keep, are stored as JSON in the "btv_skim" key of
+    the schema metadata. With format="coffea" the objects are pickled to
+    <chunk>.coffea instead: no pyarrow is needed, but the files can only be
+    read whole, with coffea. run() reads both formats.
+    """
+
+    formats = ("parquet", "coffea")
+
+    def __init__(self, path, format="parquet"):
+        if format not in self.formats:
+            raise ValueError(f"skim format {format} is not one of {self.formats}")
+        self.path = path
+        self.format = format
+
+    def _publish(self, name, write):
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        # several workers can write the same directory, only publish complete files
+        write(f"{name}.{os.getpid()}.tmp")
+        os.replace(f"{name}.{os.getpid()}.tmp", name)
+
+    def _save(self, content, name):
+        self._publish(name, lambda tmp: save(content, tmp))
+
+    def write_summary(self, metadata, summary):
+        """sum of weights and lumi blocks of the whole chunk"""
+        self._save(summary, os.path.join(self.path, f"{chunk_name(metadata)}.coffea"))
+
+    def write(self, metadata, shift_name, objects, weight, systematics, isRealData):
+        """selected objects of a shift, one entry per event, and the (n_syst, n_event) weights of systematics"""
+        dataset, chunk = os.path.split(chunk_name(metadata))
+        name = os.path.join(
+            self.path, dataset, shift_name or "nominal", f"{chunk}.{self.format}"
+        )
+        # without the NanoEvents behavior, it refers to the factory of the chunk
+        objects = ak.Array(objects.layout)
+        if self.format == "coffea":
+            self._save(
+                {
+                    "objects": objects,
+                    "weight": weight,
+                    "systematics": systematics,
+                    "isRealData": isRealData,
+                },
+                name,
+            )
+            return
+        import pyarrow.parquet
+
+        objects = ak.packed(objects)
+        if "weight" in objects.fields:
+            raise ValueError("weight is the column of the weights of the systematics")
+        table = ak.to_arrow_table(
+            ak.zip(
+                {
+                    **dict(zip(objects.fields, ak.unzip(objects))),
+                    "weight": np.ascontiguousarray(weight.T),
+                },
+                depth_limit=1,
+            )
+        )
+        # what ak.to_parquet writes, with the form and the systematics in the schema metadata
+        skim = {
+            "form": json.loads(objects.layout.form.tojson()),
+            "systematics": list(systematics),
+            "isRealData": bool(isRealData),
+        }
+        self._publish(
+            name,
+            lambda tmp: pyarrow.parquet.write_table(
+                table.replace_schema_metadata({"btv_skim": json.dumps(skim)}), tmp
+            ),
+        )
+
+    @staticmethod
+    def read(name):
+        """content of a skim file, as given to write"""
+        if name.endswith(".coffea"):
+            return load(name)
+        import pyarrow.parquet
+
+        metadata = pyarrow.parquet.read_metadata(name)
+        skim = json.loads(metadata.metadata[b"btv_skim"])
+        form = ak.forms.Form.fromjson(json.dumps(skim["form"]))
+        if metadata.num_rows == 0:
+            # awkward 1 cannot read a Parquet file without rows, the objects are built from their form
+            objects = ak.from_buffers(form, 0, _ZeroBuffers(), lazy=False)
+            weight = np.zeros((len(skim["systematics"]), 0))
+        else:
+            table = ak.from_parquet(name)
+            layout = table[
+                [field for field in table.fields if field != "weight"]
+            ].layout
+            _restore_parameters(layout, form)
+            objects = ak.Array(layout)
+            weight = np.ascontiguousarray(
+                ak.to_numpy(table.weight).reshape(len(table), -1).T
+            )
+        return {
+            "objects": objects,
+            "weight": weight,
+            "systematics": skim["systematics"],
+            "isRealData": skim["isRealData"],
+        }
+
+    def datasets(self):
+        return sorted(
+            os.path.basename(os.path.dirname(path))
+            for path in glob.glob(os.path.join(self.path, "*", ""))
+        )
+
+    def run(self, processor_instance, datasets=None):
+        """{dataset: output} of the workflow processor_instance, filled from the store"""
+        output = {}
+        for dataset in self.datasets():
+            if datasets is not None and dataset not in datasets:
+                continue
+            path = os.path.join(self.path, dataset)
+            output[dataset] = processor.accumulate(
+                (load(name) for name in glob.glob(os.path.join(path, "*.coffea"))), {}
+            )
+            for name in sorted(
+                glob.glob(os.path.join(path, "*", "*.parquet"))
+                + glob.glob(os.path.join(path, "*", "*.coffea"))
+            ):
+                skim = self.read(name)
+                output[dataset] = processor.accumulate(
+                    [
+                        processor_instance.fill_histograms(
+                            ak.Array(skim["objects"], behavior=nanoaod.behavior),
+                            skim["weight"],
+                            skim["systematics"],
+                            skim["isRealData"],
+                        )
+                    ],
+                    output[dataset],
+                )
+        return output
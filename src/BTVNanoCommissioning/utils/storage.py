@@ -0,0 +1,245 @@
+import glob, hashlib, json, os, shutil, subprocess, threading, time, zlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+def adler32(path, block=1024**2):
+    """adler32 checksum of a local file, as computed by EOS and xrootd"""
+    value = 1
+    with open(path, "rb") as fin:
+        while data := fin.read(block):
+            value = zlib.adler32(data, value)
+    return value
+
+
+class LocalStorage:
+    """output destination on the local filesystem (or a mounted EOS path)"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def url(self, path):
+        return os.path.join(self.path, path)
+
+    def exists(self, path):
+        return os.path.exists(self.url(path))
+
+    def put(self, local, path):
+        # copied next to the target and renamed, a failed copy leaves no partial output
+        target = self.url(path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copy2(local, f"{target}.part")
+        os.replace(f"{target}.part", target)
+
+    def checksum(self, path):
+        return adler32(self.url(path))
+
+    def listing(self):
+        """relative paths of all the files of the destination"""
+        files = set()
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                files.add(os.path.relpath(os.path.join(dirpath, filename), self.path))
+        return files
+
+
+class XRootDStorage:
+    """output destination on an xrootd server, root://host//path"""
+
+    def __init__(self, url):
+        self.host, _, path = url[len("root://") :].partition("/")
+        self.path = "/" + path.lstrip("/")
+
+    def url(self, path):
+        return f"root://{self.host}/{os.path.join(self.path, path)}"
+
+    def exists(self, path):
+        return (
+            subprocess.run(
+                ["xrdfs", self.host, "stat", os.path.join(self.path, path)],
+                capture_output=True,
+            ).returncode
+            == 0
+        )
+
+    def put(self, local, path):
+        subprocess.run(
+            ["xrdcp", "-f", "-p", "--silent", local, self.url(path)],
+            check=True,
+            capture_output=True,
+        )
+
+    def checksum(self, path):
+        # "adler32 <hex>"
+        out = subprocess.run(
+            [
+                "xrdfs",
+                self.host,
+                "query",
+                "checksum",
+                os.path.join(self.path, path),
+            ],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        return int(out.stdout.split()[1], 16)
+
+    def listing(self):
+        """relative paths of all the entries of the destination, listed in a single call"""
+        out = subprocess.run(
+            ["xrdfs", self.host, "ls", "-R", self.path],
+            capture_output=True,
+            text=True,
+        )
+        if out.returncode != 0:
+            print(f"Cannot list {self.url('')}, nothing is produced yet:", out.stderr)
+            return set()
+        return {
+            os.path.relpath(line.strip(), self.path)
+            for line in out.stdout.split("\n")
+            if line.strip().startswith(self.path)
+        }
+
+
+def storage(url):
+    """storage backend of an output destination, xrootd url or local directory"""
+    if url.startswith("root://"):
+        return XRootDStorage(url)
+    return LocalStorage(url)
+
+
+class OutputIndex:
+    """outputs already at a destination
+
+    build() lists the destination once, at job start, the index is then
+    shipped to the workers with the processor and every chunk checks its
+    output in the set. Without build(), each check asks the destination.
+    """
+
+    def __init__(self, destination):
+        self.destination = destination
+        self.files = None
+
+    def build(self):
+        self.files = frozenset(self.destination.listing())
+        return self
+
+    def __contains__(self, path):
+        if self.files is None:
+            return self.destination.exists(path)
+        return path in self.files
+
+    def __len__(self):
+        return 0 if self.files is None else len(self.files)
+
+
+class UploadQueue:
+    """background transfer of the finished output files to their destination
+
+    submit() journals the upload and returns, the copy happens in a pool of
+    worker threads so the next chunk is processed meanwhile. A copy is
+    retried with exponential backoff until the checksum at the destination
+    matches the local file, then the local file and the journal entry are
+    removed. submit() blocks while max_pending uploads are queued, so a slow
+    storage cannot fill the local disk.
+
+    The journal holds one json file per pending upload, entries left by a
+    failed upload or a killed worker are retried by retry_uploads().
+    """
+
+    def __init__(
+        self, journal=".uploads", workers=4, retries=3, backoff=10.0, max_pending=16
+    ):
+        self.journal = os.path.abspath(journal)
+        self.retries = retries
+        self.backoff = backoff
+        os.makedirs(self.journal, exist_ok=True)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="upload"
+        )
+
+    def _entry(self, url, path):
+        key = hashlib.sha1(f"{url}{path}".encode()).hexdigest()[:16]
+        return os.path.join(self.journal, f"{key}.json")
+
+    def _upload(self, local, destination, path, entry):
+        try:
+            checksum = adler32(local)
+            for attempt in range(self.retries + 1):
+                try:
+                    destination.put(local, path)
+                    remote = destination.checksum(path)
+                    if remote != checksum:
+                        raise IOError(
+                            f"checksum mismatch {remote:08x} != {checksum:08x}"
+                        )
+                    break
+                except Exception as e:
+                    if attempt == self.retries:
+                        print(
+                            f"Upload of {local} to {destination.url(path)} failed, kept in {entry}:",
+                            e,
+                        )
+                        raise
+                    time.sleep(self.backoff * 2**attempt)
+            os.remove(local)
+            os.remove(entry)
+        finally:
+            self._slots.release()
+
+    def submit(self, local, destination, path):
+        """upload local to path of the destination storage, then remove it"""
+        local = os.path.abspath(local)
+        entry = self._entry(destination.url(""), path)
+        with open(f"{entry}.tmp", "w") as fout:
+            json.dump(
+                {"local": local, "destination": destination.url(""), "path": path},
+                fout,
+            )
+        os.replace(f"{entry}.tmp", entry)
+        self._slots.acquire()
+        return self._executor.submit(self._upload, local, destination, path, entry)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+_queues = {}
+
+
+def upload_queue(journal=".uploads"):
+    """upload queue of the current worker process"""
+    # the pool threads are not inherited by forked workers, one queue per process
+    if os.getpid() not in _queues:
+        _queues.clear()
+        _queues[os.getpid()] = UploadQueue(journal)
+    return _queues[os.getpid()]
+
+
+def retry_uploads(journal=".uploads", retries=3, backoff=10.0):
+    """wait for the uploads of this process, then retry the entries left in
+    the journal. Returns the entries that could still not be uploaded."""
+    if os.getpid() in _queues:
+        _queues.pop(os.getpid()).close()
+    if not os.path.isdir(journal):
+        return []
+    entries = []
+    for path in sorted(glob.glob(os.path.join(journal, "*.json"))):
+        with open(path) as fin:
+            entries.append(json.load(fin))
+    if len(entries) == 0:
+        return []
+    print(f"Retrying {len(entries)} pending uploads from {journal}")
+    queue = UploadQueue(journal, retries=retries, backoff=backoff)
+    futures = {}
+    for entry in entries:
+        if not os.path.exists(entry["local"]):
+            print(f"{entry['local']} is gone, its chunk has to be reprocessed")
+            os.remove(queue._entry(entry["destination"], entry["path"]))
+            continue
+        futures[entry["local"]] = queue.submit(
+            entry["local"], storage(entry["destination"]), entry["path"]
+        )
+    queue.close()
+    return [local for local, future in futures.items() if future.exception()]
@@ -0,0 +1,86 @@
+import collections
+import awkward as ak
+import numpy as np
+
+# branches of the HLT/Flag groups existing in the last files, keyed on the file
+_available = collections.OrderedDict()
+
+
+def available_paths(events, paths, group="HLT", required=True):
+    """paths of the group existing in the file of the events, resolved once per file
+
+    Missing paths are reported once per file, if none exists an error is
+    raised unless required is False.
+    """
+    metadata = getattr(events, "metadata", None) or {}
+    key = (
+        metadata.get("fileuuid") or metadata.get("filename"),
+        group,
+        tuple(paths),
+    )
+    if key[0] is None or key not in _available:
+        fields = set(events[group].fields) if group in events.fields else set()
+        available = [path for path in paths if path in fields]
+        if len(available) < len(paths):
+            missing = [path for path in paths if path not in fields]
+            print(np.array(missing), " not exist in", metadata.get("dataset"))
+        if key[0] is not None:
+            _available[key] = available
+            if len(_available) > 64:
+                _available.popitem(last=False)
+    else:
+        _available.move_to_end(key)
+        available = _available[key]
+    # only the existing paths are cached, each call checks if it needs one
+    if required and len(paths) > 0 and len(available) == 0:
+        raise ValueError(
+            f"{group} paths:", paths, " are all invalid in", metadata.get("dataset")
+        )
+    return available
+
+
+def path_matrix(events, paths, group="HLT", required=True):
+    """(events, paths) decisions in one array, False for the missing paths"""
+    available = set(available_paths(events, paths, group, required))
+    matrix = np.zeros((len(events), len(paths)), dtype=bool)
+    for i, path in enumerate(paths):
+        if path in available:
+            matrix[:, i] = ak.to_numpy(events[group][path])
+    return matrix
+
+
+def trigger_mask(events, triggers, required=True):
+    """OR of the triggers, missing paths are ignored"""
+    return path_matrix(events, triggers, "HLT", required).any(axis=1)
+
+
+def flag_mask(events, flags):
+    """AND of the event filter flags, which all have to exist"""
+    if len(flags) == 0:
+        return np.ones(len(events), dtype=bool)
+    available = available_paths(events, flags, "Flag")
+    if len(available) != len(flags):
+        raise ValueError(
+            "Flag paths:",
+            sorted(set(flags) - set(available)),
+            " are missing in",
+            events.metadata.get("dataset"),
+        )
+    return path_matrix(events, flags, "Flag").all(axis=1)
+
+
+def trigger_bits(events, triggers, required=True):
+    """decisions of the triggers packed in words of 32 bits, trigger i is bit i % 32 of word i // 32
+
+    Every event gets len(triggers) // 32 + 1 words.
+    """
+    matrix = path_matrix(events, triggers, "HLT", required)
+    nwords = len(triggers) // 32 + 1
+    matrix = np.pad(matrix, ((0, 0), (0, 32 * nwords - len(triggers))))
+    words = np.packbits(matrix, axis=1, bitorder="little").view("<u4")
+    return ak.Array(
+        ak.layout.ListOffsetArray64(
+            ak.layout.Index64(np.arange(0, len(events) * nwords + 1, nwords)),
+            ak.layout.NumpyArray(words.astype(np.int64).ravel()),
+        )
+    )
@@ -7,13 +7,19 @@ from coffea.nanoevents.methods import vector
 from BTVNanoCommissioning.helpers.update_branch import missing_branch
 from BTVNanoCommissioning.helpers.BTA_helper import (
     BTA_HLT,
-    to_bitwise_trigger,
+    BTA_destination,
+    BTA_dtypes,
+    JP_track_categories,
+    associate_tracks,
     get_hadron_mass,
     cumsum,
-    is_from_GSP,
+    GenPartIndex,
     calc_ip_vector,
 )
 from BTVNanoCommissioning.helpers.func import update
+from BTVNanoCommissioning.utils.array_writer import writer_policy
+from BTVNanoCommissioning.utils.storage import storage, OutputIndex, upload_queue
+from BTVNanoCommissioning.utils.trigger import trigger_bits
 from BTVNanoCommissioning.utils.correction import (
     load_SF,
     JME_shifts,
@@ -35,10 +41,12 @@ class NanoProcessor(processor.ProcessorABC):
         chunksize=75000,
         addPFMuons=False,  # BTA custom argument
         addAllTracks=False,  # BTA custom argument
+        destination=BTA_destination,  # BTA custom argument
     ):
         self._year = year
         self._campaign = campaign
         self.chunksize = chunksize
+        self.branch_dtypes = BTA_dtypes
 
         self.SF_map = load_SF(self._campaign)
         # addPFMuons: if true, include the TrkInc and PFMuon collections, used by QCD based SF methods
@@ -47,6 +55,16 @@ class NanoProcessor(processor.ProcessorABC):
         self.addPFMuons = addPFMuons
         self.addAllTracks = addAllTracks
         self.isSyst = isSyst
+        dirname = "BTA"
+        if self.addAllTracks:
+            dirname += "_addAllTracks"
+        if self.addPFMuons:
+            dirname += "_addPFMuons"
+        # chunks already at the destination are skipped, the index is listed once at job start (runner.py)
+        self.destination = storage(
+            f"{destination}/{dirname}/{self._campaign.replace('Run3','')}"
+        )
+        self.produced = OutputIndex(self.destination)
 
     @property
     def accumulator(self):
@@ -58,20 +76,18 @@ class NanoProcessor(processor.ProcessorABC):
         events = missing_branch(events)
         shifts = []
         fname = f"{dataset}/{events.metadata['filename'].split('/')[-1].replace('.root','')}_{int(events.metadata['entrystop']/self.chunksize)}.root"
-        dirname = "BTA"
-        if self.addAllTracks:
-            dirname += "_addAllTracks"
-        if self.addPFMuons:
-            dirname += "_addPFMuons"
         if self.isSyst:
             fname = "systematic/" + fname
-        checkf = os.popen(
-            f"gfal-ls root://eoscms.cern.ch//eos/cms/store/group/phys_btag/milee/{dirname}/{self._campaign.replace('Run3','')}/{fname}"
-        ).read()
-        if len(checkf) > 0:
-            print("skip ", checkf)
+        if fname in self.produced:
+            print("skip ", fname)
             return {dataset: len(events)}
 
+        # drop the events failing the track trigger before the jet corrections
+        if isRealData and self.addAllTracks:
+            events = events[events.HLT.PFJet80]
+            if len(events) == 0:
+                return {dataset: len(events)}
+
         if "JME" in self.SF_map.keys() or "jetveto" in self.SF_map.keys():
             shifts = JME_shifts(
                 shifts, self.SF_map, events, self._campaign, isRealData, False, True
@@ -102,10 +118,6 @@ class NanoProcessor(processor.ProcessorABC):
         dataset = events.metadata["dataset"]
         isRealData = not hasattr(events, "genWeight")
 
-        if isRealData and self.addAllTracks:
-            events = events[events.HLT.PFJet80]
-            if len(events) == 0:
-                return {dataset: len(events)}
         # basic variables
         basic_vars = {
             "Run": events.run,
@@ -125,28 +137,7 @@ class NanoProcessor(processor.ProcessorABC):
         ###########
         #   HLT   #
         ###########
-        triggers = BTA_HLT
-        checkHLT = ak.Array([hasattr(events.HLT, _trig) for _trig in triggers])
-        if ak.all(checkHLT == False):
-            raise ValueError("HLT paths:", triggers, " are all invalid in", dataset)
-        elif ak.any(checkHLT == False):
-            print(
-                np.array(triggers)[~checkHLT],
-                " doesn't exist in",
-                dataset,
-                ", please check!",
-            )
-
-        pass_trig = np.array(
-            [
-                getattr(events.HLT, _trig, np.zeros(len(events), dtype="bool"))
-                for _trig in triggers
-            ]
-        ).T
-
-        basic_vars["BitTrigger"] = to_bitwise_trigger(
-            pass_trig, ak.ArrayBuilder()
-        ).snapshot()
+        basic_vars["BitTrigger"] = trigger_bits(events, BTA_HLT)
         # PV
         PV = ak.zip(
             {
@@ -158,6 +149,9 @@ class NanoProcessor(processor.ProcessorABC):
             }
         )
         if not isRealData:
+            # mother/daughter index of GenPart, used by all the generator blocks
+            genparts = GenPartIndex(events.GenPart)
+
             ###########
             # Quarks #
             ###########
@@ -166,7 +160,6 @@ class NanoProcessor(processor.ProcessorABC):
                 quark_sel = (abs(events.GenPart.pdgId) == quark_pdgid) & (
                     events.GenPart.hasFlags("isLastCopy")
                 )  # is b/c-quark & is last copy
-                quark_index = ak.local_index(events.GenPart.pdgId)[quark_sel]
                 quarks = events.GenPart[quark_sel]
                 out = ak.zip(
                     {
@@ -175,7 +168,7 @@ class NanoProcessor(processor.ProcessorABC):
                         "phi": quarks.phi,
                         "pdgId": quarks.pdgId,
                         "status": quarks.status,
-                        "fromGSP": is_from_GSP(quarks),
+                        "fromGSP": genparts.from_GSP(quark_sel),
                     }
                 )
                 if quark_pdgid == 4:
@@ -190,15 +183,16 @@ class NanoProcessor(processor.ProcessorABC):
                 abs(p.pdgId) // 1000 == pid
             )
 
+            isDhadron = is_heavy_hadron(events.GenPart, 4)
+            isBhadron = is_heavy_hadron(events.GenPart, 5)
+            # D hadrons whose daughters do not include D hadrons
+            isfinalD = isDhadron & (genparts.n_daughters(isDhadron) == 0)
+
             # finding D hadrons
-            sel = is_heavy_hadron(events.GenPart, 4) & (
+            sel = isfinalD & (
                 events.GenPart.hasFlags("isLastCopy")
-            )  # PID match, is last copy
-
+            )  # PID match, is last copy, should not select D hadron whose daughters also includes D hadrons
             chadrons = events.GenPart[sel]
-            chadrons = chadrons[
-                ~ak.any(is_heavy_hadron(chadrons.children, 4), axis=-1)
-            ]  # should not select D hadron whose daughters also includes D hadrons
             DHadron = ak.zip(
                 {
                     "pT": chadrons.pt,
@@ -206,15 +200,17 @@ class NanoProcessor(processor.ProcessorABC):
                     "phi": chadrons.phi,
                     "pdgID": chadrons.pdgId,
                     "mass": get_hadron_mass(chadrons.pdgId),
-                    "muInDaughter": ak.any(abs(chadrons.children.pdgId) == 13, axis=-1),
+                    "muInDaughter": (
+                        genparts.n_daughters(abs(events.GenPart.pdgId) == 13) > 0
+                    )[sel],
                 }
             )
 
             # finding B hadrons
-            sel = is_heavy_hadron(events.GenPart, 5) & (
+            bsel = isBhadron & (
                 events.GenPart.hasFlags("isLastCopy")
             )  # PID match, is last copy
-            bhadrons = events.GenPart[sel]
+            bhadrons = events.GenPart[bsel]
             BHadron = ak.zip(
                 {
                     "pT": bhadrons.pt,
@@ -223,62 +219,16 @@ class NanoProcessor(processor.ProcessorABC):
                     "pdgID": bhadrons.pdgId,
                     "mass": get_hadron_mass(bhadrons.pdgId),
                     "hasBdaughter": ak.values_astype(
-                        ak.any(is_heavy_hadron(bhadrons.children, 5), axis=-1), int
+                        (genparts.n_daughters(isBhadron) > 0)[bsel], int
                     ),  # B hadrons with B-daughters not removed
                 }
             )
 
-            ## find all daughter stable D hadrons and matched with D hadron list
-            bhad_ch1G = bhadrons.children
-            bhad_ch2G = bhadrons.children.children
-            bhad_ch3G = bhadrons.children.children.children
-            bhad_ch4G = bhadrons.children.children.children.children
-
-            # for each B hadron: form a list of it daugthers which are:
-            # D hadron & D does not include D hadron daugthers
-            # i.e., find B -> D
-            chad_asdau_1G = bhad_ch1G[
-                is_heavy_hadron(bhad_ch1G, 4)
-                & ~ak.any(is_heavy_hadron(bhad_ch2G, 4), axis=-1)
-            ]
-            # then find B -> D* -> D (store the final D)
-
-            chad_asdau_2G = ak.flatten(
-                bhad_ch2G[
-                    is_heavy_hadron(bhad_ch2G, 4)
-                    & ~ak.any(is_heavy_hadron(bhad_ch3G, 4), axis=-1)
-                ],
-                axis=3,
-            )
-
-            # then find B -> D** -> D* -> D (store the final D)
-            chad_asdau_3G = ak.flatten(
-                ak.flatten(
-                    bhad_ch3G[
-                        is_heavy_hadron(bhad_ch3G, 4)
-                        & ~ak.any(is_heavy_hadron(bhad_ch4G, 4), axis=-1)
-                    ],
-                    axis=4,
-                ),
-                axis=3,
-            )
-            # combine all final D hadrons together
-            # now in dim: (evt, bhad, chad_asdau)
-            chad_asdau_final = ak.concatenate(
-                [chad_asdau_1G, chad_asdau_2G, chad_asdau_3G], axis=2
-            )
-            chadrons_broadcast = ak.cartesian(
-                [bhadrons, chadrons], axis=1, nested=True
-            )[
-                "1"
-            ]  # broadcast to include bhad dimension: (evt, bhad, chad)
-
-            # pair the D hadrons (as daughters) with the previous D hadron list
-            pair = ak.cartesian(
-                [chad_asdau_final, chadrons_broadcast], axis=2, nested=True
-            )  # dim: (evt, bhad, chad_asdau, chad)
-            chad_index = ak.argmax(
-                pair["0"].pt == pair["1"].pt, axis=-1
+            # for each B hadron: index in the D hadron list of its descendants which are
+            # D hadrons without D hadron daughters, up to 3 generations, i.e.
+            # B -> D, B -> D* -> D, B -> D** -> D* -> D (store the final D)
+            chad_index = genparts.descendants(
+                bsel, sel, 3
             )  # dim: (evt, bhad, chad_asdau)
 
             # fill D hadron index (exclude those with hasBdaughter==False)
@@ -304,16 +254,12 @@ class NanoProcessor(processor.ProcessorABC):
             ###############
             ## Genlep
 
-            _fix = lambda x: ak.fill_none(x, 0)
             is_lep = (
-                lambda p: (abs(_fix(p.pdgId)) == 11)
-                | (abs(_fix(p.pdgId)) == 13)
-                | (abs(_fix(p.pdgId)) == 15)
-            )
-            is_WZ = lambda p: (abs(_fix(p.pdgId)) == 23) | (abs(_fix(p.pdgId)) == 24)
-            is_heavy_hadron = lambda p, pid: (abs(_fix(p.pdgId)) // 100 == pid) | (
-                abs(_fix(p.pdgId)) // 1000 == pid
+                lambda p: (abs(p.pdgId) == 11)
+                | (abs(p.pdgId) == 13)
+                | (abs(p.pdgId) == 15)
             )
+            is_WZ = lambda p: (abs(p.pdgId) == 23) | (abs(p.pdgId) == 24)
 
             sel = (
                 is_lep(events.GenPart)
@@ -323,19 +269,16 @@ class NanoProcessor(processor.ProcessorABC):
             genlep = events.GenPart[sel]
 
             # trace parents up to 4 generations (from BTA code)
-            genlep_pa1G = genlep.parent
-            genlep_pa2G = genlep.parent.parent
-            genlep_pa3G = genlep.parent.parent.parent
-            genlep_pa4G = genlep.parent.parent.parent.parent
-            istau = abs(genlep_pa1G.pdgId) == 15
-            isWZ = is_WZ(genlep_pa1G) | is_WZ(genlep_pa2G)
-            isD = is_heavy_hadron(genlep_pa1G, 4) | is_heavy_hadron(genlep_pa2G, 4)
-            isB = (
-                is_heavy_hadron(genlep_pa1G, 5)
-                | is_heavy_hadron(genlep_pa2G, 5)
-                | is_heavy_hadron(genlep_pa3G, 5)
-                | is_heavy_hadron(genlep_pa4G, 5)
+            has_ancestor = (
+                lambda mask, generations: genparts.first_ancestor(
+                    sel, mask, generations
+                )
+                >= 0
             )
+            istau = has_ancestor(abs(events.GenPart.pdgId) == 15, 1)
+            isWZ = has_ancestor(is_WZ(events.GenPart), 2)
+            isD = has_ancestor(isDhadron, 2)
+            isB = has_ancestor(isBhadron, 4)
 
             Genlep = ak.zip(
                 {
@@ -357,27 +300,27 @@ class NanoProcessor(processor.ProcessorABC):
             genV0 = events.GenPart[sel]
 
             # finding charged daughters with pT > 1
-            is_lep = (
-                lambda p: (abs(_fix(p.pdgId)) == 11)
-                | (abs(_fix(p.pdgId)) == 13)
-                | (abs(_fix(p.pdgId)) == 15)
-            )
             is_charged_light_hadron = (
                 lambda p: (abs(p.pdgId) == 211)
                 | (abs(p.pdgId) == 213)
                 | (abs(p.pdgId) == 321)
                 | (abs(p.pdgId) == 323)
             )
-            genV0_ch_charged = genV0.children[
-                (is_charged_light_hadron(genV0.children) | is_lep(genV0.children))
-                & (genV0.children.pt > 1.0)
-            ]
+            charged = (
+                is_charged_light_hadron(events.GenPart) | is_lep(events.GenPart)
+            ) & (events.GenPart.pt > 1.0)
+            genV0_ch_charged = genparts.descendants(
+                sel, charged, 1
+            )  # dim: (evt, V0, charged daughter), index in GenPart[charged]
             ncharged = ak.num(genV0_ch_charged, axis=2)
 
             # check acceptance (from the BTA code)
-            svx = ak.fill_none(ak.firsts(genV0_ch_charged.vx, axis=-1), 0)
-            svy = ak.fill_none(ak.firsts(genV0_ch_charged.vy, axis=-1), 0)
-            svz = ak.fill_none(ak.firsts(genV0_ch_charged.vz, axis=-1), 0)
+            first_charged = events.GenPart[charged][
+                ak.firsts(genV0_ch_charged, axis=-1)
+            ]
+            svx = ak.fill_none(first_charged.vx, 0)
+            svy = ak.fill_none(first_charged.vy, 0)
+            svz = ak.fill_none(first_charged.vz, 0)
             radius = np.hypot(svx, svy)
             abseta = abs(genV0.eta)
 
@@ -567,29 +510,12 @@ class NanoProcessor(processor.ProcessorABC):
             & (trkj.btagDecayLenVal < 5)
         ]
 
-        pair = ak.cartesian(
-            [jet, trkj], axis=1, nested=True
-        )  # dim: (event, jet, pfcand)
-
-        # first loosely matches tracks with jets with deltaR < 0.4
+        # first loosely matches tracks with jets with deltaR < 0.4, and assign categories (findCat in BTA)
         # for calculating JP, deltaR < 0.3 is further required
-        matched = (pair["0"].pt_orig == pair["1"].jet.pt) & (
-            pair["0"].delta_r(pair["1"].pf) < 0.4
-        )
-
-        trkj_jetbased = pair["1"][matched]  # dim: (event, jet, pfcand)
+        trkj_jetbased = associate_tracks(
+            jet, trkj, 0.4, JP_track_categories
+        )  # dim: (event, jet, pfcand)
 
-        # calculate basic kinematics
-        trkj_jetbased["pvec"] = ak.zip(
-            {
-                "pt": trkj_jetbased.pf.trkPt,
-                "eta": trkj_jetbased.pf.trkEta,
-                "phi": trkj_jetbased.pf.trkPhi,
-                "mass": trkj_jetbased.pf.mass,
-            },
-            behavior=vector.behavior,
-            with_name="PtEtaPhiMLorentzVector",
-        )
         # deltaR(jet, track) used for further selection
         trkj_jetbased["dr_jet"] = trkj_jetbased.pf.delta_r(jet)
 
@@ -615,123 +541,6 @@ class NanoProcessor(processor.ProcessorABC):
             trkj_jetbased.pf.lostInnerHits == -1, int
         )  # according to definition of lostInnerHits
 
-        # assign categories (findCat in BTA)
-        cats = {
-            0: dict(
-                withFirstPixel=-1,
-                nPixelHitsRange=(1, 99),
-                etaRange=(0.0, 4.5),
-                pRange=(1.0, 999.0),
-                nHitsRange=(1, 50),
-                chiRange=(0, 5),
-            ),
-            1: dict(
-                withFirstPixel=1,
-                nPixelHitsRange=(1, 3),
-                etaRange=(0.0, 4.5),
-                pRange=(1.0, 999.0),
-                nHitsRange=(1, 50),
-                chiRange=(0, 5),
-            ),
-            2: dict(
-                withFirstPixel=1,
-                nPixelHitsRange=(4, 99),
-                etaRange=(0.0, 1.0),
-                pRange=(1.0, 3.0),
-                nHitsRange=(1, 50),
-                chiRange=(0, 5),
-            ),
-            3: dict(
-                withFirstPixel=1,
-                nPixelHitsRange=(4, 99),
-                etaRange=(0.0, 1.0),
-                pRange=(3.0, 6.0),
-                nHitsRange=(1, 50),
-                chiRange=(0, 5),
-            ),
-            4: dict(
-                withFirstPixel=1,
-                nPixelHitsRange=(4, 99),
-                etaRange=(0.0, 1.0),
-                pRange=(6.0, 999.0),
-                nHitsRange=(1, 50),
-                chiRange=(0, 5),
-            ),
-            5: dict(
-                withFirstPixel=1,
-                nPixelHitsRange=(4, 99),
-                etaRange=(1.0, 2.0),
-                pRange=(1.0, 6.0),
-                nHitsRange=(1, 50),
-                chiRange=(0, 5),
-            ),
-            6: dict(
-                withFirstPixel=1,
-                nPixelHitsRange=(4, 99),
-                etaRange=(1.0, 2.0),
-                pRange=(6.0, 12.0),
-                nHitsRange=(1, 50),
-                chiRange=(0, 5),
-            ),
-            7: dict(
-                withFirstPixel=1,
-                nPixelHitsRange=(4, 99),
-                etaRange=(1.0, 2.0),
-                pRange=(12.0, 999.0),
-                nHitsRange=(1, 50),
-                chiRange=(0, 5),
-            ),
-            8: dict(
-                withFirstPixel=1,
-                nPixelHitsRange=(4, 99),
-                etaRange=(2.0, 4.5),
-                pRange=(1.0, 18.0),
-                nHitsRange=(1, 50),
-                chiRange=(0, 5),
-            ),
-            9: dict(
-                withFirstPixel=1,
-                nPixelHitsRange=(4, 99),
-                etaRange=(2.0, 4.5),
-                pRange=(18.0, 999.0),
-                nHitsRange=(1, 50),
-                chiRange=(0, 5),
-            ),
-        }
-        pass_cat = lambda t, i: (
-            (
-                ((cats[i]["withFirstPixel"] == 1) & (t.isHitL1 == 1))
-                | ((cats[i]["withFirstPixel"] == -1) & (t.isHitL1 == 0))
-                | (cats[i]["withFirstPixel"] == 0)
-            )
-            & (
-                (t.pf.numberOfPixelHits >= cats[i]["nPixelHitsRange"][0])
-                & (t.pf.numberOfPixelHits <= cats[i]["nPixelHitsRange"][1])
-            )
-            & (
-                (abs(t.pf.trkEta) >= cats[i]["etaRange"][0])
-                & (abs(t.pf.trkEta) <= cats[i]["etaRange"][1])
-            )
-            & ((t.pvec.p >= cats[i]["pRange"][0]) & (t.pvec.p <= cats[i]["pRange"][1]))
-            & (
-                (t.pf.numberOfHits >= cats[i]["nHitsRange"][0])
-                & (t.pf.numberOfHits <= cats[i]["nHitsRange"][1])
-            )
-            & (
-                (t.pf.trkChi2 >= cats[i]["chiRange"][0])
-                & (t.pf.trkChi2 <= cats[i]["chiRange"][1])
-            )
-        )
-
-        zeros = ak.zeros_like(trkj_jetbased.pt, dtype=int)
-        trkj_jetbased["category"] = zeros - 1  # initial category index: -1
-        for idx in range(0, 10):
-            trkj_jetbased["category"] = ak.where(
-                (trkj_jetbased["category"] == -1) & pass_cat(trkj_jetbased, idx),
-                zeros + idx,
-                trkj_jetbased["category"],
-            )
-
         # calculate track probability, based on IPsig and category
         JPMC_syst = True if self.isSyst == "JP_MC" else False
         jpc = JPCalibHandler(self._campaign, isRealData, dataset, JPMC_syst)
@@ -831,13 +640,9 @@ class NanoProcessor(processor.ProcessorABC):
                 & (trkj.pf.dz < 1.0)
             ]
 
-            pair = ak.cartesian(
-                [jet, trkj], axis=1, nested=True
+            trkj_jetbased = associate_tracks(
+                jet, trkj, 0.4
             )  # dim: (event, jet, pfcand)
-            matched = (pair["0"].pt_orig == pair["1"].jet.pt) & (
-                pair["0"].delta_r(pair["1"].pf) < 0.4
-            )
-            trkj_jetbased = pair["1"][matched]  # dim: (event, jet, pfcand)
 
             # calculate pTrel
             vec = ak.zip(
@@ -1117,12 +922,7 @@ class NanoProcessor(processor.ProcessorABC):
         fname = f"{dataset}/{events.metadata['filename'].split('/')[-1].replace('.root','')}_{int(events.metadata['entrystop']/self.chunksize)}.root"
         if self.isSyst:
             fname = "systematic/" + fname
-        dirname = "BTA"
-        if self.addAllTracks:
-            dirname += "_addAllTracks"
-        if self.addPFMuons:
-            dirname += "_addPFMuons"
-        with uproot.recreate(fname) as fout:
+        with writer_policy(self).recreate(fname) as fout:
             output_root = {}
             for bname in output.keys():
                 if not output[bname].fields:
@@ -1132,11 +932,9 @@ class NanoProcessor(processor.ProcessorABC):
                     for n in output[bname].fields:
                         b_nest[n] = ak.packed(ak.without_parameters(output[bname][n]))
                     output_root[bname] = ak.zip(b_nest)
-            fout["btagana/ttree"] = output_root
-        os.system(
-            f"xrdcp -p --silent {fname} root://eoscms.cern.ch//eos/cms/store/group/phys_btag/milee/{dirname}/{self._campaign.replace('Run3','')}/{fname}"
-        )
-        os.system(f"rm {fname}")
+            writer_policy(self).write(fout, "btagana/ttree", output_root)
+        # copied to the destination in the background, the next chunk does not wait
+        upload_queue().submit(fname, self.destination, fname)
         return {dataset: len(events)}
 
     def postprocess(self, accumulator):
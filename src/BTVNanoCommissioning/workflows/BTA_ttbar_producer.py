@@ -6,9 +6,13 @@ from coffea import processor
 from BTVNanoCommissioning.helpers.update_branch import missing_branch
 from BTVNanoCommissioning.helpers.BTA_helper import (
     BTA_ttbar_HLT_chns,
-    to_bitwise_trigger,
+    BTA_destination,
+    BTA_dtypes,
 )
 from BTVNanoCommissioning.helpers.func import update
+from BTVNanoCommissioning.utils.array_writer import writer_policy
+from BTVNanoCommissioning.utils.storage import storage, OutputIndex, upload_queue
+from BTVNanoCommissioning.utils.trigger import path_matrix, trigger_bits
 from BTVNanoCommissioning.utils.correction import load_SF, JME_shifts, jetveto
 import os
 
@@ -24,13 +28,20 @@ class NanoProcessor(processor.ProcessorABC):
         isArray=True,
         noHist=False,
         chunksize=75000,
+        destination=BTA_destination,
     ):
         self._year = year
         self._campaign = campaign
         self.chunksize = chunksize
+        self.branch_dtypes = BTA_dtypes
         self.syst = isSyst
         self.name = name
         self.SF_map = load_SF(self._campaign)
+        # chunks already at the destination are skipped, the index is listed once at job start (runner.py)
+        self.destination = storage(
+            f"{destination}/BTA_ttbar/{self._campaign.replace('Run3','')}"
+        )
+        self.produced = OutputIndex(self.destination)
 
         ### Custom initialzations for BTA_ttbar workflow ###
 
@@ -68,11 +79,8 @@ class NanoProcessor(processor.ProcessorABC):
 
         fname = f"{dataset}_{shift_name}/{events.metadata['filename'].split('/')[-1].replace('.root','')}_{int(events.metadata['entrystop']/self.chunksize)}.root"
 
-        checkf = os.popen(
-            f"gfal-ls root://eoscms.cern.ch//eos/cms/store/group/phys_btag/milee/BTA_ttbar/{self._campaign.replace('Run3','')}/{fname}"
-        ).read()
-        if len(checkf) > 0:
-            print("skip ", checkf)
+        if fname in self.produced:
+            print("skip ", fname)
             return {dataset: len(events)}
 
         isRealData = not hasattr(events, "genWeight")
@@ -99,24 +107,8 @@ class NanoProcessor(processor.ProcessorABC):
         ###########
         triggers = [t[0] for t in BTA_ttbar_HLT_chns]
 
-        checkHLT = ak.Array([hasattr(events.HLT, _trig) for _trig in triggers])
-        if ak.all(checkHLT == False):
-            raise ValueError("HLT paths:", triggers, " are all invalid in", dataset)
-        elif ak.any(checkHLT == False):
-            print(
-                np.array(triggers)[~checkHLT],
-                " not exist in",
-                dataset,
-                ", please check!",
-            )
-
-        # pass_trigger dim: (n_evt, n_trig), append False for non-exist triggers
-        pass_trig = np.array(
-            [
-                getattr(events.HLT, _trig, np.zeros(len(events), dtype="bool"))
-                for _trig in triggers
-            ]
-        ).T
+        # pass_trigger dim: (n_evt, n_trig), False for non-exist triggers
+        pass_trig = path_matrix(events, triggers)
 
         # get trigger pass for each channel (e, m, em)
         pass_trig_chn = {
@@ -129,9 +121,7 @@ class NanoProcessor(processor.ProcessorABC):
             pass_trig_chn[chn] |= pass_trig[:, i]
 
         # convert to bitwise trigger (total number of triggers is less than 32)
-        basic_vars[f"ttbar_trigWord"] = to_bitwise_trigger(
-            pass_trig, ak.ArrayBuilder()
-        ).snapshot()[:, 0]
+        basic_vars[f"ttbar_trigWord"] = trigger_bits(events, triggers)[:, 0]
 
         #########################
         #  Lep/di-lep channels  #
@@ -525,7 +515,7 @@ class NanoProcessor(processor.ProcessorABC):
         fname = f"{dataset}_{shift_name}/{events.metadata['filename'].split('/')[-1].replace('.root','')}_{int(events.metadata['entrystop']/self.chunksize)}.root"
         os.system(f"mkdir -p {dataset}_{shift_name}")
         if ak.any(passEvent) == False:
-            with uproot.recreate(fname) as fout:
+            with writer_policy(self).recreate(fname) as fout:
                 fout["sumw"] = {
                     "total_events": ak.Array([len(events)]),
                 }
@@ -558,7 +548,7 @@ class NanoProcessor(processor.ProcessorABC):
                 output["ttbar_ps_w"] = ps_w_arrays[passEvent]
 
         # customize output file name: <dataset>_<nanoAOD file name>_<chunk index>.root
-        with uproot.recreate(fname) as fout:
+        with writer_policy(self).recreate(fname) as fout:
             output_root = {}
             for bname in output.keys():
                 if not output[bname].fields:
@@ -568,7 +558,7 @@ class NanoProcessor(processor.ProcessorABC):
                     for n in output[bname].fields:
                         b_nest[n] = ak.packed(ak.without_parameters(output[bname][n]))
                     output_root[bname] = ak.zip(b_nest)
-            fout["btagana/ttree"] = output_root
+            writer_policy(self).write(fout, "btagana/ttree", output_root)
             if isRealData:
                 fout["sumw"] = {"total_events": ak.Array([len(events)])}
             else:
@@ -584,10 +574,8 @@ class NanoProcessor(processor.ProcessorABC):
                         [ak.sum(events.genWeight[events.genWeight < 0.0])]
                     ),
                 }
-        os.system(
-            f"xrdcp -p --silent {fname} root://eoscms.cern.ch//eos/cms/store/group/phys_btag/milee/BTA_ttbar/{self._campaign.replace('Run3','')}/{fname}"
-        )
-        os.system(f"rm {fname}")
+        # copied to the destination in the background, the next chunk does not wait
+        upload_queue().submit(fname, self.destination, fname)
         return {dataset: len(events)}
 
     def postprocess(self, accumulator):
@@ -1,10 +1,22 @@
 import collections, numpy as np, awkward as ak
 from coffea import processor
 from coffea.analysis_tools import Weights
-from BTVNanoCommissioning.utils.selection import jet_cut
-from BTVNanoCommissioning.helpers.func import flatten, update, dump_lumi
-from BTVNanoCommissioning.utils.histogrammer import histogrammer
+from BTVNanoCommissioning.utils.selection import jet_cut, prefilter_mask
+from BTVNanoCommissioning.helpers.func import (
+    flatten,
+    update,
+    dump_sumw,
+    SelectedEvents,
+)
+from BTVNanoCommissioning.utils.histogrammer import (
+    histogrammer,
+    syst_categories,
+    syst_weights,
+    fill_syst,
+)
 from BTVNanoCommissioning.utils.array_writer import array_writer
+from BTVNanoCommissioning.utils.reader import prefiltered
+from BTVNanoCommissioning.utils.trigger import trigger_mask
 from BTVNanoCommissioning.helpers.update_branch import missing_branch
 from BTVNanoCommissioning.utils.correction import (
     load_SF,
@@ -13,8 +25,7 @@ from BTVNanoCommissioning.utils.correction import (
     eleSFs,
     puwei,
     btagSFs,
-    JME_shifts,
-    Roccor_shifts,
+    common_shifts,
     jetveto,
 )
 import correctionlib
@@ -40,8 +51,16 @@ class NanoProcessor(processor.ProcessorABC):
         self.noHist = noHist
         self.lumiMask = load_lumi(self._campaign)
         self.chunksize = chunksize
+        self.selection_index = None
+        self.skim = None
+        # the jet veto map is applied in the selection
+        self.exclude_jetveto = True
+        self.triggers = [
+            "PFJet140",
+        ]
         ## Load corrections
         self.SF_map = load_SF(self._campaign)
+        self.systematics = syst_categories(self.SF_map, self.isSyst, ["PU", "BTV"])
 
     @property
     def accumulator(self):
@@ -50,86 +69,76 @@ class NanoProcessor(processor.ProcessorABC):
     def process(self, events):
         isRealData = not hasattr(events, "genWeight")
         dataset = events.metadata["dataset"]
-        events = missing_branch(events)
-        shifts = []
-        if "JME" in self.SF_map.keys() or "jetveto" in self.SF_map.keys():
-            syst_JERC = self.isSyst
-            if self.isSyst == "JERC_split":
-                syst_JERC = "split"
-            shifts = JME_shifts(
-                shifts, self.SF_map, events, self._campaign, isRealData, False, True
-            )
-        else:
-            if int(self._year) < 2020:
-                shifts = [
-                    ({"Jet": events.Jet, "MET": events.MET, "Muon": events.Muon}, None)
-                ]
-            else:
-                shifts = [
-                    (
-                        {
-                            "Jet": events.Jet,
-                            "MET": events.PuppiMET,
-                            "Muon": events.Muon,
-                        },
-                        None,
-                    )
-                ]
-        if "roccor" in self.SF_map.keys():
-            shifts = Roccor_shifts(shifts, self.SF_map, events, isRealData, False)
-        else:
-            shifts[0][0]["Muon"] = events.Muon
-
+        output = {dataset: dump_sumw(events, self.lumiMask)}
+        if self.skim is not None:
+            self.skim.write_summary(events.metadata, output[dataset])
+        events = missing_branch(
+            prefiltered(events, self.prefilter, self.selection_index)
+        )
+        # sum of weights of the whole chunk, the events are prefiltered
+        sumw = output[dataset]["sumw"]
+        shifts = common_shifts(
+            events,
+            self.SF_map,
+            self._campaign,
+            self._year,
+            isRealData,
+            exclude_jetveto=self.exclude_jetveto,
+        )
         return processor.accumulate(
-            self.process_shift(update(events, collections), name)
-            for collections, name in shifts
+            (
+                self.process_shift(update(events, collections), name, sumw)
+                for collections, name in shifts
+            ),
+            output,
+        )
+
+    def prefilter(self, events):
+        # shift-independent part of the selection, run before the corrections
+        return prefilter_mask(
+            events,
+            self._campaign,
+            self.lumiMask if not hasattr(events, "genWeight") else None,
+            self.triggers,
         )
 
-    def process_shift(self, events, shift_name):
+    def process_shift(self, events, shift_name, sumw):
         isRealData = not hasattr(events, "genWeight")
         dataset = events.metadata["dataset"]
-        _hist_event_dict = {"": None} if self.noHist else histogrammer(events, "QCD")
-        if _hist_event_dict == None:
-            _hist_event_dict[""]
-        output = {
-            "sumw": processor.defaultdict_accumulator(float),
-            **_hist_event_dict,
-        }
-
-        if isRealData:
-            output["sumw"] = len(events)
-        else:
-            output["sumw"] = ak.sum(events.genWeight)
+        output = {}
 
         ####################
         #    Selections    #
         ####################
         ## HLT
-        triggers = [
-            "PFJet140",
-        ]
-        checkHLT = ak.Array([hasattr(events.HLT, _trig) for _trig in triggers])
-        if ak.all(checkHLT == False):
-            raise ValueError("HLT paths:", triggers, " are all invalid in", dataset)
-        elif ak.any(checkHLT == False):
-            print(np.array(triggers)[~checkHLT], " not exist in", dataset)
-        trig_arrs = [
-            events.HLT[_trig] for _trig in triggers if hasattr(events.HLT, _trig)
-        ]
-        req_trig = np.zeros(len(events), dtype="bool")
-        for t in trig_arrs:
-            req_trig = req_trig | t
+        triggers = self.triggers
+        req_trig = trigger_mask(events, triggers)
         req_lumi = np.ones(len(events), dtype="bool")
         if isRealData:
             req_lumi = self.lumiMask(events.run, events.luminosityBlock)
-        if shift_name is None:
-            output = dump_lumi(events[req_lumi], output)
         ## Jet cuts
         events.Jet = events.Jet[jet_cut(events, self._campaign)]
         req_jets = ak.count(events.Jet.pt, axis=1) >= 1
 
         event_level = ak.fill_none(req_lumi & req_trig & req_jets, False)
-        if len(events[event_level]) == 0:
+        selev = SelectedEvents(
+            events,
+            event_level,
+            (
+                ["PV.npvsGood"]
+                if isRealData
+                else ["PV.npvsGood", "genWeight", "Pileup.nTrueInt"]
+            ),
+        )
+        if len(selev) == 0:
+            if not self.noHist:
+                output.update(
+                    histogrammer(
+                        events,
+                        "QCD",
+                        ["nominal"] if isRealData else self.systematics,
+                    )
+                )
             return {dataset: output}
 
         ####################
@@ -140,7 +149,6 @@ class NanoProcessor(processor.ProcessorABC):
         ###############
         # Selected SV #
         ###############
-        selev = events[event_level]
         if "JetSVs" in events.Jet.fields:
             matched_JetSVs = selev.Jet[selev.JetSVs.jetIdx]
             lj_matched_JetSVs = matched_JetSVs[selev.JetSVs.jetIdx == 0]
@@ -152,7 +160,7 @@ class NanoProcessor(processor.ProcessorABC):
         ####################
         weights = Weights(len(selev), storeIndividual=True)
         if not isRealData:
-            weights.add("genweight", selev.genWeight)
+            weights.add("genweight", selev["genWeight"])
             par_flav = (sjets.partonFlavour == 0) & (sjets.hadronFlavour == 0)
             genflavor = sjets.hadronFlavour + 1 * par_flav
             # genweiev = ak.flatten(
@@ -168,7 +176,7 @@ class NanoProcessor(processor.ProcessorABC):
             syst_wei = True if self.isSyst != None else False
             if "PU" in self.SF_map.keys():
                 puwei(
-                    events[event_level].Pileup.nTrueInt,
+                    selev["Pileup.nTrueInt"],
                     self.SF_map,
                     weights,
                     syst_wei,
@@ -216,104 +224,150 @@ class NanoProcessor(processor.ProcessorABC):
         ####################
         #  Fill histogram  #
         ####################
-        for syst in systematics:
-
-            if self.isSyst == False and syst != "nominal":
-                break
-            if self.noHist:
-                break
-            weight = (
-                weights.weight()
-                if syst == "nominal" or syst == shift_name
-                else weights.weight(modifier=syst)
+        hist_systematics = [
+            syst for syst in systematics if self.isSyst != False or syst == "nominal"
+        ]
+        if len(hist_systematics) > 0 and (not self.noHist or self.skim is not None):
+            # objects the histograms are filled from, also stored in the skim
+            objects = ak.zip(
+                {
+                    "Jet": sjets,
+                    "njet": njet,
+                    "genflavor": genflavor,
+                    "npvs": selev["PV.npvsGood"],
+                    **(
+                        {
+                            "JetSVs": lj_SVs,
+                            "JetSVs_flavor": lj_matched_JetSVs_genflav,
+                            "nJetSVs": nJetSVs,
+                        }
+                        if "JetSVs" in events.Jet.fields
+                        else {}
+                    ),
+                    **({} if isRealData else {"pu": selev["Pileup.nTrueInt"]}),
+                },
+                depth_limit=1,
             )
-            for histname, h in output.items():
-                if (
-                    "DeepCSV" in histname
-                    and "btag" not in histname
-                    and histname in events.Jet.fields
-                ):
+            # weights of all the systematics, each histogram is filled once
+            weight = syst_weights(weights, hist_systematics, shift_name)
+            if self.skim is not None:
+                self.skim.write(
+                    events.metadata,
+                    shift_name,
+                    objects,
+                    weight,
+                    hist_systematics,
+                    isRealData,
+                )
+            if not self.noHist:
+                output.update(
+                    self.fill_histograms(objects, weight, hist_systematics, isRealData)
+                )
+        elif not self.noHist:
+            output.update(
+                histogrammer(
+                    events, "QCD", ["nominal"] if isRealData else self.systematics
+                )
+            )
+        return {dataset: output}
+
+    def fill_histograms(self, objects, weight, hist_systematics, isRealData):
+        """histograms of the selected objects of a shift, from process_shift or the skim"""
+        output = histogrammer(
+            objects, "QCD", ["nominal"] if isRealData else self.systematics
+        )
+        sjets, njet, genflavor = objects.Jet, objects.njet, objects.genflavor
+        for histname, h in output.items():
+            if (
+                "DeepCSV" in histname
+                and "btag" not in histname
+                and histname in sjets.fields
+            ):
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    flatten(genflavor),
+                    flatten(sjets[histname]),
+                    weight=weight,
+                    counts=ak.num(sjets),
+                )
+            elif "jet" in histname and histname.replace("jet0_", "") in sjets.fields:
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    flatten(genflavor[:, 0]),
+                    flatten(sjets[:, 0][histname.replace(f"jet0_", "")]),
+                    weight=weight,
+                )
+            elif "JetSVs_" in histname and "JetSVs" in objects.fields:
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    flatten(objects.JetSVs_flavor),
+                    flatten(objects.JetSVs[histname.replace("JetSVs_", "")]),
+                    weight=weight,
+                    counts=ak.num(objects.JetSVs_flavor),
+                )
+            elif (
+                "btag" in histname
+                and "0" in histname
+                and histname.replace("_0", "") in sjets.fields
+            ):
+                sel_jet = sjets[:, 0]
+                discr = np.where(
+                    sel_jet[histname.replace("_0", "")] < 0,
+                    -0.2,
+                    sel_jet[histname.replace("_0", "")],
+                )
+                if hist_systematics[0] == "nominal":
                     h.fill(
-                        syst,
-                        flatten(genflavor),
-                        flatten(sjets[histname]),
-                        weight=flatten(ak.broadcast_arrays(weight, sjets["pt"])[0]),
+                        syst="noSF",
+                        flav=genflavor[:, 0],
+                        discr=discr,
+                        weight=weight[0],
                     )
-                elif (
-                    "jet" in histname and histname.replace("jet0_", "") in sjets.fields
-                ):
-                    h.fill(
-                        syst,
-                        flatten(genflavor[:, 0]),
-                        flatten(sjets[:, 0][histname.replace(f"jet0_", "")]),
+                if not isRealData and "btag" in self.SF_map.keys():
+                    fill_syst(
+                        h,
+                        hist_systematics,
+                        flav=genflavor[:, 0],
+                        discr=discr,
                         weight=weight,
                     )
-                elif "JetSVs_" in histname and "JetSVs" in events.Jet.fields:
-                    h.fill(
-                        syst,
-                        flatten(lj_matched_JetSVs_genflav),
-                        flatten(lj_SVs[histname.replace("JetSVs_", "")]),
-                        weight=flatten(
-                            ak.broadcast_arrays(weight, lj_matched_JetSVs["pt"])[0]
-                        ),
-                    )
-                elif (
-                    "btag" in histname
-                    and "0" in histname
-                    and histname.replace("_0", "") in events.Jet.fields
-                ):
-                    sel_jet = sjets[:, 0]
-                    if syst == "nominal":
-                        h.fill(
-                            syst="noSF",
-                            flav=genflavor[:, 0],
-                            discr=np.where(
-                                sel_jet[histname.replace("_0", "")] < 0,
-                                -0.2,
-                                sel_jet[histname.replace("_0", "")],
-                            ),
-                            weight=weight,
-                        )
-                    if not isRealData and "btag" in self.SF_map.keys():
-                        h.fill(
-                            syst=syst,
-                            flav=genflavor[:, 0],
-                            discr=np.where(
-                                sel_jet[histname.replace("_0", "")] < 0,
-                                -0.2,
-                                sel_jet[histname.replace("_0", "")],
-                            ),
-                            weight=weight,
-                        )
-
-            output["njet"].fill(syst, njet, weight=weight)
-            if "JetSVs" in events.Jet.fields:
-                output["nJetSVs"].fill(syst, nJetSVs, weight=weight)
 
-                output["dr_SVjet0"].fill(
-                    syst,
-                    flatten(lj_matched_JetSVs_genflav),
-                    flatten(abs(lj_SVs.deltaR) - 0.1),
-                    weight=flatten(
-                        ak.broadcast_arrays(weight, lj_matched_JetSVs["pt"])[0]
-                    ),
-                )
-            output["npvs"].fill(syst, flatten(selev.PV.npvsGood), weight=weight)
-            if not isRealData:
-                if syst == "nominal":
-                    output["pu"].fill(
-                        "noPU",
-                        flatten(selev.Pileup.nTrueInt),
-                        weight=np.ones_like(weight),
-                    )
-                    output["npvs"].fill(
-                        "noPU",
-                        flatten(selev.Pileup.nTrueInt),
-                        weight=np.ones_like(weight),
-                    )
-                    output["pu"].fill(syst, flatten(selev.PV.npvsGood), weight=weight)
+        fill_syst(output["njet"], hist_systematics, njet, weight=weight)
+        if "JetSVs" in objects.fields:
+            fill_syst(
+                output["nJetSVs"], hist_systematics, objects.nJetSVs, weight=weight
+            )
 
-        return {dataset: output}
+            fill_syst(
+                output["dr_SVjet0"],
+                hist_systematics,
+                flatten(objects.JetSVs_flavor),
+                flatten(abs(objects.JetSVs.deltaR) - 0.1),
+                weight=weight,
+                counts=ak.num(objects.JetSVs_flavor),
+            )
+        fill_syst(
+            output["npvs"],
+            hist_systematics,
+            flatten(objects.npvs),
+            weight=weight,
+        )
+        if not isRealData and hist_systematics[0] == "nominal":
+            output["pu"].fill(
+                "noPU",
+                flatten(objects.pu),
+                weight=np.ones_like(weight[0]),
+            )
+            output["npvs"].fill(
+                "noPU",
+                flatten(objects.pu),
+                weight=np.ones_like(weight[0]),
+            )
+            output["pu"].fill("nominal", flatten(objects.npvs), weight=weight[0])
+        return output
 
     def postprocess(self, accumulator):
         return accumulator
@@ -11,26 +11,44 @@ from BTVNanoCommissioning.utils.correction import (
     eleSFs,
     puwei,
     btagSFs,
-    JME_shifts,
-    Roccor_shifts,
+    common_shifts,
 )
 
 from BTVNanoCommissioning.helpers.func import (
+    SelectedEvents,
     flatten,
     update,
-    dump_lumi,
+    dump_sumw,
+    jet_pfcands,
 )
 from BTVNanoCommissioning.helpers.update_branch import missing_branch
-from BTVNanoCommissioning.utils.histogrammer import histogrammer
-from BTVNanoCommissioning.utils.array_writer import array_writer
+from BTVNanoCommissioning.utils.histogrammer import (
+    histogrammer,
+    syst_categories,
+    syst_weights,
+    fill_syst,
+)
+from BTVNanoCommissioning.utils.array_writer import (
+    array_writer,
+    flush_writers,
+    reset_writers,
+)
+from BTVNanoCommissioning.utils.reader import prefiltered
+from BTVNanoCommissioning.utils.trigger import trigger_mask
 from BTVNanoCommissioning.utils.selection import (
     jet_id,
     mu_idiso,
     ele_mvatightid,
     MET_filters,
+    prefilter_mask,
+    dr_clean,
 )
 
 
+# histograms booked for each selection modifier
+histoname = {"DYM": "ctag_DY_sf", "DYE": "ectag_DY_sf"}
+
+
 class NanoProcessor(processor.ProcessorABC):
     def __init__(
         self,
@@ -51,80 +69,82 @@ class NanoProcessor(processor.ProcessorABC):
         self.noHist = noHist
         self.lumiMask = load_lumi(self._campaign)
         self.chunksize = chunksize
+        self.selection_index = None
+        self.skim = None
         self.selMod = selectionModifier
+        if "DYM" in self.selMod:
+            self.triggers = ["Mu17_TrkIsoVVL_Mu8_TrkIsoVVL_DZ_Mass8"]
+        elif "DYE" in self.selMod:
+            self.triggers = ["Ele23_Ele12_CaloIdL_TrackIdL_IsoVL"]
+        else:
+            raise ValueError(self.selMod, "is not a valid selection modifier.")
         ## Load corrections
         self.SF_map = load_SF(self._campaign)
+        lepton_sf = "MUO" if "DYM" in self.selMod else "EGM"
+        self.systematics = syst_categories(
+            self.SF_map, self.isSyst, ["PU", lepton_sf, "BTV"]
+        )
 
     @property
     def accumulator(self):
         return self._accumulator
 
     def process(self, events):
+        # a retried chunk does not keep the arrays of its failed attempt
+        reset_writers()
         isRealData = not hasattr(events, "genWeight")
         dataset = events.metadata["dataset"]
-        events = missing_branch(events)
-        shifts = []
-        if "JME" in self.SF_map.keys():
-            syst_JERC = self.isSyst
-            if self.isSyst == "JERC_split":
-                syst_JERC = "split"
-            shifts = JME_shifts(
-                shifts, self.SF_map, events, self._campaign, isRealData, syst_JERC
-            )
-        else:
-            if int(self._year) < 2020:
-                shifts = [
-                    ({"Jet": events.Jet, "MET": events.MET, "Muon": events.Muon}, None)
-                ]
-            else:
-                shifts = [
-                    (
-                        {
-                            "Jet": events.Jet,
-                            "MET": events.PuppiMET,
-                            "Muon": events.Muon,
-                        },
-                        None,
-                    )
-                ]
-        if "roccor" in self.SF_map.keys():
-            shifts = Roccor_shifts(shifts, self.SF_map, events, isRealData, False)
-        else:
-            shifts[0][0]["Muon"] = events.Muon
+        output = {dataset: dump_sumw(events, self.lumiMask)}
+        if self.skim is not None:
+            self.skim.write_summary(events.metadata, output[dataset])
+        events = missing_branch(
+            prefiltered(events, self.prefilter, self.selection_index)
+        )
+        # sum of weights of the whole chunk, the events are prefiltered
+        sumw = output[dataset]["sumw"]
+        shifts = common_shifts(
+            events, self.SF_map, self._campaign, self._year, isRealData, self.isSyst
+        )
+        output = processor.accumulate(
+            (
+                self.process_shift(update(events, collections), name, sumw)
+                for collections, name in shifts
+            ),
+            output,
+        )
+        # the chunk is only done once its root files are written
+        flush_writers()
+        return output
 
-        return processor.accumulate(
-            self.process_shift(update(events, collections), name)
-            for collections, name in shifts
+    def prefilter(self, events):
+        # shift-independent part of the selection, run before the corrections
+        if "DYM" in self.selMod:
+            dilep = mu_idiso(events, self._campaign)
+        else:
+            dilep = (events.Electron.pt > 15) & ele_mvatightid(events, self._campaign)
+        return prefilter_mask(
+            events,
+            self._campaign,
+            self.lumiMask if not hasattr(events, "genWeight") else None,
+            self.triggers,
+            metfilter=True,
+            nobjects=[(dilep, 2)],
         )
 
-    def process_shift(self, events, shift_name):
+    def process_shift(self, events, shift_name, sumw):
         dataset = events.metadata["dataset"]
         isRealData = not hasattr(events, "genWeight")
 
         isMu = False
         isEle = False
         if "DYM" in self.selMod:
-            triggers = ["Mu17_TrkIsoVVL_Mu8_TrkIsoVVL_DZ_Mass8"]
             isMu = True
         elif "DYE" in self.selMod:
-            triggers = ["Ele23_Ele12_CaloIdL_TrackIdL_IsoVL"]
             isEle = True
         else:
             raise ValueError(self.selMod, "is not a valid selection modifier.")
 
-        histname = {"DYM": "ctag_DY_sf", "DYE": "ectag_DY_sf"}
-        _hist_event_dict = (
-            {"": None} if self.noHist else histogrammer(events, histname[self.selMod])
-        )
-        output = {
-            "sumw": processor.defaultdict_accumulator(float),
-            **_hist_event_dict,
-        }
-
-        if isRealData:
-            output["sumw"] = len(events)
-        else:
-            output["sumw"] = ak.sum(events.genWeight)
+        output = {}
 
         ####################
         #    Selections    #
@@ -133,22 +153,9 @@ class NanoProcessor(processor.ProcessorABC):
         req_lumi = np.ones(len(events), dtype="bool")
         if isRealData:
             req_lumi = self.lumiMask(events.run, events.luminosityBlock)
-        # only dump for nominal case
-        if shift_name is None:
-            output = dump_lumi(events[req_lumi], output)
 
         ## HLT
-        checkHLT = ak.Array([hasattr(events.HLT, _trig) for _trig in triggers])
-        if ak.all(checkHLT == False):
-            raise ValueError("HLT paths:", triggers, " are all invalid in", dataset)
-        elif ak.any(checkHLT == False):
-            print(np.array(triggers)[~checkHLT], " not exist in", dataset)
-        trig_arrs = [
-            events.HLT[_trig] for _trig in triggers if hasattr(events.HLT, _trig)
-        ]
-        req_trig = np.zeros(len(events), dtype="bool")
-        for t in trig_arrs:
-            req_trig = req_trig | t
+        req_trig = trigger_mask(events, self.triggers)
 
         req_metfilter = MET_filters(events, self._campaign)
 
@@ -178,22 +185,11 @@ class NanoProcessor(processor.ProcessorABC):
             axis=-1,
         )
 
+        jetid = jet_id(events, self._campaign)
         jet_sel = ak.fill_none(
-            jet_id(events, self._campaign)
-            & (
-                ak.all(
-                    events.Jet.metric_table(pos_dilep) > 0.4,
-                    axis=2,
-                    mask_identity=True,
-                )
-            )
-            & (
-                ak.all(
-                    events.Jet.metric_table(neg_dilep) > 0.4,
-                    axis=2,
-                    mask_identity=True,
-                )
-            ),
+            jetid
+            & (dr_clean(events.Jet, pos_dilep, 0.4, mask_identity=True))
+            & (dr_clean(events.Jet, neg_dilep, 0.4, mask_identity=True)),
             False,
             axis=-1,
         )
@@ -209,18 +205,20 @@ class NanoProcessor(processor.ProcessorABC):
         ## Jet cuts
         event_jet = events.Jet[
             ak.fill_none(
-                jet_id(events, self._campaign)
+                jetid
                 & (
-                    ak.all(
-                        events.Jet.metric_table(pos_dilep[:, 0]) > 0.4,
-                        axis=2,
+                    dr_clean(
+                        events.Jet,
+                        ak.singletons(pos_dilep[:, 0]),
+                        0.4,
                         mask_identity=True,
                     )
                 )
                 & (
-                    ak.all(
-                        events.Jet.metric_table(neg_dilep[:, 0]) > 0.4,
-                        axis=2,
+                    dr_clean(
+                        events.Jet,
+                        ak.singletons(neg_dilep[:, 0]),
+                        0.4,
                         mask_identity=True,
                     )
                 ),
@@ -243,15 +241,29 @@ class NanoProcessor(processor.ProcessorABC):
             req_lumi & req_trig & req_dilep & req_dilepmass & req_jets & req_metfilter,
             False,
         )
-        if len(events[event_level]) == 0:
+        selev = SelectedEvents(
+            events,
+            event_level,
+            ["PV.npvs"] if isRealData else ["PV.npvs", "genWeight", "Pileup.nTrueInt"],
+        )
+        if len(selev) == 0:
+            if not self.noHist:
+                output.update(
+                    histogrammer(
+                        events,
+                        histoname[self.selMod],
+                        ["nominal"] if isRealData else self.systematics,
+                    )
+                )
             if self.isArray:
                 array_writer(
                     self,
-                    events[event_level],
+                    selev.events,
                     events,
                     "nominal",
                     dataset,
                     isRealData,
+                    sumw,
                     empty=True,
                 )
             return {dataset: output}
@@ -262,7 +274,6 @@ class NanoProcessor(processor.ProcessorABC):
         sposmu = sposmu[:, 0]
         snegmu = neg_dilep[event_level]
         snegmu = snegmu[:, 0]
-        sz = sposmu + snegmu
         sjets = event_jet[event_level]
         sel_jet = sjets[:, 0]
         njet = ak.count(sjets.pt, axis=1)
@@ -276,27 +287,21 @@ class NanoProcessor(processor.ProcessorABC):
 
         # Find the PFCands associate with selected jets. Search from jetindex->JetPFCands->PFCand
         if "PFCands" in events.fields:
-            spfcands = events[event_level].PFCands[
-                events[event_level]
-                .JetPFCands[
-                    events[event_level].JetPFCands.jetIdx == jetindx[event_level]
-                ]
-                .pFCandsIdx
-            ]
+            spfcands = jet_pfcands(selev, jetindx[event_level])
 
         ####################
         # Weight & Geninfo #
         ####################
-        weights = Weights(len(events[event_level]), storeIndividual=True)
+        weights = Weights(len(selev), storeIndividual=True)
         if not isRealData:
-            weights.add("genweight", events[event_level].genWeight)
+            weights.add("genweight", selev["genWeight"])
             par_flav = (sel_jet.partonFlavour == 0) & (sel_jet.hadronFlavour == 0)
             genflavor = sel_jet.hadronFlavour + 1 * par_flav
             if len(self.SF_map.keys()) > 0:
                 syst_wei = True if self.isSyst != False else False
                 if "PU" in self.SF_map.keys():
                     puwei(
-                        events[event_level].Pileup.nTrueInt,
+                        selev["Pileup.nTrueInt"],
                         self.SF_map,
                         weights,
                         syst_wei,
@@ -328,119 +333,54 @@ class NanoProcessor(processor.ProcessorABC):
         ####################
         #  Fill histogram  #
         ####################
-        for syst in systematics:
-            if self.isSyst == False and syst != "nominal":
-                break
-            if self.noHist:
-                break
-            weight = (
-                weights.weight()
-                if syst == "nominal" or syst == shift_name
-                else weights.weight(modifier=syst)
-            )
-            for histname, h in output.items():
-                if (
-                    "Deep" in histname
-                    and "btag" not in histname
-                    and histname in events.Jet.fields
-                ):
-                    h.fill(
-                        syst,
-                        genflavor,
-                        sel_jet[histname],
-                        weight=weights.partial_weight(exclude=exclude_btv),
-                    )
-                elif (
-                    "PFCands" in events.fields
-                    and "PFCands" in histname
-                    and histname.split("_")[1] in events.PFCands.fields
-                ):
-                    h.fill(
-                        syst,
-                        flatten(ak.broadcast_arrays(genflavor, spfcands["pt"])[0]),
-                        flatten(spfcands[histname.replace("PFCands_", "")]),
-                        weight=flatten(
-                            ak.broadcast_arrays(
-                                weights.partial_weight(exclude=exclude_btv),
-                                spfcands["pt"],
-                            )[0]
-                        ),
-                    )
-                elif (
-                    "posl_" in histname
-                    and histname.replace("posl_", "") in sposmu.fields
-                ):
-                    h.fill(
-                        syst,
-                        flatten(sposmu[histname.replace("posl_", "")]),
-                        weight=weight,
-                    )
-                elif (
-                    "negl_" in histname
-                    and histname.replace("negl_", "") in snegmu.fields
-                ):
-                    h.fill(
-                        syst,
-                        flatten(snegmu[histname.replace("negl_", "")]),
-                        weight=weight,
-                    )
-
-                elif "jet_" in histname:
-                    h.fill(
-                        syst,
-                        genflavor,
-                        sel_jet[histname.replace("jet_", "")],
-                        weight=weight,
-                    )
-                elif (
-                    "btag" in histname
-                    and "0" in histname
-                    and histname.replace("_0", "") in events.Jet.fields
-                ):
-                    h.fill(
-                        syst="noSF",
-                        flav=genflavor,
-                        discr=np.where(
-                            sel_jet[histname.replace("_0", "")] < 0,
-                            -0.2,
-                            sel_jet[histname.replace("_0", "")],
-                        ),
-                        weight=weights.partial_weight(exclude=exclude_btv),
-                    )
-                    if not isRealData and "btag" in self.SF_map.keys():
-                        h.fill(
-                            syst=syst,
-                            flav=genflavor,
-                            discr=np.where(
-                                sel_jet[histname.replace("_0", "")] < 0,
-                                -0.2,
-                                sel_jet[histname.replace("_0", "")],
-                            ),
-                            weight=weight,
-                        )
-            output["njet"].fill(syst, njet, weight=weight)
-            output["dr_mumu"].fill(syst, snegmu.delta_r(sposmu), weight=weight)
-            output["z_pt"].fill(syst, flatten(sz.pt), weight=weight)
-            output["z_eta"].fill(syst, flatten(sz.eta), weight=weight)
-            output["z_phi"].fill(syst, flatten(sz.phi), weight=weight)
-            output["z_mass"].fill(syst, flatten(sz.mass), weight=weight)
-            output["npvs"].fill(
-                syst,
-                events[event_level].PV.npvs,
-                weight=weight,
+        hist_systematics = [
+            syst for syst in systematics if self.isSyst != False or syst == "nominal"
+        ]
+        if len(hist_systematics) > 0 and (not self.noHist or self.skim is not None):
+            # objects the histograms are filled from, also stored in the skim
+            objects = ak.zip(
+                {
+                    "Jet": sjets,
+                    "LeptonPlus": sposmu,
+                    "LeptonMinus": snegmu,
+                    "njet": njet,
+                    "genflavor": genflavor,
+                    "npvs": selev["PV.npvs"],
+                    "btv_weight": weights.partial_weight(exclude=exclude_btv),
+                    **({"PFCands": spfcands} if "PFCands" in events.fields else {}),
+                    **({} if isRealData else {"pu": selev["Pileup.nTrueInt"]}),
+                },
+                depth_limit=1,
             )
-            if not isRealData:
-                output["pu"].fill(
-                    syst,
-                    events[event_level].Pileup.nTrueInt,
-                    weight=weight,
+            # weights of all the systematics, each histogram is filled once
+            weight = syst_weights(weights, hist_systematics, shift_name)
+            if self.skim is not None:
+                self.skim.write(
+                    events.metadata,
+                    shift_name,
+                    objects,
+                    weight,
+                    hist_systematics,
+                    isRealData,
+                )
+            if not self.noHist:
+                output.update(
+                    self.fill_histograms(objects, weight, hist_systematics, isRealData)
+                )
+        elif not self.noHist:
+            output.update(
+                histogrammer(
+                    events,
+                    histoname[self.selMod],
+                    ["nominal"] if isRealData else self.systematics,
                 )
+            )
         #######################
         #  Create root files  #
         #######################
         if self.isArray:
             # Keep the structure of events and pruned the object size
-            pruned_ev = events[event_level]
+            pruned_ev = selev.events
             pruned_ev["SelJet"] = sjets
             pruned_ev["LeadJet"] = sel_jet
             if isMu:
@@ -477,11 +417,126 @@ class NanoProcessor(processor.ProcessorABC):
                 systematics[0],
                 dataset,
                 isRealData,
+                sumw,
                 kinOnly=kinOnly,
                 remove=kinOnly,
             )
 
         return {dataset: output}
 
+    def fill_histograms(self, objects, weight, hist_systematics, isRealData):
+        """histograms of the selected objects of a shift, from process_shift or the skim"""
+        output = histogrammer(
+            objects,
+            histoname[self.selMod],
+            ["nominal"] if isRealData else self.systematics,
+        )
+        sjets, sposmu, snegmu = objects.Jet, objects.LeptonPlus, objects.LeptonMinus
+        genflavor, btv_weight, njet = (
+            objects.genflavor,
+            objects.btv_weight,
+            objects.njet,
+        )
+        sel_jet = sjets[:, 0]
+        sz = sposmu + snegmu
+        for histname, h in output.items():
+            if (
+                "Deep" in histname
+                and "btag" not in histname
+                and histname in sjets.fields
+            ):
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    genflavor,
+                    sel_jet[histname],
+                    weight=btv_weight,
+                )
+            elif (
+                "PFCands" in objects.fields
+                and "PFCands" in histname
+                and histname.split("_")[1] in objects.PFCands.fields
+            ):
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    flatten(ak.broadcast_arrays(genflavor, objects.PFCands["pt"])[0]),
+                    flatten(objects.PFCands[histname.replace("PFCands_", "")]),
+                    weight=btv_weight,
+                    counts=ak.num(objects.PFCands),
+                )
+            elif "posl_" in histname and histname.replace("posl_", "") in sposmu.fields:
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    flatten(sposmu[histname.replace("posl_", "")]),
+                    weight=weight,
+                )
+            elif "negl_" in histname and histname.replace("negl_", "") in snegmu.fields:
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    flatten(snegmu[histname.replace("negl_", "")]),
+                    weight=weight,
+                )
+
+            elif "jet_" in histname:
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    genflavor,
+                    sel_jet[histname.replace("jet_", "")],
+                    weight=weight,
+                )
+            elif (
+                "btag" in histname
+                and "0" in histname
+                and histname.replace("_0", "") in sjets.fields
+            ):
+                discr = np.where(
+                    sel_jet[histname.replace("_0", "")] < 0,
+                    -0.2,
+                    sel_jet[histname.replace("_0", "")],
+                )
+                h.fill(
+                    syst="noSF",
+                    flav=genflavor,
+                    discr=discr,
+                    weight=btv_weight,
+                )
+                if not isRealData and "btag" in self.SF_map.keys():
+                    fill_syst(
+                        h,
+                        hist_systematics,
+                        flav=genflavor,
+                        discr=discr,
+                        weight=weight,
+                    )
+        fill_syst(output["njet"], hist_systematics, njet, weight=weight)
+        fill_syst(
+            output["dr_mumu"],
+            hist_systematics,
+            snegmu.delta_r(sposmu),
+            weight=weight,
+        )
+        fill_syst(output["z_pt"], hist_systematics, flatten(sz.pt), weight=weight)
+        fill_syst(output["z_eta"], hist_systematics, flatten(sz.eta), weight=weight)
+        fill_syst(output["z_phi"], hist_systematics, flatten(sz.phi), weight=weight)
+        fill_syst(output["z_mass"], hist_systematics, flatten(sz.mass), weight=weight)
+        fill_syst(
+            output["npvs"],
+            hist_systematics,
+            objects.npvs,
+            weight=weight,
+        )
+        if not isRealData:
+            fill_syst(
+                output["pu"],
+                hist_systematics,
+                objects.pu,
+                weight=weight,
+            )
+        return output
+
     def postprocess(self, accumulator):
         return accumulator
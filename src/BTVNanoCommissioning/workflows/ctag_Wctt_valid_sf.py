@@ -11,25 +11,49 @@ from BTVNanoCommissioning.utils.correction import (
     eleSFs,
     puwei,
     btagSFs,
-    JME_shifts,
-    Roccor_shifts,
+    common_shifts,
 )
 from BTVNanoCommissioning.helpers.func import (
+    SelectedEvents,
     flatten,
     update,
-    dump_lumi,
+    dump_sumw,
+    jet_pfcands,
 )
 from BTVNanoCommissioning.helpers.update_branch import missing_branch
-from BTVNanoCommissioning.utils.histogrammer import histogrammer
-from BTVNanoCommissioning.utils.array_writer import array_writer
+from BTVNanoCommissioning.utils.histogrammer import (
+    histogrammer,
+    syst_categories,
+    syst_weights,
+    fill_syst,
+)
+from BTVNanoCommissioning.utils.array_writer import (
+    array_writer,
+    flush_writers,
+    reset_writers,
+)
+from BTVNanoCommissioning.utils.reader import prefiltered
+from BTVNanoCommissioning.utils.trigger import trigger_mask
 from BTVNanoCommissioning.utils.selection import (
     jet_id,
     mu_idiso,
     ele_mvatightid,
     softmu_mask,
+    prefilter_mask,
+    dr_clean,
+    max_dr,
 )
 
 
+# histograms booked for each selection modifier
+histoname = {
+    "WcM": "ctag_Wc_sf",
+    "WcE": "ectag_Wc_sf",
+    "semittM": "ctag_Wc_sf",  # same histogram representation as W+c
+    "semittE": "ectag_Wc_sf",  # same histogram representation as W+c
+}
+
+
 class NanoProcessor(processor.ProcessorABC):
     def __init__(
         self,
@@ -50,67 +74,80 @@ class NanoProcessor(processor.ProcessorABC):
         self.noHist = noHist
         self.lumiMask = load_lumi(self._campaign)
         self.chunksize = chunksize
+        self.selection_index = None
+        self.skim = None
         ## Load corrections
         self.SF_map = load_SF(self._campaign)
         self.selMod = selectionModifier
+        if "WcM" in self.selMod or "semittM" in self.selMod:
+            self.triggers = ["IsoMu27", "IsoMu24"]
+        elif "WcE" in self.selMod or "semittE" in self.selMod:
+            self.triggers = ["Ele32_WPTight_Gsf_L1DoubleEG"]
+        else:
+            raise ValueError(self.selMod, "is not a valid selection modifier.")
+        lepton_sf = "MUO" if "WcM" in self.selMod or "semittM" in self.selMod else "EGM"
+        self.systematics = syst_categories(
+            self.SF_map, self.isSyst, ["PU", lepton_sf, "BTV"]
+        )
 
     @property
     def accumulator(self):
         return self._accumulator
 
     def process(self, events):
+        # a retried chunk does not keep the arrays of its failed attempt
+        reset_writers()
         isRealData = not hasattr(events, "genWeight")
         dataset = events.metadata["dataset"]
-        events = missing_branch(events)
-        shifts = []
-        if "JME" in self.SF_map.keys():
-            syst_JERC = self.isSyst
-            if self.isSyst == "JERC_split":
-                syst_JERC = "split"
-            shifts = JME_shifts(
-                shifts, self.SF_map, events, self._campaign, isRealData, syst_JERC
-            )
-        else:
-            if int(self._year) < 2020:
-                shifts = [
-                    ({"Jet": events.Jet, "MET": events.MET, "Muon": events.Muon}, None)
-                ]
-            else:
-                shifts = [
-                    (
-                        {
-                            "Jet": events.Jet,
-                            "MET": events.PuppiMET,
-                            "Muon": events.Muon,
-                        },
-                        None,
-                    )
-                ]
-        if "roccor" in self.SF_map.keys():
-            shifts = Roccor_shifts(shifts, self.SF_map, events, isRealData, False)
-        else:
-            shifts[0][0]["Muon"] = events.Muon
+        output = {dataset: dump_sumw(events, self.lumiMask)}
+        if self.skim is not None:
+            self.skim.write_summary(events.metadata, output[dataset])
+        events = missing_branch(
+            prefiltered(events, self.prefilter, self.selection_index)
+        )
+        # sum of weights of the whole chunk, the events are prefiltered
+        sumw = output[dataset]["sumw"]
+        shifts = common_shifts(
+            events, self.SF_map, self._campaign, self._year, isRealData, self.isSyst
+        )
+        output = processor.accumulate(
+            (
+                self.process_shift(update(events, collections), name, sumw)
+                for collections, name in shifts
+            ),
+            output,
+        )
+        # the chunk is only done once its root files are written
+        flush_writers()
+        return output
 
-        return processor.accumulate(
-            self.process_shift(update(events, collections), name)
-            for collections, name in shifts
+    def prefilter(self, events):
+        # shift-independent part of the selection, run before the corrections
+        if "WcM" in self.selMod or "semittM" in self.selMod:
+            iso_lep = mu_idiso(events, self._campaign)
+        else:
+            iso_lep = (events.Electron.pt > 34) & ele_mvatightid(events, self._campaign)
+        return prefilter_mask(
+            events,
+            self._campaign,
+            self.lumiMask if not hasattr(events, "genWeight") else None,
+            self.triggers,
+            nobjects=[(iso_lep, 1)],
         )
 
-    def process_shift(self, events, shift_name):
+    def process_shift(self, events, shift_name, sumw):
         dataset = events.metadata["dataset"]
         isRealData = not hasattr(events, "genWeight")
 
         isMu = False
         isEle = False
         if "WcM" in self.selMod or "semittM" in self.selMod:
-            triggers = ["IsoMu27", "IsoMu24"]
             isMu = True
             dxySigcut = 0  # 1
             muNeEmSum = 1  # 0.7
             muonpTratioCut = 1  # 0.4
             isolepdz, isolepdxy, isolepsip3d = 0.01, 0.002, 2
         elif "WcE" in self.selMod or "semittE" in self.selMod:
-            triggers = ["Ele32_WPTight_Gsf_L1DoubleEG"]
             isEle = True
             dxySigcut = 0
             muNeEmSum = 1
@@ -119,25 +156,8 @@ class NanoProcessor(processor.ProcessorABC):
         else:
             raise ValueError(self.selMod, "is not a valid selection modifier.")
 
-        histoname = {
-            "WcM": "ctag_Wc_sf",
-            "WcE": "ectag_Wc_sf",
-            "semittM": "ctag_Wc_sf",  # same histogram representation as W+c
-            "semittE": "ectag_Wc_sf",  # same histogram representation as W+c
-        }
-        _hist_event_dict = (
-            {"": None} if self.noHist else histogrammer(events, histoname[self.selMod])
-        )
-
-        output = {
-            "sumw": processor.defaultdict_accumulator(float),
-            **_hist_event_dict,
-        }
+        output = {}
 
-        if isRealData:
-            output["sumw"] = len(events)
-        else:
-            output["sumw"] = ak.sum(events.genWeight)
         ####################
         #    Selections    #
         ####################
@@ -145,53 +165,32 @@ class NanoProcessor(processor.ProcessorABC):
         req_lumi = np.ones(len(events), dtype="bool")
         if isRealData:
             req_lumi = self.lumiMask(events.run, events.luminosityBlock)
-        # only dump for nominal case
-        if shift_name is None:
-            output = dump_lumi(events[req_lumi], output)
 
         ## HLT
-        checkHLT = ak.Array([hasattr(events.HLT, _trig) for _trig in triggers])
-        if ak.all(checkHLT == False):
-            raise ValueError("HLT paths:", triggers, " are all invalid in", dataset)
-        elif ak.any(checkHLT == False):
-            print(np.array(triggers)[~checkHLT], " not exist in", dataset)
-        trig_arrs = [
-            events.HLT[_trig] for _trig in triggers if hasattr(events.HLT, _trig)
-        ]
-        req_trig = np.zeros(len(events), dtype="bool")
-        for t in trig_arrs:
-            req_trig = req_trig | t
+        req_trig = trigger_mask(events, self.triggers)
 
         ## Lepton cuts
+        mu_id = mu_idiso(events, self._campaign)
+        ele_id = ele_mvatightid(events, self._campaign)
         if isMu:
             # muon twiki: https://twiki.cern.ch/twiki/bin/view/CMS/SWGuideMuonIdRun2
-            iso_lep = events.Muon[
-                (events.Muon.pt > 30) & mu_idiso(events, self._campaign)
-            ]
+            iso_lepsel = (events.Muon.pt > 30) & mu_id
+            iso_lep = events.Muon[iso_lepsel]
         elif isEle:
-            iso_lep = events.Electron[
-                (events.Electron.pt > 34) & ele_mvatightid(events, self._campaign)
-            ]
+            iso_lepsel = (events.Electron.pt > 34) & ele_id
+            iso_lep = events.Electron[iso_lepsel]
         req_lep = ak.count(iso_lep.pt, axis=1) == 1
         jet_sel = ak.fill_none(
-            jet_id(events, self._campaign)
-            & (ak.all(events.Jet.metric_table(iso_lep) > 0.5, axis=2)),
+            jet_id(events, self._campaign) & (dr_clean(events.Jet, iso_lep, 0.5)),
             False,
             axis=-1,
         )
         iso_lep = ak.pad_none(iso_lep, 1, axis=1)
         iso_lep = iso_lep[:, 0]
         if isMu:
-            iso_lepindx = ak.mask(
-                ak.local_index(events.Muon.pt),
-                ((events.Muon.pt > 30) & mu_idiso(events, self._campaign)) == 1,
-            )
+            iso_lepindx = ak.mask(ak.local_index(events.Muon.pt), iso_lepsel == 1)
         elif isEle:
-            iso_lepindx = ak.mask(
-                ak.local_index(events.Electron.pt),
-                ((events.Electron.pt > 34) & ele_mvatightid(events, self._campaign))
-                == 1,
-            )
+            iso_lepindx = ak.mask(ak.local_index(events.Electron.pt), iso_lepsel == 1)
         iso_lepindx = ak.pad_none(iso_lepindx, 1)
         iso_lepindx = iso_lepindx[:, 0]
 
@@ -211,9 +210,11 @@ class NanoProcessor(processor.ProcessorABC):
             & (abs(events.Muon.dxy / events.Muon.dxyErr) > dxySigcut)
         ]
         req_softmu = ak.count(soft_muon.pt, axis=1) >= 1
+        # deltaR to the farthest soft muon, -inf without any, for all the jets
+        softmu_dr = max_dr(events.Jet, soft_muon)
         mujetsel = ak.fill_none(
             (
-                (ak.all(event_jet.metric_table(soft_muon) <= 0.4, axis=2))
+                (softmu_dr[jet_sel] <= 0.4)
                 & ((event_jet.muonIdx1 != -1) | (event_jet.muonIdx2 != -1))
                 & ((event_jet.muEF + event_jet.neEmEF) < muNeEmSum)
                 & (event_jet.pt > 20)
@@ -225,13 +226,7 @@ class NanoProcessor(processor.ProcessorABC):
         mujetsel2 = ak.fill_none(
             (
                 ((events.Jet.muEF + events.Jet.neEmEF) < muNeEmSum)
-                & (
-                    ak.all(
-                        events.Jet.metric_table(soft_muon) <= 0.4,
-                        axis=2,
-                        mask_identity=True,
-                    )
-                )
+                & ((softmu_dr <= 0.4) & (softmu_dr > -np.inf))
                 & ((events.Jet.muonIdx1 != -1) | (events.Jet.muonIdx2 != -1))
             ),
             False,
@@ -275,10 +270,8 @@ class NanoProcessor(processor.ProcessorABC):
         # )
         # )
 
-        dilep_mu = events.Muon[(events.Muon.pt > 12) & mu_idiso(events, self._campaign)]
-        dilep_ele = events.Electron[
-            (events.Electron.pt > 15) & ele_mvatightid(events, self._campaign)
-        ]
+        dilep_mu = events.Muon[(events.Muon.pt > 12) & mu_id]
+        dilep_ele = events.Electron[(events.Electron.pt > 15) & ele_id]
         req_dilepveto = (
             ak.count(dilep_mu.pt, axis=1) + ak.count(dilep_ele.pt, axis=1) != 2
         )
@@ -349,15 +342,29 @@ class NanoProcessor(processor.ProcessorABC):
             & req_pTratio
         )
         event_level = ak.fill_none(event_level, False)
-        if len(events[event_level]) == 0:
+        selev = SelectedEvents(
+            events,
+            event_level,
+            ["PV.npvs"] if isRealData else ["PV.npvs", "genWeight", "Pileup.nTrueInt"],
+        )
+        if len(selev) == 0:
+            if not self.noHist:
+                output.update(
+                    histogrammer(
+                        events,
+                        histoname[self.selMod],
+                        ["nominal"] if isRealData else self.systematics,
+                    )
+                )
             if self.isArray:
                 array_writer(
                     self,
-                    events[event_level],
+                    selev.events,
                     events,
                     "nominal",
                     dataset,
                     isRealData,
+                    sumw,
                     empty=True,
                 )
             return {dataset: output}
@@ -378,8 +385,6 @@ class NanoProcessor(processor.ProcessorABC):
         nmujet = ak.count(smuon_jet.pt, axis=1)
         smuon_jet = smuon_jet[:, 0]
         ssmu = ssmu[:, 0]
-        sz = shmu + ssmu
-        sw = shmu + smet
 
         osss = 1
         ossswrite = shmu.charge * ssmu.charge * -1
@@ -389,20 +394,14 @@ class NanoProcessor(processor.ProcessorABC):
         njet = ak.count(sjets.pt, axis=1)
         # Find the PFCands associate with selected jets. Search from jetindex->JetPFCands->PFCand
         if "PFCands" in events.fields:
-            spfcands = events[event_level].PFCands[
-                events[event_level]
-                .JetPFCands[
-                    events[event_level].JetPFCands.jetIdx == jetindx[event_level]
-                ]
-                .pFCandsIdx
-            ]
+            spfcands = jet_pfcands(selev, jetindx[event_level])
 
         ####################
         # Weight & Geninfo #
         ####################
-        weights = Weights(len(events[event_level]), storeIndividual=True)
+        weights = Weights(len(selev), storeIndividual=True)
         if not isRealData:
-            weights.add("genweight", events[event_level].genWeight)
+            weights.add("genweight", selev["genWeight"])
             genflavor = sjets.hadronFlavour + 1 * (
                 (sjets.partonFlavour == 0) & (sjets.hadronFlavour == 0)
             )
@@ -413,7 +412,7 @@ class NanoProcessor(processor.ProcessorABC):
                 syst_wei = True if self.isSyst != False else False
                 if "PU" in self.SF_map.keys():
                     puwei(
-                        events[event_level].Pileup.nTrueInt,
+                        selev["Pileup.nTrueInt"],
                         self.SF_map,
                         weights,
                         syst_wei,
@@ -447,191 +446,60 @@ class NanoProcessor(processor.ProcessorABC):
         ####################
         #  Fill histogram  #
         ####################
-        for syst in systematics:
-            if self.isSyst == False and syst != "nominal":
-                break
-            if self.noHist:
-                break
-            weight = (
-                weights.weight()
-                if syst == "nominal" or syst == shift_name
-                else weights.weight(modifier=syst)
-            )
-            for histname, h in output.items():
-                if (
-                    "Deep" in histname
-                    and "btag" not in histname
-                    and histname in events.Jet.fields
-                ):
-                    h.fill(
-                        syst,
-                        flatten(genflavor),
-                        flatten(ak.broadcast_arrays(osss, sjets["pt"])[0]),
-                        flatten(sjets[histname]),
-                        weight=flatten(
-                            ak.broadcast_arrays(
-                                weights.partial_weight(exclude=exclude_btv), sjets["pt"]
-                            )[0]
-                        ),
-                    )
-                elif (
-                    "PFCands" in events.fields
-                    and "PFCands" in histname
-                    and histname.split("_")[1] in events.PFCands.fields
-                ):
-                    h.fill(
-                        syst,
-                        flatten(ak.broadcast_arrays(smflav, spfcands["pt"])[0]),
-                        flatten(ak.broadcast_arrays(osss, spfcands["pt"])[0]),
-                        flatten(spfcands[histname.replace("PFCands_", "")]),
-                        weight=flatten(
-                            ak.broadcast_arrays(
-                                weights.partial_weight(exclude=exclude_btv),
-                                spfcands["pt"],
-                            )[0]
-                        ),
-                    )
-                elif "jet_" in histname and "mu" not in histname:
-                    h.fill(
-                        syst,
-                        flatten(genflavor),
-                        flatten(ak.broadcast_arrays(osss, sjets["pt"])[0]),
-                        flatten(sjets[histname.replace("jet_", "")]),
-                        weight=flatten(ak.broadcast_arrays(weight, sjets["pt"])[0]),
-                    )
-                elif "hl_" in histname and histname.replace("hl_", "") in shmu.fields:
-                    h.fill(
-                        syst,
-                        osss,
-                        flatten(shmu[histname.replace("hl_", "")]),
-                        weight=weight,
-                    )
-                elif (
-                    "soft_l" in histname
-                    and histname.replace("soft_l_", "") in ssmu.fields
-                ):
-                    h.fill(
-                        syst,
-                        smflav,
-                        osss,
-                        flatten(ssmu[histname.replace("soft_l_", "")]),
-                        weight=weight,
-                    )
-                elif "mujet_" in histname:
-                    h.fill(
-                        syst,
-                        smflav,
-                        osss,
-                        flatten(smuon_jet[histname.replace("mujet_", "")]),
-                        weight=weight,
-                    )
-                elif "btag" in histname and "Trans" not in histname:
-                    for i in range(2):
-                        if (
-                            str(i) not in histname
-                            or histname.replace(f"_{i}", "") not in events.Jet.fields
-                        ):
-                            continue
-                        h.fill(
-                            syst="noSF",
-                            flav=smflav,
-                            osss=osss,
-                            discr=np.where(
-                                smuon_jet[histname.replace(f"_{i}", "")] < 0,
-                                -0.2,
-                                smuon_jet[histname.replace(f"_{i}", "")],
-                            ),
-                            weight=weights.partial_weight(exclude=exclude_btv),
-                        )
-                        if not isRealData and "btag" in self.SF_map.keys():
-                            h.fill(
-                                syst=syst,
-                                flav=smflav,
-                                osss=osss,
-                                discr=np.where(
-                                    smuon_jet[histname.replace(f"_{i}", "")] < 0,
-                                    -0.2,
-                                    smuon_jet[histname.replace(f"_{i}", "")],
-                                ),
-                                weight=weight,
-                            )
-                elif "btag" in histname and "Trans" in histname:
-                    if histname not in smuon_jet:
-                        continue
-                    for i in range(2):
-                        histname = histname.replace("Trans", "").replace(f"_{i}", "")
-                        h.fill(
-                            syst="noSF",
-                            flav=smflav,
-                            osss=osss,
-                            discr=1.0 / np.tanh(smuon_jet[histname]),
-                            weight=weights.partial_weight(exclude=exclude_btv),
-                        )
-
-            output["njet"].fill(syst, osss, njet, weight=weight)
-            output["nmujet"].fill(syst, osss, nmujet, weight=weight)
-            output["nsoftmu"].fill(syst, osss, nsoftmu, weight=weight)
-            output["hl_ptratio"].fill(
-                syst,
-                genflavor[:, 0],
-                osss=osss,
-                ratio=shmu.pt / sjets[:, 0].pt,
-                weight=weight,
-            )
-            output["soft_l_ptratio"].fill(
-                syst,
-                flav=smflav,
-                osss=osss,
-                ratio=ssmu.pt / smuon_jet.pt,
-                weight=weight,
-            )
-            output["dr_lmujetsmu"].fill(
-                syst,
-                flav=smflav,
-                osss=osss,
-                dr=smuon_jet.delta_r(ssmu),
-                weight=weight,
-            )
-            output["dr_lmujethmu"].fill(
-                syst,
-                flav=smflav,
-                osss=osss,
-                dr=smuon_jet.delta_r(shmu),
-                weight=weight,
-            )
-            output["dr_lmusmu"].fill(
-                syst,
-                osss=osss,
-                dr=shmu.delta_r(ssmu),
-                weight=weight,
-            )
-            output["z_pt"].fill(syst, osss, flatten(sz.pt), weight=weight)
-            output["z_eta"].fill(syst, osss, flatten(sz.eta), weight=weight)
-            output["z_phi"].fill(syst, osss, flatten(sz.phi), weight=weight)
-            output["z_mass"].fill(syst, osss, flatten(sz.mass), weight=weight)
-            output["w_pt"].fill(syst, osss, flatten(sw.pt), weight=weight)
-            output["w_eta"].fill(syst, osss, flatten(sw.eta), weight=weight)
-            output["w_phi"].fill(syst, osss, flatten(sw.phi), weight=weight)
-            output["w_mass"].fill(syst, osss, flatten(sw.mass), weight=weight)
-            output["MET_pt"].fill(syst, osss, flatten(smet.pt), weight=weight)
-            output["MET_phi"].fill(syst, osss, flatten(smet.phi), weight=weight)
-            output["npvs"].fill(
-                syst,
-                events[event_level].PV.npvs,
-                weight=weight,
+        hist_systematics = [
+            syst for syst in systematics if self.isSyst != False or syst == "nominal"
+        ]
+        if len(hist_systematics) > 0 and (not self.noHist or self.skim is not None):
+            # objects the histograms are filled from, also stored in the skim
+            objects = ak.zip(
+                {
+                    "Jet": sjets,
+                    "Lepton": shmu,
+                    "SoftMuon": ssmu,
+                    "MuonJet": smuon_jet,
+                    "MET": smet,
+                    "njet": njet,
+                    "nmujet": nmujet,
+                    "nsoftmu": nsoftmu,
+                    "osss": osss * np.ones(len(selev), dtype=int),
+                    "genflavor": genflavor,
+                    "mujet_flavor": smflav,
+                    "npvs": selev["PV.npvs"],
+                    "btv_weight": weights.partial_weight(exclude=exclude_btv),
+                    **({"PFCands": spfcands} if "PFCands" in events.fields else {}),
+                    **({} if isRealData else {"pu": selev["Pileup.nTrueInt"]}),
+                },
+                depth_limit=1,
             )
-            if not isRealData:
-                output["pu"].fill(
-                    syst,
-                    events[event_level].Pileup.nTrueInt,
-                    weight=weight,
+            # weights of all the systematics, each histogram is filled once
+            weight = syst_weights(weights, hist_systematics, shift_name)
+            if self.skim is not None:
+                self.skim.write(
+                    events.metadata,
+                    shift_name,
+                    objects,
+                    weight,
+                    hist_systematics,
+                    isRealData,
+                )
+            if not self.noHist:
+                output.update(
+                    self.fill_histograms(objects, weight, hist_systematics, isRealData)
                 )
+        elif not self.noHist:
+            output.update(
+                histogrammer(
+                    events,
+                    histoname[self.selMod],
+                    ["nominal"] if isRealData else self.systematics,
+                )
+            )
         #######################
         #  Create root files  #
         #######################
         if self.isArray:
             # Keep the structure of events and pruned the object size
-            pruned_ev = events[event_level]
+            pruned_ev = selev.events
             pruned_ev["SelJet"] = sjets
             pruned_ev["Muon"] = shmu
             pruned_ev["MuonJet"] = smuon_jet
@@ -664,9 +532,232 @@ class NanoProcessor(processor.ProcessorABC):
             pruned_ev["MuonJet_beta"] = smuon_jet.pt / smuon_jet.E
             pruned_ev["MuonJet_muneuEF"] = smuon_jet.muEF + smuon_jet.neEmEF
 
-            array_writer(self, pruned_ev, events, systematics[0], dataset, isRealData)
+            array_writer(
+                self, pruned_ev, events, systematics[0], dataset, isRealData, sumw
+            )
 
         return {dataset: output}
 
+    def fill_histograms(self, objects, weight, hist_systematics, isRealData):
+        """histograms of the selected objects of a shift, from process_shift or the skim"""
+        output = histogrammer(
+            objects,
+            histoname[self.selMod],
+            ["nominal"] if isRealData else self.systematics,
+        )
+        sjets, shmu, ssmu = objects.Jet, objects.Lepton, objects.SoftMuon
+        smuon_jet, smet, osss = objects.MuonJet, objects.MET, objects.osss
+        njet, nmujet, nsoftmu = objects.njet, objects.nmujet, objects.nsoftmu
+        genflavor, smflav = objects.genflavor, objects.mujet_flavor
+        btv_weight = objects.btv_weight
+        sz = shmu + ssmu
+        sw = shmu + smet
+        for histname, h in output.items():
+            if (
+                "Deep" in histname
+                and "btag" not in histname
+                and histname in sjets.fields
+            ):
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    flatten(genflavor),
+                    flatten(ak.broadcast_arrays(osss, sjets["pt"])[0]),
+                    flatten(sjets[histname]),
+                    weight=btv_weight,
+                    counts=ak.num(sjets),
+                )
+            elif (
+                "PFCands" in objects.fields
+                and "PFCands" in histname
+                and histname.split("_")[1] in objects.PFCands.fields
+            ):
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    flatten(ak.broadcast_arrays(smflav, objects.PFCands["pt"])[0]),
+                    flatten(ak.broadcast_arrays(osss, objects.PFCands["pt"])[0]),
+                    flatten(objects.PFCands[histname.replace("PFCands_", "")]),
+                    weight=btv_weight,
+                    counts=ak.num(objects.PFCands),
+                )
+            elif "jet_" in histname and "mu" not in histname:
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    flatten(genflavor),
+                    flatten(ak.broadcast_arrays(osss, sjets["pt"])[0]),
+                    flatten(sjets[histname.replace("jet_", "")]),
+                    weight=weight,
+                    counts=ak.num(sjets),
+                )
+            elif "hl_" in histname and histname.replace("hl_", "") in shmu.fields:
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    osss,
+                    flatten(shmu[histname.replace("hl_", "")]),
+                    weight=weight,
+                )
+            elif (
+                "soft_l" in histname and histname.replace("soft_l_", "") in ssmu.fields
+            ):
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    smflav,
+                    osss,
+                    flatten(ssmu[histname.replace("soft_l_", "")]),
+                    weight=weight,
+                )
+            elif "mujet_" in histname:
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    smflav,
+                    osss,
+                    flatten(smuon_jet[histname.replace("mujet_", "")]),
+                    weight=weight,
+                )
+            elif "btag" in histname and "Trans" not in histname:
+                for i in range(2):
+                    if (
+                        str(i) not in histname
+                        or histname.replace(f"_{i}", "") not in sjets.fields
+                    ):
+                        continue
+                    discr = np.where(
+                        smuon_jet[histname.replace(f"_{i}", "")] < 0,
+                        -0.2,
+                        smuon_jet[histname.replace(f"_{i}", "")],
+                    )
+                    h.fill(
+                        syst="noSF",
+                        flav=smflav,
+                        osss=osss,
+                        discr=discr,
+                        weight=btv_weight,
+                    )
+                    if not isRealData and "btag" in self.SF_map.keys():
+                        fill_syst(
+                            h,
+                            hist_systematics,
+                            flav=smflav,
+                            osss=osss,
+                            discr=discr,
+                            weight=weight,
+                        )
+            elif "btag" in histname and "Trans" in histname:
+                if histname not in smuon_jet:
+                    continue
+                for i in range(2):
+                    histname = histname.replace("Trans", "").replace(f"_{i}", "")
+                    h.fill(
+                        syst="noSF",
+                        flav=smflav,
+                        osss=osss,
+                        discr=1.0 / np.tanh(smuon_jet[histname]),
+                        weight=btv_weight,
+                    )
+
+        fill_syst(output["njet"], hist_systematics, osss, njet, weight=weight)
+        fill_syst(output["nmujet"], hist_systematics, osss, nmujet, weight=weight)
+        fill_syst(output["nsoftmu"], hist_systematics, osss, nsoftmu, weight=weight)
+        fill_syst(
+            output["hl_ptratio"],
+            hist_systematics,
+            genflavor[:, 0],
+            osss=osss,
+            ratio=shmu.pt / sjets[:, 0].pt,
+            weight=weight,
+        )
+        fill_syst(
+            output["soft_l_ptratio"],
+            hist_systematics,
+            flav=smflav,
+            osss=osss,
+            ratio=ssmu.pt / smuon_jet.pt,
+            weight=weight,
+        )
+        fill_syst(
+            output["dr_lmujetsmu"],
+            hist_systematics,
+            flav=smflav,
+            osss=osss,
+            dr=smuon_jet.delta_r(ssmu),
+            weight=weight,
+        )
+        fill_syst(
+            output["dr_lmujethmu"],
+            hist_systematics,
+            flav=smflav,
+            osss=osss,
+            dr=smuon_jet.delta_r(shmu),
+            weight=weight,
+        )
+        fill_syst(
+            output["dr_lmusmu"],
+            hist_systematics,
+            osss=osss,
+            dr=shmu.delta_r(ssmu),
+            weight=weight,
+        )
+        fill_syst(output["z_pt"], hist_systematics, osss, flatten(sz.pt), weight=weight)
+        fill_syst(
+            output["z_eta"], hist_systematics, osss, flatten(sz.eta), weight=weight
+        )
+        fill_syst(
+            output["z_phi"], hist_systematics, osss, flatten(sz.phi), weight=weight
+        )
+        fill_syst(
+            output["z_mass"],
+            hist_systematics,
+            osss,
+            flatten(sz.mass),
+            weight=weight,
+        )
+        fill_syst(output["w_pt"], hist_systematics, osss, flatten(sw.pt), weight=weight)
+        fill_syst(
+            output["w_eta"], hist_systematics, osss, flatten(sw.eta), weight=weight
+        )
+        fill_syst(
+            output["w_phi"], hist_systematics, osss, flatten(sw.phi), weight=weight
+        )
+        fill_syst(
+            output["w_mass"],
+            hist_systematics,
+            osss,
+            flatten(sw.mass),
+            weight=weight,
+        )
+        fill_syst(
+            output["MET_pt"],
+            hist_systematics,
+            osss,
+            flatten(smet.pt),
+            weight=weight,
+        )
+        fill_syst(
+            output["MET_phi"],
+            hist_systematics,
+            osss,
+            flatten(smet.phi),
+            weight=weight,
+        )
+        fill_syst(
+            output["npvs"],
+            hist_systematics,
+            objects.npvs,
+            weight=weight,
+        )
+        if not isRealData:
+            fill_syst(
+                output["pu"],
+                hist_systematics,
+                objects.pu,
+                weight=weight,
+            )
+        return output
+
     def postprocess(self, accumulator):
         return accumulator
@@ -11,26 +11,48 @@ from BTVNanoCommissioning.utils.correction import (
     eleSFs,
     puwei,
     btagSFs,
-    JME_shifts,
-    Roccor_shifts,
+    common_shifts,
 )
 
 from BTVNanoCommissioning.helpers.func import (
+    SelectedEvents,
     flatten,
     update,
-    dump_lumi,
+    dump_sumw,
+    jet_pfcands,
 )
 from BTVNanoCommissioning.helpers.update_branch import missing_branch
-from BTVNanoCommissioning.utils.histogrammer import histogrammer
-from BTVNanoCommissioning.utils.array_writer import array_writer
+from BTVNanoCommissioning.utils.histogrammer import (
+    histogrammer,
+    syst_categories,
+    syst_weights,
+    fill_syst,
+)
+from BTVNanoCommissioning.utils.array_writer import (
+    array_writer,
+    flush_writers,
+    reset_writers,
+)
+from BTVNanoCommissioning.utils.reader import prefiltered
+from BTVNanoCommissioning.utils.trigger import trigger_mask
 from BTVNanoCommissioning.utils.selection import (
     jet_id,
     mu_idiso,
     ele_mvatightid,
     softmu_mask,
+    prefilter_mask,
+    dr_clean,
+    dr_matched,
 )
 
 
+# histograms booked for each selection modifier
+histoname = {
+    "dilepttM": "ctag_ttdilep_sf",
+    "dilepttE": "ectag_ttdilep_sf",
+}
+
+
 class NanoProcessor(processor.ProcessorABC):
     def __init__(
         self,
@@ -51,53 +73,66 @@ class NanoProcessor(processor.ProcessorABC):
         self.noHist = noHist
         self.lumiMask = load_lumi(self._campaign)
         self.chunksize = chunksize
+        self.selection_index = None
+        self.skim = None
         self.selMod = selectionModifier
+        if self.selMod == "dilepttM":
+            self.triggers = ["Mu17_TrkIsoVVL_Mu8_TrkIsoVVL_DZ_Mass8"]
+        elif self.selMod == "dilepttE":
+            self.triggers = ["Ele23_Ele12_CaloIdL_TrackIdL_IsoVL"]
         ## Load corrections
         self.SF_map = load_SF(self._campaign)
+        lepton_sf = {"dilepttM": ["MUO"], "dilepttE": ["EGM"]}.get(self.selMod, [])
+        self.systematics = syst_categories(
+            self.SF_map, self.isSyst, ["PU", "BTV"] + lepton_sf
+        )
 
     @property
     def accumulator(self):
         return self._accumulator
 
     def process(self, events):
+        # a retried chunk does not keep the arrays of its failed attempt
+        reset_writers()
         isRealData = not hasattr(events, "genWeight")
         dataset = events.metadata["dataset"]
-        events = missing_branch(events)
-        shifts = []
-        if "JME" in self.SF_map.keys():
-            syst_JERC = self.isSyst
-            if self.isSyst == "JERC_split":
-                syst_JERC = "split"
-            shifts = JME_shifts(
-                shifts, self.SF_map, events, self._campaign, isRealData, syst_JERC
-            )
-        else:
-            if int(self._year) < 2020:
-                shifts = [
-                    ({"Jet": events.Jet, "MET": events.MET, "Muon": events.Muon}, None)
-                ]
-            else:
-                shifts = [
-                    (
-                        {
-                            "Jet": events.Jet,
-                            "MET": events.PuppiMET,
-                            "Muon": events.Muon,
-                        },
-                        None,
-                    )
-                ]
-        if "roccor" in self.SF_map.keys():
-            shifts = Roccor_shifts(shifts, self.SF_map, events, isRealData, False)
-        else:
-            shifts[0][0]["Muon"] = events.Muon
+        output = {dataset: dump_sumw(events, self.lumiMask)}
+        if self.skim is not None:
+            self.skim.write_summary(events.metadata, output[dataset])
+        events = missing_branch(
+            prefiltered(events, self.prefilter, self.selection_index)
+        )
+        # sum of weights of the whole chunk, the events are prefiltered
+        sumw = output[dataset]["sumw"]
+        shifts = common_shifts(
+            events, self.SF_map, self._campaign, self._year, isRealData, self.isSyst
+        )
+        output = processor.accumulate(
+            (
+                self.process_shift(update(events, collections), name, sumw)
+                for collections, name in shifts
+            ),
+            output,
+        )
+        # the chunk is only done once its root files are written
+        flush_writers()
+        return output
 
-        return processor.accumulate(
-            self.process_shift(update(events, collections), name)
-            for collections, name in shifts
+    def prefilter(self, events):
+        # shift-independent part of the selection, run before the corrections
+        if self.selMod == "dilepttM":
+            iso_lep = mu_idiso(events, self._campaign)
+        elif self.selMod == "dilepttE":
+            iso_lep = (events.Electron.pt > 25) & ele_mvatightid(events, self._campaign)
+        return prefilter_mask(
+            events,
+            self._campaign,
+            self.lumiMask if not hasattr(events, "genWeight") else None,
+            self.triggers,
+            nobjects=[(iso_lep, 2)],
         )
 
-    def process_shift(self, events, shift_name):
+    def process_shift(self, events, shift_name, sumw):
         dataset = events.metadata["dataset"]
         isRealData = not hasattr(events, "genWeight")
 
@@ -110,21 +145,7 @@ class NanoProcessor(processor.ProcessorABC):
             req_lumi = self.lumiMask(events.run, events.luminosityBlock)
 
         ## HLT
-        if self.selMod == "dilepttM":
-            triggers = ["Mu17_TrkIsoVVL_Mu8_TrkIsoVVL_DZ_Mass8"]
-        elif self.selMod == "dilepttE":
-            triggers = ["Ele23_Ele12_CaloIdL_TrackIdL_IsoVL"]
-        checkHLT = ak.Array([hasattr(events.HLT, _trig) for _trig in triggers])
-        if ak.all(checkHLT == False):
-            raise ValueError("HLT paths:", triggers, " are all invalid in", dataset)
-        elif ak.any(checkHLT == False):
-            print(np.array(triggers)[~checkHLT], " not exist in", dataset)
-        trig_arrs = [
-            events.HLT[_trig] for _trig in triggers if hasattr(events.HLT, _trig)
-        ]
-        req_trig = np.zeros(len(events), dtype="bool")
-        for t in trig_arrs:
-            req_trig = req_trig | t
+        req_trig = trigger_mask(events, self.triggers)
 
         # Lepton selections
         if self.selMod == "dilepttM":
@@ -158,32 +179,25 @@ class NanoProcessor(processor.ProcessorABC):
             (dilep_mass.mass < 75) | (dilep_mass.mass > 105)
         )
         ## Jet cuts
-        event_jet = events.Jet[
-            ak.fill_none(
-                jet_id(events, self._campaign)
-                & ak.all(
-                    events.Jet.metric_table(iso_lep) > 0.4, axis=2, mask_identity=True
-                ),
-                False,
-                axis=-1,
-            )
-        ]
+        jetid = jet_id(events, self._campaign)
+        jet_sel = ak.fill_none(
+            jetid & dr_clean(events.Jet, iso_lep, 0.4, mask_identity=True),
+            False,
+            axis=-1,
+        )
+        event_jet = events.Jet[jet_sel]
         req_jets = ak.count(event_jet.pt, axis=1) >= 2
 
         ## Soft Muon cuts
         soft_muon = events.Muon[softmu_mask(events, self._campaign)]
         req_softmu = ak.count(soft_muon.pt, axis=1) >= 1
+        # for all the jets, the selected ones take their subset
+        softmu_matched = dr_matched(events.Jet, soft_muon, 0.4, mask_identity=True)
 
         ## Muon jet cuts
         mu_jet = events.Jet[
             ak.fill_none(
-                (
-                    ak.all(
-                        event_jet.metric_table(soft_muon) <= 0.4,
-                        axis=2,
-                        mask_identity=True,
-                    )
-                )
+                (softmu_matched[jet_sel])
                 & ((event_jet.muonIdx1 != -1) | (event_jet.muonIdx2 != -1)),
                 False,
                 axis=-1,
@@ -196,14 +210,8 @@ class NanoProcessor(processor.ProcessorABC):
         jetindx = ak.mask(
             ak.local_index(events.Jet.pt),
             (
-                jet_id(events, self._campaign)
-                & (
-                    ak.all(
-                        events.Jet.metric_table(soft_muon) <= 0.4,
-                        axis=2,
-                        mask_identity=True,
-                    )
-                )
+                jetid
+                & (softmu_matched)
                 & ((events.Jet.muonIdx1 != -1) | (events.Jet.muonIdx2 != -1))
             )
             == 1,
@@ -234,35 +242,30 @@ class NanoProcessor(processor.ProcessorABC):
             & req_mujet
         )
         event_level = ak.fill_none(event_level, False)
-        histname = {
-            "dilepttM": "ctag_ttdilep_sf",
-            "dilepttE": "ectag_ttdilep_sf",
-        }
-        _hist_event_dict = (
-            {"": None} if self.noHist else histogrammer(events, histname[self.selMod])
+        output = {}
+        selev = SelectedEvents(
+            events,
+            event_level,
+            ["PV.npvs"] if isRealData else ["PV.npvs", "genWeight", "Pileup.nTrueInt"],
         )
-
-        output = {
-            "sumw": processor.defaultdict_accumulator(float),
-            **_hist_event_dict,
-        }
-        if shift_name is None:
-            if isRealData:
-                output["sumw"] = len(events)
-            else:
-                output["sumw"] = ak.sum(events.genWeight)
-        # only dump for nominal case
-        if shift_name is None:
-            output = dump_lumi(events[req_lumi], output)
-        if len(events[event_level]) == 0:
+        if len(selev) == 0:
+            if not self.noHist:
+                output.update(
+                    histogrammer(
+                        events,
+                        histoname[self.selMod],
+                        ["nominal"] if isRealData else self.systematics,
+                    )
+                )
             if self.isArray:
                 array_writer(
                     self,
-                    events[event_level],
+                    selev.events,
                     events,
                     "nominal",
                     dataset,
                     isRealData,
+                    sumw,
                     empty=True,
                 )
             return {dataset: output}
@@ -273,11 +276,6 @@ class NanoProcessor(processor.ProcessorABC):
         shlep = iso_lep[event_level]
         ssmu = soft_muon[event_level]
         nsoftmu = ak.count(ssmu.pt, axis=1)
-        softmu0 = ssmu
-        softmu0 = ssmu[:, 0]
-        sz = shlep[:, 0] + shlep[:, 1]
-        isomu0 = shlep[:, 0]
-        isomu1 = shlep[:, 1]
         sjets = event_jet[event_level]
         smuon_jet = mu_jet[event_level]
         nmujet = ak.count(smuon_jet.pt, axis=1)
@@ -287,20 +285,14 @@ class NanoProcessor(processor.ProcessorABC):
 
         # Find the PFCands associate with selected jets. Search from jetindex->JetPFCands->PFCand
         if "PFCands" in events.fields:
-            spfcands = events[event_level].PFCands[
-                events[event_level]
-                .JetPFCands[
-                    events[event_level].JetPFCands.jetIdx == jetindx[event_level]
-                ]
-                .pFCandsIdx
-            ]
+            spfcands = jet_pfcands(selev, jetindx[event_level])
 
         ####################
         # Weight & Geninfo #
         ####################
-        weights = Weights(len(events[event_level]), storeIndividual=True)
+        weights = Weights(len(selev), storeIndividual=True)
         if not isRealData:
-            weights.add("genweight", events[event_level].genWeight)
+            weights.add("genweight", selev["genWeight"])
             par_flav = (sjets.partonFlavour == 0) & (sjets.hadronFlavour == 0)
             genflavor = ak.values_astype(sjets.hadronFlavour + 1 * par_flav, int)
             smpu = (smuon_jet.partonFlavour == 0) & (smuon_jet.hadronFlavour == 0)
@@ -309,7 +301,7 @@ class NanoProcessor(processor.ProcessorABC):
                 syst_wei = True if self.isSyst != False else False
                 if "PU" in self.SF_map.keys():
                     puwei(
-                        events[event_level].Pileup.nTrueInt,
+                        selev["Pileup.nTrueInt"],
                         self.SF_map,
                         weights,
                         syst_wei,
@@ -343,160 +335,60 @@ class NanoProcessor(processor.ProcessorABC):
         ####################
         #  Fill histogram  #
         ####################
-        for syst in systematics:
-            if self.isSyst == False and syst != "nominal":
-                break
-            if self.noHist:
-                break
-            weight = (
-                weights.weight()
-                if syst == "nominal" or syst == shift_name
-                else weights.weight(modifier=syst)
-            )
-            for histname, h in output.items():
-                if (
-                    "Deep" in histname
-                    and "btag" not in histname
-                    and histname in events.Jet.fields
-                ):
-                    h.fill(
-                        syst,
-                        flatten(genflavor),
-                        flatten(sjets[histname]),
-                        weight=flatten(
-                            ak.broadcast_arrays(
-                                weights.partial_weight(exclude=exclude_btv), sjets["pt"]
-                            )[0]
-                        ),
-                    )
-                elif (
-                    "PFCands" in events.fields
-                    and "PFCands" in histname
-                    and histname.split("_")[1] in events.PFCands.fields
-                ):
-                    h.fill(
-                        syst,
-                        flatten(ak.broadcast_arrays(smflav, spfcands["pt"])[0]),
-                        flatten(spfcands[histname.replace("PFCands_", "")]),
-                        weight=flatten(
-                            ak.broadcast_arrays(
-                                weights.partial_weight(exclude=exclude_btv),
-                                spfcands["pt"],
-                            )[0]
-                        ),
-                    )
-                elif "jet_" in histname and "mu" not in histname:
-                    h.fill(
-                        syst,
-                        flatten(genflavor),
-                        flatten(sjets[histname.replace("jet_", "")]),
-                        weight=flatten(ak.broadcast_arrays(weight, sjets["pt"])[0]),
-                    )
-                elif "hl_" in histname and not "ptratio" in histname:
-                    h.fill(
-                        syst,
-                        flatten(isomu0[histname.replace("hl_", "")]),
-                        weight=weight,
-                    )
-                elif "sl_" in histname and not "ptratio" in histname:
-                    h.fill(
-                        syst,
-                        flatten(isomu1[histname.replace("sl_", "")]),
-                        weight=weight,
-                    )
-                elif "soft_l" in histname and not "ptratio" in histname:
-                    h.fill(
-                        syst,
-                        smflav,
-                        flatten(softmu0[histname.replace("soft_l_", "")]),
-                        weight=weight,
-                    )
-                elif "lmujet_" in histname:
-                    h.fill(
-                        syst,
-                        smflav,
-                        flatten(smuon_jet[histname.replace("lmujet_", "")]),
-                        weight=weight,
-                    )
-                elif "btag" in histname:
-                    for i in range(2):
-                        if (
-                            str(i) not in histname
-                            or histname.replace(f"_{i}", "") not in events.Jet.fields
-                        ):
-                            continue
-                        h.fill(
-                            syst="noSF",
-                            flav=smflav,
-                            discr=smuon_jet[histname.replace(f"_{i}", "")],
-                            weight=weights.partial_weight(exclude=exclude_btv),
-                        )
-                        if not isRealData and "btag" in self.SF_map.keys():
-                            h.fill(
-                                syst=syst,
-                                flav=smflav,
-                                discr=smuon_jet[histname.replace(f"_{i}", "")],
-                                weight=weight,
-                            )
-
-            output["njet"].fill(syst, njet, weight=weight)
-            output["nmujet"].fill(syst, nmujet, weight=weight)
-            output["nsoftmu"].fill(syst, nsoftmu, weight=weight)
-            output["hl_ptratio"].fill(
-                syst,
-                genflavor[:, 0],
-                ratio=isomu0.pt / sjets[:, 0].pt,
-                weight=weight,
-            )
-            output["sl_ptratio"].fill(
-                syst,
-                genflavor[:, 0],
-                ratio=isomu1.pt / sjets[:, 0].pt,
-                weight=weight,
-            )
-            output["soft_l_ptratio"].fill(
-                syst,
-                flav=smflav,
-                ratio=softmu0.pt / smuon_jet.pt,
-                weight=weight,
-            )
-            output["dr_lmujetsmu"].fill(
-                syst,
-                flav=smflav,
-                dr=smuon_jet.delta_r(softmu0),
-                weight=weight,
-            )
-            output["dr_lmujethmu"].fill(
-                syst,
-                flav=smflav,
-                dr=smuon_jet.delta_r(isomu0),
-                weight=weight,
-            )
-            output["dr_lmusmu"].fill(syst, dr=isomu0.delta_r(softmu0), weight=weight)
-            output["z_pt"].fill(syst, flatten(sz.pt), weight=weight)
-            output["z_eta"].fill(syst, flatten(sz.eta), weight=weight)
-            output["z_phi"].fill(syst, flatten(sz.phi), weight=weight)
-            output["z_mass"].fill(syst, flatten(sz.mass), weight=weight)
-            output["MET_pt"].fill(syst, flatten(smet.pt), weight=weight)
-            output["MET_phi"].fill(syst, flatten(smet.phi), weight=weight)
-            output["npvs"].fill(
-                syst,
-                events[event_level].PV.npvs,
-                weight=weight,
+        hist_systematics = [
+            syst for syst in systematics if self.isSyst != False or syst == "nominal"
+        ]
+        if len(hist_systematics) > 0 and (not self.noHist or self.skim is not None):
+            # objects the histograms are filled from, also stored in the skim
+            objects = ak.zip(
+                {
+                    "Jet": sjets,
+                    "Lepton": shlep,
+                    "SoftMuon": ssmu,
+                    "MuonJet": smuon_jet,
+                    "MET": smet,
+                    "njet": njet,
+                    "nmujet": nmujet,
+                    "nsoftmu": nsoftmu,
+                    "genflavor": genflavor,
+                    "mujet_flavor": smflav,
+                    "npvs": selev["PV.npvs"],
+                    "btv_weight": weights.partial_weight(exclude=exclude_btv),
+                    **({"PFCands": spfcands} if "PFCands" in events.fields else {}),
+                    **({} if isRealData else {"pu": selev["Pileup.nTrueInt"]}),
+                },
+                depth_limit=1,
             )
-            if not isRealData:
-                output["pu"].fill(
-                    syst,
-                    events[event_level].Pileup.nTrueInt,
-                    weight=weight,
+            # weights of all the systematics, each histogram is filled once
+            weight = syst_weights(weights, hist_systematics, shift_name)
+            if self.skim is not None:
+                self.skim.write(
+                    events.metadata,
+                    shift_name,
+                    objects,
+                    weight,
+                    hist_systematics,
+                    isRealData,
+                )
+            if not self.noHist:
+                output.update(
+                    self.fill_histograms(objects, weight, hist_systematics, isRealData)
+                )
+        elif not self.noHist:
+            output.update(
+                histogrammer(
+                    events,
+                    histoname[self.selMod],
+                    ["nominal"] if isRealData else self.systematics,
                 )
+            )
         #######################
         #  Create root files  #
         #######################
 
         if self.isArray:
             # Keep the structure of events and pruned the object size
-            pruned_ev = events[event_level]
+            pruned_ev = selev.events
             # pruned_ev["SelJet"] = sjets
             if self.selMod == "dilepttM":
                 pruned_ev["Muon1"] = shlep[:, 0]
@@ -524,9 +416,178 @@ class NanoProcessor(processor.ProcessorABC):
             pruned_ev["dr_mujet_softmu"] = ssmu[:, 0].delta_r(smuon_jet)
             pruned_ev["soft_l_ptratio"] = ssmu[:, 0].pt / smuon_jet.pt
 
-            array_writer(self, pruned_ev, events, systematics[0], dataset, isRealData)
+            array_writer(
+                self, pruned_ev, events, systematics[0], dataset, isRealData, sumw
+            )
 
         return {dataset: output}
 
+    def fill_histograms(self, objects, weight, hist_systematics, isRealData):
+        """histograms of the selected objects of a shift, from process_shift or the skim"""
+        output = histogrammer(
+            objects,
+            histoname[self.selMod],
+            ["nominal"] if isRealData else self.systematics,
+        )
+        sjets, shlep, ssmu = objects.Jet, objects.Lepton, objects.SoftMuon
+        smuon_jet, smet = objects.MuonJet, objects.MET
+        njet, nmujet, nsoftmu = objects.njet, objects.nmujet, objects.nsoftmu
+        genflavor, smflav = objects.genflavor, objects.mujet_flavor
+        btv_weight = objects.btv_weight
+        isomu0, isomu1, softmu0 = shlep[:, 0], shlep[:, 1], ssmu[:, 0]
+        sz = isomu0 + isomu1
+        for histname, h in output.items():
+            if (
+                "Deep" in histname
+                and "btag" not in histname
+                and histname in sjets.fields
+            ):
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    flatten(genflavor),
+                    flatten(sjets[histname]),
+                    weight=btv_weight,
+                    counts=ak.num(sjets),
+                )
+            elif (
+                "PFCands" in objects.fields
+                and "PFCands" in histname
+                and histname.split("_")[1] in objects.PFCands.fields
+            ):
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    flatten(ak.broadcast_arrays(smflav, objects.PFCands["pt"])[0]),
+                    flatten(objects.PFCands[histname.replace("PFCands_", "")]),
+                    weight=btv_weight,
+                    counts=ak.num(objects.PFCands),
+                )
+            elif "jet_" in histname and "mu" not in histname:
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    flatten(genflavor),
+                    flatten(sjets[histname.replace("jet_", "")]),
+                    weight=weight,
+                    counts=ak.num(sjets),
+                )
+            elif "hl_" in histname and not "ptratio" in histname:
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    flatten(isomu0[histname.replace("hl_", "")]),
+                    weight=weight,
+                )
+            elif "sl_" in histname and not "ptratio" in histname:
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    flatten(isomu1[histname.replace("sl_", "")]),
+                    weight=weight,
+                )
+            elif "soft_l" in histname and not "ptratio" in histname:
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    smflav,
+                    flatten(softmu0[histname.replace("soft_l_", "")]),
+                    weight=weight,
+                )
+            elif "lmujet_" in histname:
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    smflav,
+                    flatten(smuon_jet[histname.replace("lmujet_", "")]),
+                    weight=weight,
+                )
+            elif "btag" in histname:
+                for i in range(2):
+                    if (
+                        str(i) not in histname
+                        or histname.replace(f"_{i}", "") not in sjets.fields
+                    ):
+                        continue
+                    h.fill(
+                        syst="noSF",
+                        flav=smflav,
+                        discr=smuon_jet[histname.replace(f"_{i}", "")],
+                        weight=btv_weight,
+                    )
+                    if not isRealData and "btag" in self.SF_map.keys():
+                        fill_syst(
+                            h,
+                            hist_systematics,
+                            flav=smflav,
+                            discr=smuon_jet[histname.replace(f"_{i}", "")],
+                            weight=weight,
+                        )
+
+        fill_syst(output["njet"], hist_systematics, njet, weight=weight)
+        fill_syst(output["nmujet"], hist_systematics, nmujet, weight=weight)
+        fill_syst(output["nsoftmu"], hist_systematics, nsoftmu, weight=weight)
+        fill_syst(
+            output["hl_ptratio"],
+            hist_systematics,
+            genflavor[:, 0],
+            ratio=isomu0.pt / sjets[:, 0].pt,
+            weight=weight,
+        )
+        fill_syst(
+            output["sl_ptratio"],
+            hist_systematics,
+            genflavor[:, 0],
+            ratio=isomu1.pt / sjets[:, 0].pt,
+            weight=weight,
+        )
+        fill_syst(
+            output["soft_l_ptratio"],
+            hist_systematics,
+            flav=smflav,
+            ratio=softmu0.pt / smuon_jet.pt,
+            weight=weight,
+        )
+        fill_syst(
+            output["dr_lmujetsmu"],
+            hist_systematics,
+            flav=smflav,
+            dr=smuon_jet.delta_r(softmu0),
+            weight=weight,
+        )
+        fill_syst(
+            output["dr_lmujethmu"],
+            hist_systematics,
+            flav=smflav,
+            dr=smuon_jet.delta_r(isomu0),
+            weight=weight,
+        )
+        fill_syst(
+            output["dr_lmusmu"],
+            hist_systematics,
+            dr=isomu0.delta_r(softmu0),
+            weight=weight,
+        )
+        fill_syst(output["z_pt"], hist_systematics, flatten(sz.pt), weight=weight)
+        fill_syst(output["z_eta"], hist_systematics, flatten(sz.eta), weight=weight)
+        fill_syst(output["z_phi"], hist_systematics, flatten(sz.phi), weight=weight)
+        fill_syst(output["z_mass"], hist_systematics, flatten(sz.mass), weight=weight)
+        fill_syst(output["MET_pt"], hist_systematics, flatten(smet.pt), weight=weight)
+        fill_syst(output["MET_phi"], hist_systematics, flatten(smet.phi), weight=weight)
+        fill_syst(
+            output["npvs"],
+            hist_systematics,
+            objects.npvs,
+            weight=weight,
+        )
+        if not isRealData:
+            fill_syst(
+                output["pu"],
+                hist_systematics,
+                objects.pu,
+                weight=weight,
+            )
+        return output
+
     def postprocess(self, accumulator):
         return accumulator
@@ -18,17 +18,34 @@ from BTVNanoCommissioning.utils.correction import (
 
 # user helper function
 from BTVNanoCommissioning.helpers.func import (
+    SelectedEvents,
     flatten,
     update,
     uproot_writeable,
-    dump_lumi,
+    dump_sumw,
 )
 from BTVNanoCommissioning.helpers.update_branch import missing_branch
 
 ## load histograms & selctions for this workflow
-from BTVNanoCommissioning.utils.histogrammer import histogrammer
-from BTVNanoCommissioning.utils.array_writer import array_writer
-from BTVNanoCommissioning.utils.selection import jet_id, mu_idiso, ele_cuttightid
+from BTVNanoCommissioning.utils.histogrammer import (
+    histogrammer,
+    syst_categories,
+    syst_weights,
+    fill_syst,
+)
+from BTVNanoCommissioning.utils.array_writer import (
+    array_writer,
+    flush_writers,
+    reset_writers,
+)
+from BTVNanoCommissioning.utils.reader import prefiltered
+from BTVNanoCommissioning.utils.trigger import trigger_mask
+from BTVNanoCommissioning.utils.selection import (
+    jet_id,
+    mu_idiso,
+    ele_cuttightid,
+    prefilter_mask,
+)
 
 
 class NanoProcessor(processor.ProcessorABC):
@@ -50,8 +67,18 @@ class NanoProcessor(processor.ProcessorABC):
         self.noHist = noHist
         self.lumiMask = load_lumi(self._campaign)
         self.chunksize = chunksize
+        self.selection_index = None
+        self.skim = None
+        self.triggers = [
+            "Mu23_TrkIsoVVL_Ele12_CaloIdL_TrackIdL_IsoVL_DZ",
+            "Mu12_TrkIsoVVL_Ele23_CaloIdL_TrackIdL_IsoVL_DZ",
+            "Mu8_TrkIsoVVL_Ele23_CaloIdL_TrackIdL_IsoVL_DZ",
+        ]
         ## Load corrections
         self.SF_map = load_SF(self._campaign)
+        self.systematics = syst_categories(
+            self.SF_map, self.isSyst, ["PU", "MUO", "EGM", "BTV"]
+        )
 
     @property
     def accumulator(self):
@@ -59,9 +86,18 @@ class NanoProcessor(processor.ProcessorABC):
 
     ## Apply corrections on momentum/mass on MET, Jet, Muon
     def process(self, events):
+        # a retried chunk does not keep the arrays of its failed attempt
+        reset_writers()
         isRealData = not hasattr(events, "genWeight")
         dataset = events.metadata["dataset"]
-        events = missing_branch(events)
+        output = {dataset: dump_sumw(events, self.lumiMask)}
+        if self.skim is not None:
+            self.skim.write_summary(events.metadata, output[dataset])
+        events = missing_branch(
+            prefiltered(events, self.prefilter, self.selection_index)
+        )
+        # sum of weights of the whole chunk, the events are prefiltered
+        sumw = output[dataset]["sumw"]
         shifts = []
         if "JME" in self.SF_map.keys():
             syst_JERC = self.isSyst
@@ -90,32 +126,38 @@ class NanoProcessor(processor.ProcessorABC):
             shifts = Roccor_shifts(shifts, self.SF_map, events, isRealData, False)
         else:
             shifts[0][0]["Muon"] = events.Muon
-
-        return processor.accumulate(
-            self.process_shift(update(events, collections), name)
-            for collections, name in shifts
+        output = processor.accumulate(
+            (
+                self.process_shift(update(events, collections), name, sumw)
+                for collections, name in shifts
+            ),
+            output,
         )
+        # the chunk is only done once its root files are written
+        flush_writers()
+        return output
 
     ## Processed events per-chunk, made selections, filled histogram, stored root files
-    def process_shift(self, events, shift_name):
-        dataset = events.metadata["dataset"]
-        isRealData = not hasattr(events, "genWeight")
-        ######################
-        #  Create histogram  # : Get the histogram dict from `histogrammer`
-        ######################
-        _hist_event_dict = (
-            {"": None} if self.noHist else histogrammer(events, "example")
+    def prefilter(self, events):
+        # shift-independent part of the selection, run before the corrections
+        return prefilter_mask(
+            events,
+            self._campaign,
+            self.lumiMask if not hasattr(events, "genWeight") else None,
+            self.triggers,
+            nobjects=[
+                (mu_idiso(events, self._campaign), 1),
+                (
+                    (events.Electron.pt > 15) & ele_cuttightid(events, self._campaign),
+                    1,
+                ),
+            ],
         )
 
-        output = {
-            "sumw": processor.defaultdict_accumulator(float),
-            **_hist_event_dict,
-        }
-        if shift_name is None:
-            if isRealData:
-                output["sumw"] = len(events)
-            else:
-                output["sumw"] = ak.sum(events.genWeight)
+    def process_shift(self, events, shift_name, sumw):
+        dataset = events.metadata["dataset"]
+        isRealData = not hasattr(events, "genWeight")
+        output = {}
         ####################
         #    Selections    #
         ####################
@@ -123,27 +165,9 @@ class NanoProcessor(processor.ProcessorABC):
         req_lumi = np.ones(len(events), dtype="bool")
         if isRealData:
             req_lumi = self.lumiMask(events.run, events.luminosityBlock)
-        # only dump for nominal case
-        if shift_name is None:
-            output = dump_lumi(events[req_lumi], output)
 
         ## HLT
-        triggers = [
-            "Mu23_TrkIsoVVL_Ele12_CaloIdL_TrackIdL_IsoVL_DZ",
-            "Mu12_TrkIsoVVL_Ele23_CaloIdL_TrackIdL_IsoVL_DZ",
-            "Mu8_TrkIsoVVL_Ele23_CaloIdL_TrackIdL_IsoVL_DZ",
-        ]
-        checkHLT = ak.Array([hasattr(events.HLT, _trig) for _trig in triggers])
-        if ak.all(checkHLT == False):
-            raise ValueError("HLT paths:", triggers, " are all invalid in", dataset)
-        elif ak.any(checkHLT == False):
-            print(np.array(triggers)[~checkHLT], " not exist in", dataset)
-        trig_arrs = [
-            events.HLT[_trig] for _trig in triggers if hasattr(events.HLT, _trig)
-        ]
-        req_trig = np.zeros(len(events), dtype="bool")
-        for t in trig_arrs:
-            req_trig = req_trig | t
+        req_trig = trigger_mask(events, self.triggers)
 
         ##### Add some selections
         ## Muon cuts
@@ -174,7 +198,20 @@ class NanoProcessor(processor.ProcessorABC):
         )
         event_level = ak.fill_none(event_level, False)
         # Skip empty events
-        if len(events[event_level]) == 0:
+        selev = SelectedEvents(
+            events,
+            event_level,
+            [] if isRealData else ["genWeight", "Pileup.nTrueInt"],
+        )
+        if len(selev) == 0:
+            if not self.noHist:
+                output.update(
+                    histogrammer(
+                        events,
+                        "example",
+                        ["nominal"] if isRealData else self.systematics,
+                    )
+                )
             return {dataset: output}
 
         ####################
@@ -187,9 +224,9 @@ class NanoProcessor(processor.ProcessorABC):
         # Weight & Geninfo # : Add weight to selected events
         ####################
         # create Weights object to save individual weights
-        weights = Weights(len(events[event_level]), storeIndividual=True)
+        weights = Weights(len(selev), storeIndividual=True)
         if not isRealData:
-            weights.add("genweight", events[event_level].genWeight)
+            weights.add("genweight", selev["genWeight"])
             par_flav = (sjets.partonFlavour == 0) & (sjets.hadronFlavour == 0)
             genflavor = ak.values_astype(sjets.hadronFlavour + 1 * par_flav, int)
             # Load SFs
@@ -199,7 +236,7 @@ class NanoProcessor(processor.ProcessorABC):
                 )  # load systematic flag
                 if "PU" in self.SF_map.keys():
                     puwei(
-                        events[event_level].Pileup.nTrueInt,
+                        selev["Pileup.nTrueInt"],
                         self.SF_map,
                         weights,
                         syst_wei,
@@ -234,42 +271,46 @@ class NanoProcessor(processor.ProcessorABC):
         ####################
         #  Fill histogram  #
         ####################
-        for syst in systematics:
-            if self.isSyst == False and syst != "nominal":
-                break
-            if self.noHist:
-                break
-            weight = (
-                weights.weight()
-                if syst == "nominal" or syst == shift_name
-                else weights.weight(modifier=syst)
-            )  # shift up/down for weight systematics
-
-            # fill the histogram (check axis defintion in histogrammer and following the order)
-            output["jet_pt"].fill(
-                syst,
-                flatten(genflavor[:, 0]),
-                flatten(sjets[:, 0].pt),
-                weight=weight,
+        hist_systematics = [
+            syst for syst in systematics if self.isSyst != False or syst == "nominal"
+        ]
+        if len(hist_systematics) > 0 and (not self.noHist or self.skim is not None):
+            # objects the histograms are filled from, also stored in the skim (one entry per event)
+            objects = ak.zip(
+                {"Jet": sjets, "Muon": smu, "genflavor": genflavor}, depth_limit=1
             )
-            output["mu_pt"].fill(syst, flatten(smu[:, 0].pt), weight=weight)
-            output["dr_mujet"].fill(
-                syst,
-                flatten(genflavor[:, 0]),  # the fill content should always flat arrays
-                flatten(sjets[:, 0].delta_r(smu[:, 0])),
-                weight=weight,
+            # (n_syst, n_event) weights, shift up/down for weight systematics
+            weight = syst_weights(weights, hist_systematics, shift_name)
+            if self.skim is not None:
+                self.skim.write(
+                    events.metadata,
+                    shift_name,
+                    objects,
+                    weight,
+                    hist_systematics,
+                    isRealData,
+                )
+            if not self.noHist:
+                output.update(
+                    self.fill_histograms(objects, weight, hist_systematics, isRealData)
+                )
+        elif not self.noHist:
+            output.update(
+                histogrammer(
+                    events, "example", ["nominal"] if isRealData else self.systematics
+                )
             )
         #######################
         #  Create root files  # : Save arrays in to root file, keep axis structure
         #######################
         if self.isArray:
             # Keep the structure of events and pruned the object size
-            pruned_ev = events[event_level]  # pruned events
+            pruned_ev = selev.events  # pruned events
 
             pruned_ev.Muon = smu  # replace muon collections with selected muon
         if self.isArray:
             # Keep the structure of events and pruned the object size
-            pruned_ev = events[event_level]
+            pruned_ev = selev.events
             pruned_ev["SelJet"] = sjets
             pruned_ev["Muon"] = smu
 
@@ -280,10 +321,41 @@ class NanoProcessor(processor.ProcessorABC):
                     pruned_ev[f"{ind_wei}_weight"] = weights.partial_weight(
                         include=[ind_wei]
                     )
-            array_writer(self, pruned_ev, events, systematics[0], dataset, isRealData)
+            array_writer(
+                self, pruned_ev, events, systematics[0], dataset, isRealData, sumw
+            )
 
         return {dataset: output}
 
+    def fill_histograms(self, objects, weight, hist_systematics, isRealData):
+        """histograms of the selected objects of a shift, from process_shift or the skim"""
+        ######################
+        #  Create histogram  # : Get the histogram dict from `histogrammer`, with the syst categories declared up front
+        ######################
+        output = histogrammer(
+            objects, "example", ["nominal"] if isRealData else self.systematics
+        )
+        sjets, smu, genflavor = objects.Jet, objects.Muon, objects.genflavor
+        # fill all systematics at once (check axis defintion in histogrammer and following the order)
+        fill_syst(
+            output["jet_pt"],
+            hist_systematics,
+            flatten(genflavor[:, 0]),
+            flatten(sjets[:, 0].pt),
+            weight=weight,
+        )
+        fill_syst(
+            output["mu_pt"], hist_systematics, flatten(smu[:, 0].pt), weight=weight
+        )
+        fill_syst(
+            output["dr_mujet"],
+            hist_systematics,
+            flatten(genflavor[:, 0]),  # the fill content should always flat arrays
+            flatten(sjets[:, 0].delta_r(smu[:, 0])),
+            weight=weight,
+        )
+        return output
+
     ## post process, return the accumulator, compressed
     def postprocess(self, accumulator):
         return accumulator
@@ -0,0 +1,86 @@
+import copy
+import numpy as np
+from coffea import processor
+from BTVNanoCommissioning.helpers.func import update, dump_sumw
+from BTVNanoCommissioning.helpers.update_branch import missing_branch
+from BTVNanoCommissioning.utils.array_writer import flush_writers, reset_writers
+from BTVNanoCommissioning.utils.correction import common_shifts
+from BTVNanoCommissioning.utils.reader import prefiltered
+
+
+class NanoProcessor(processor.ProcessorABC):
+    """Several workflows on a single read of the events
+
+    The events passing any of the workflow prefilters are read once, the
+    missing branches and the corrections/shifts are computed once per chunk
+    and the corrected events are handed to the process_shift of every
+    workflow. The output is {workflow name: output of the workflow}.
+    """
+
+    def __init__(self, processors):
+        self.processors = processors
+        first = next(iter(processors.values()))
+        for name, proc in processors.items():
+            if not hasattr(proc, "prefilter") or not hasattr(proc, "process_shift"):
+                raise ValueError(f"{name} cannot be run together with other workflows")
+            if getattr(proc, "exclude_jetveto", False) or (
+                proc._campaign,
+                proc._year,
+            ) != (first._campaign, first._year):
+                raise ValueError(
+                    f"{name} does not share the corrections of {list(processors)}"
+                )
+        self._campaign = first._campaign
+        self._year = first._year
+        self.lumiMask = first.lumiMask
+        self.SF_map = first.SF_map
+        # workflows without systematics (validation) only get the nominal shift
+        self.isSyst = next((p.isSyst for p in processors.values() if p.isSyst), False)
+        for name, proc in processors.items():
+            if proc.isSyst not in [False, self.isSyst]:
+                raise ValueError(
+                    f"{name} does not share the systematics {self.isSyst} of {list(processors)}"
+                )
+        self.selection_index = None
+
+    def process(self, events):
+        # a retried chunk does not keep the arrays of its failed attempt
+        reset_writers()
+        isRealData = not hasattr(events, "genWeight")
+        dataset = events.metadata["dataset"]
+        summary = dump_sumw(events, self.lumiMask)
+        for proc in self.processors.values():
+            if proc.skim is not None:
+                proc.skim.write_summary(events.metadata, summary)
+        events = missing_branch(
+            prefiltered(events, self.prefilter, self.selection_index)
+        )
+        shifts = common_shifts(
+            events, self.SF_map, self._campaign, self._year, isRealData, self.isSyst
+        )
+        output = {name: {dataset: copy.deepcopy(summary)} for name in self.processors}
+        for collections, shift in shifts:
+            for name, proc in self.processors.items():
+                if shift is None or proc.isSyst == self.isSyst:
+                    # process_shift replaces collections of its events, each gets its own copy
+                    output[name] = processor.accumulate(
+                        [
+                            proc.process_shift(
+                                update(events, collections), shift, summary["sumw"]
+                            )
+                        ],
+                        output[name],
+                    )
+        flush_writers()
+        return output
+
+    def prefilter(self, events):
+        return np.logical_or.reduce(
+            [
+                np.asarray(p.prefilter(events), dtype=bool)
+                for p in self.processors.values()
+            ]
+        )
+
+    def postprocess(self, accumulator):
+        return accumulator
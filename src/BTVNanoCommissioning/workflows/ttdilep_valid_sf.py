@@ -12,26 +12,40 @@ from BTVNanoCommissioning.utils.correction import (
     muSFs,
     puwei,
     btagSFs,
-    JME_shifts,
-    Roccor_shifts,
+    common_shifts,
 )
 
 # user helper function
 from BTVNanoCommissioning.helpers.func import (
+    SelectedEvents,
     flatten,
     update,
-    dump_lumi,
+    dump_sumw,
+    jet_pfcands,
 )
 from BTVNanoCommissioning.helpers.update_branch import missing_branch
 
 ## load histograms & selctions for this workflow
-from BTVNanoCommissioning.utils.histogrammer import histogrammer
-from BTVNanoCommissioning.utils.array_writer import array_writer
+from BTVNanoCommissioning.utils.histogrammer import (
+    histogrammer,
+    syst_categories,
+    syst_weights,
+    fill_syst,
+)
+from BTVNanoCommissioning.utils.array_writer import (
+    array_writer,
+    flush_writers,
+    reset_writers,
+)
+from BTVNanoCommissioning.utils.reader import prefiltered
+from BTVNanoCommissioning.utils.trigger import trigger_mask
 from BTVNanoCommissioning.utils.selection import (
     jet_id,
     mu_idiso,
     ele_cuttightid,
     btag_wp,
+    dr_clean,
+    prefilter_mask,
 )
 
 
@@ -54,8 +68,18 @@ class NanoProcessor(processor.ProcessorABC):
         self.noHist = noHist
         self.lumiMask = load_lumi(self._campaign)
         self.chunksize = chunksize
+        self.selection_index = None
+        self.skim = None
+        self.triggers = [
+            "Mu23_TrkIsoVVL_Ele12_CaloIdL_TrackIdL_IsoVL_DZ",
+            "Mu12_TrkIsoVVL_Ele23_CaloIdL_TrackIdL_IsoVL_DZ",
+            "Mu8_TrkIsoVVL_Ele23_CaloIdL_TrackIdL_IsoVL_DZ",
+        ]
         ## Load corrections
         self.SF_map = load_SF(self._campaign)
+        self.systematics = syst_categories(
+            self.SF_map, self.isSyst, ["PU", "MUO", "EGM", "BTV"]
+        )
 
     @property
     def accumulator(self):
@@ -63,61 +87,52 @@ class NanoProcessor(processor.ProcessorABC):
 
     ## Apply corrections on momentum/mass on MET, Jet, Muon
     def process(self, events):
+        # a retried chunk does not keep the arrays of its failed attempt
+        reset_writers()
         isRealData = not hasattr(events, "genWeight")
         dataset = events.metadata["dataset"]
-        events = missing_branch(events)
-        shifts = []
-        if "JME" in self.SF_map.keys():
-            syst_JERC = self.isSyst
-            if self.isSyst == "JERC_split":
-                syst_JERC = "split"
-            shifts = JME_shifts(
-                shifts, self.SF_map, events, self._campaign, isRealData, syst_JERC
-            )
-        else:
-            if int(self._year) < 2020:
-                shifts = [
-                    ({"Jet": events.Jet, "MET": events.MET, "Muon": events.Muon}, None)
-                ]
-            else:
-                shifts = [
-                    (
-                        {
-                            "Jet": events.Jet,
-                            "MET": events.PuppiMET,
-                            "Muon": events.Muon,
-                        },
-                        None,
-                    )
-                ]
-        if "roccor" in self.SF_map.keys():
-            shifts = Roccor_shifts(shifts, self.SF_map, events, isRealData, False)
-        else:
-            shifts[0][0]["Muon"] = events.Muon
+        output = {dataset: dump_sumw(events, self.lumiMask)}
+        if self.skim is not None:
+            self.skim.write_summary(events.metadata, output[dataset])
+        events = missing_branch(
+            prefiltered(events, self.prefilter, self.selection_index)
+        )
+        # sum of weights of the whole chunk, the events are prefiltered
+        sumw = output[dataset]["sumw"]
+        shifts = common_shifts(
+            events, self.SF_map, self._campaign, self._year, isRealData, self.isSyst
+        )
+        output = processor.accumulate(
+            (
+                self.process_shift(update(events, collections), name, sumw)
+                for collections, name in shifts
+            ),
+            output,
+        )
+        # the chunk is only done once its root files are written
+        flush_writers()
+        return output
 
-        return processor.accumulate(
-            self.process_shift(update(events, collections), name)
-            for collections, name in shifts
+    def prefilter(self, events):
+        # shift-independent part of the selection, run before the corrections
+        return prefilter_mask(
+            events,
+            self._campaign,
+            self.lumiMask if not hasattr(events, "genWeight") else None,
+            self.triggers,
+            nobjects=[
+                (mu_idiso(events, self._campaign), 1),
+                (
+                    (events.Electron.pt > 30) & ele_cuttightid(events, self._campaign),
+                    1,
+                ),
+            ],
         )
 
-    def process_shift(self, events, shift_name):
+    def process_shift(self, events, shift_name, sumw):
         dataset = events.metadata["dataset"]
         isRealData = not hasattr(events, "genWeight")
-        ## Create histograms
-        _hist_event_dict = (
-            {"": None} if self.noHist else histogrammer(events, "ttdilep_sf")
-        )
-        if _hist_event_dict == None:
-            _hist_event_dict[""]
-        output = {
-            "sumw": processor.defaultdict_accumulator(float),
-            **_hist_event_dict,
-        }
-        if shift_name is None:
-            if isRealData:
-                output["sumw"] = len(events)
-            else:
-                output["sumw"] = ak.sum(events.genWeight)
+        output = {}
         ####################
         #    Selections    #
         ####################
@@ -125,27 +140,9 @@ class NanoProcessor(processor.ProcessorABC):
         req_lumi = np.ones(len(events), dtype="bool")
         if isRealData:
             req_lumi = self.lumiMask(events.run, events.luminosityBlock)
-        # only dump for nominal case
-        if shift_name is None:
-            output = dump_lumi(events[req_lumi], output)
 
         ## HLT
-        triggers = [
-            "Mu23_TrkIsoVVL_Ele12_CaloIdL_TrackIdL_IsoVL_DZ",
-            "Mu12_TrkIsoVVL_Ele23_CaloIdL_TrackIdL_IsoVL_DZ",
-            "Mu8_TrkIsoVVL_Ele23_CaloIdL_TrackIdL_IsoVL_DZ",
-        ]
-        checkHLT = ak.Array([hasattr(events.HLT, _trig) for _trig in triggers])
-        if ak.all(checkHLT == False):
-            raise ValueError("HLT paths:", triggers, " are all invalid in", dataset)
-        elif ak.any(checkHLT == False):
-            print(np.array(triggers)[~checkHLT], " not exist in", dataset)
-        trig_arrs = [
-            events.HLT[_trig] for _trig in triggers if hasattr(events.HLT, _trig)
-        ]
-        req_trig = np.zeros(len(events), dtype="bool")
-        for t in trig_arrs:
-            req_trig = req_trig | t
+        req_trig = trigger_mask(events, self.triggers)
 
         ## Muon cuts
         # muon twiki: https://twiki.cern.ch/twiki/bin/view/CMS/SWGuideMuonIdRun2
@@ -164,26 +161,12 @@ class NanoProcessor(processor.ProcessorABC):
         req_ele = ak.count(events.Electron.pt, axis=1) == 1
 
         ## Jet cuts
-        event_jet = events.Jet[
-            ak.fill_none(
-                jet_id(events, self._campaign)
-                & (
-                    ak.all(
-                        events.Jet.metric_table(events.Muon) > 0.4,
-                        axis=2,
-                        mask_identity=True,
-                    )
-                )
-                & (
-                    ak.all(
-                        events.Jet.metric_table(events.Electron) > 0.4,
-                        axis=2,
-                        mask_identity=True,
-                    )
-                ),
-                False,
-            )
-        ]
+        jet_sel = (
+            jet_id(events, self._campaign)
+            & (dr_clean(events.Jet, events.Muon, 0.4, mask_identity=True))
+            & (dr_clean(events.Jet, events.Electron, 0.4, mask_identity=True))
+        )
+        event_jet = events.Jet[ak.fill_none(jet_sel, False)]
         req_jets = ak.num(event_jet.pt) >= 2
 
         ## Other cuts
@@ -194,27 +177,7 @@ class NanoProcessor(processor.ProcessorABC):
         req_opposite_charge = ak.flatten(req_opposite_charge)
 
         ## store jet index for PFCands, create mask on the jet index
-        jetindx = ak.mask(
-            ak.local_index(events.Jet.pt),
-            (
-                jet_id(events, self._campaign)
-                & (
-                    ak.all(
-                        events.Jet.metric_table(events.Muon) > 0.4,
-                        axis=2,
-                        mask_identity=True,
-                    )
-                )
-                & (
-                    ak.all(
-                        events.Jet.metric_table(events.Electron) > 0.4,
-                        axis=2,
-                        mask_identity=True,
-                    )
-                )
-            )
-            == 1,
-        )
+        jetindx = ak.mask(ak.local_index(events.Jet.pt), jet_sel == 1)
         jetindx = ak.pad_none(jetindx, 2)
         jetindx = jetindx[:, :2]
 
@@ -222,15 +185,29 @@ class NanoProcessor(processor.ProcessorABC):
             req_trig & req_lumi & req_muon & req_ele & req_jets & req_opposite_charge
         )
         event_level = ak.fill_none(event_level, False)
-        if len(events[event_level]) == 0:
+        selev = SelectedEvents(
+            events,
+            event_level,
+            ["PV.npvs"] if isRealData else ["PV.npvs", "genWeight", "Pileup.nTrueInt"],
+        )
+        if len(selev) == 0:
+            if not self.noHist:
+                output.update(
+                    histogrammer(
+                        events,
+                        "ttdilep_sf",
+                        ["nominal"] if isRealData else self.systematics,
+                    )
+                )
             if self.isArray:
                 array_writer(
                     self,
-                    events[event_level],
+                    selev.events,
                     events,
                     "nominal",
                     dataset,
                     isRealData,
+                    sumw,
                     empty=True,
                 )
             return {dataset: output}
@@ -247,36 +224,20 @@ class NanoProcessor(processor.ProcessorABC):
         sjets = sjets[:, :2]
         # Find the PFCands associate with selected jets. Search from jetindex->JetPFCands->PFCand
         if "PFCands" in events.fields:
-            jetindx0 = jetindx[:, 0]
-            jetindx1 = jetindx[:, 1]
-            spfcands = collections.defaultdict(dict)
-            spfcands[0] = events[event_level].PFCands[
-                events[event_level]
-                .JetPFCands[
-                    events[event_level].JetPFCands.jetIdx == jetindx0[event_level]
-                ]
-                .pFCandsIdx
-            ]
-            spfcands[1] = events[event_level].PFCands[
-                events[event_level]
-                .JetPFCands[
-                    events[event_level].JetPFCands.jetIdx == jetindx1[event_level]
-                ]
-                .pFCandsIdx
-            ]
+            spfcands = jet_pfcands(selev, jetindx[event_level])
         ####################
         # Weight & Geninfo #
         ####################
-        weights = Weights(len(events[event_level]), storeIndividual=True)
+        weights = Weights(len(selev), storeIndividual=True)
         if not isRealData:
-            weights.add("genweight", events[event_level].genWeight)
+            weights.add("genweight", selev["genWeight"])
             par_flav = (sjets.partonFlavour == 0) & (sjets.hadronFlavour == 0)
             genflavor = ak.values_astype(sjets.hadronFlavour + 1 * par_flav, int)
             if len(self.SF_map.keys()) > 0:
                 syst_wei = True if self.isSyst != False else False
                 if "PU" in self.SF_map.keys():
                     puwei(
-                        events[event_level].Pileup.nTrueInt,
+                        selev["Pileup.nTrueInt"],
                         self.SF_map,
                         weights,
                         syst_wei,
@@ -308,139 +269,59 @@ class NanoProcessor(processor.ProcessorABC):
         ####################
         #  Fill histogram  #
         ####################
-        for syst in systematics:
-            if self.isSyst == False and syst != "nominal":
-                break
-            if self.noHist:
-                break
-            weight = (
-                weights.weight()
-                if syst == "nominal" or syst == shift_name
-                else weights.weight(modifier=syst)
+        hist_systematics = [
+            syst for syst in systematics if self.isSyst != False or syst == "nominal"
+        ]
+        if len(hist_systematics) > 0 and (not self.noHist or self.skim is not None):
+            # objects the histograms are filled from, also stored in the skim
+            objects = ak.zip(
+                {
+                    "Jet": sjets,
+                    "Muon": smu,
+                    "Electron": sel,
+                    "njet": nseljet,
+                    "genflavor": genflavor,
+                    "npvs": selev["PV.npvs"],
+                    "btv_weight": weights.partial_weight(exclude=exclude_btv),
+                    **({"PFCands": spfcands} if "PFCands" in events.fields else {}),
+                    **({} if isRealData else {"pu": selev["Pileup.nTrueInt"]}),
+                },
+                depth_limit=1,
             )
-            for histname, h in output.items():
-                if (
-                    "Deep" in histname
-                    and "btag" not in histname
-                    and histname in events.Jet.fields
-                ):
-                    if syst != "nominal":
-                        continue
-                    h.fill(
-                        syst,
-                        flatten(genflavor),
-                        flatten(sjets[histname]),
-                        weight=flatten(
-                            ak.broadcast_arrays(
-                                weights.partial_weight(exclude=exclude_btv), sjets["pt"]
-                            )[0]
-                        ),
-                    )
-                elif (
-                    "PFCands" in events.fields
-                    and "PFCands" in histname
-                    and histname.split("_")[1] in events.PFCands.fields
-                ):
-                    if syst != "nominal":
-                        continue
-                    for i in range(2):
-                        h.fill(
-                            syst,
-                            flatten(
-                                ak.broadcast_arrays(
-                                    genflavor[:, i],
-                                    spfcands[i]["pt"],
-                                )[0]
-                            ),
-                            flatten(spfcands[i][histname.replace("PFCands_", "")]),
-                            weight=flatten(
-                                ak.broadcast_arrays(
-                                    weights.partial_weight(exclude=exclude_btv),
-                                    spfcands[i]["pt"],
-                                )[0]
-                            ),
-                        )
-
-                elif "btag" in histname:
-                    for i in range(2):
-                        sel_jet = sjets[:, i]
-                        if (
-                            str(i) in histname
-                            and histname.replace(f"_{i}", "") in events.Jet.fields
-                        ):
-                            h.fill(
-                                "noSF",
-                                flav=flatten(genflavor[:, i]),
-                                discr=flatten(sel_jet[histname.replace(f"_{i}", "")]),
-                                weight=weights.partial_weight(exclude=exclude_btv),
-                            )
-                            if not isRealData and "btag" in self.SF_map.keys():
-                                h.fill(
-                                    syst=syst,
-                                    flav=flatten(
-                                        ak.values_astype(
-                                            genflavor[:, i],
-                                            np.uint8,
-                                        )
-                                    ),
-                                    discr=flatten(
-                                        sel_jet[histname.replace(f"_{i}", "")]
-                                    ),
-                                    weight=weight,
-                                )
-                elif "mu_" in histname and histname.replace("mu_", "") in smu.fields:
-                    h.fill(
-                        syst,
-                        flatten(smu[histname.replace("mu_", "")]),
-                        weight=weight,
-                    )
-                elif "ele_" in histname and histname.replace("ele_", "") in sel.fields:
-                    h.fill(
-                        syst,
-                        flatten(sel[histname.replace("ele_", "")]),
-                        weight=weight,
-                    )
-                elif "jet" in histname and "dr" not in histname and "njet" != histname:
-                    for i in range(2):
-                        sel_jet = sjets[:, i]
-                        if str(i) in histname:
-                            h.fill(
-                                syst,
-                                flatten(genflavor[:, i]),
-                                flatten(sel_jet[histname.replace(f"jet{i}_", "")]),
-                                weight=weight,
-                            )
-
-            for i in range(2):
-                output[f"dr_mujet{i}"].fill(
-                    syst,
-                    flav=flatten(genflavor[:, i]),
-                    dr=flatten(smu.delta_r(sjets[:, i])),
-                    weight=weight,
+            # weights of all the systematics, each histogram is filled once
+            weight = syst_weights(weights, hist_systematics, shift_name)
+            if self.skim is not None:
+                self.skim.write(
+                    events.metadata,
+                    shift_name,
+                    objects,
+                    weight,
+                    hist_systematics,
+                    isRealData,
                 )
-            output["njet"].fill(syst, nseljet, weight=weight)
-            output["npvs"].fill(
-                syst,
-                events[event_level].PV.npvs,
-                weight=weight,
-            )
-            if not isRealData:
-                output["pu"].fill(
-                    syst,
-                    events[event_level].Pileup.nTrueInt,
-                    weight=weight,
+            if not self.noHist:
+                output.update(
+                    self.fill_histograms(objects, weight, hist_systematics, isRealData)
+                )
+        elif not self.noHist:
+            output.update(
+                histogrammer(
+                    events,
+                    "ttdilep_sf",
+                    ["nominal"] if isRealData else self.systematics,
                 )
+            )
         #######################
         #  Create root files  #
         #######################
         if self.isArray:
             # Keep the structure of events and pruned the object size
-            pruned_ev = events[event_level]
+            pruned_ev = selev.events
             pruned_ev["SelJet"] = sjets
             pruned_ev["Muon"] = smu
             pruned_ev["Electron"] = sel
             if "PFCands" in events.fields:
-                pruned_ev.PFCands = spfcands
+                pruned_ev.PFCands = ak.flatten(spfcands, axis=2)
             # Add custom variables
             if not isRealData:
                 pruned_ev["weight"] = weights.weight()
@@ -451,9 +332,126 @@ class NanoProcessor(processor.ProcessorABC):
 
             pruned_ev["dr_mujet0"] = smu.delta_r(sjets[:, 0])
             pruned_ev["dr_mujet1"] = smu.delta_r(sjets[:, 1])
-            array_writer(self, pruned_ev, events, systematics[0], dataset, isRealData)
+            array_writer(
+                self, pruned_ev, events, systematics[0], dataset, isRealData, sumw
+            )
 
         return {dataset: output}
 
+    def fill_histograms(self, objects, weight, hist_systematics, isRealData):
+        """histograms of the selected objects of a shift, from process_shift or the skim"""
+        output = histogrammer(
+            objects, "ttdilep_sf", ["nominal"] if isRealData else self.systematics
+        )
+        sjets, smu, sel = objects.Jet, objects.Muon, objects.Electron
+        genflavor, btv_weight = objects.genflavor, objects.btv_weight
+        for histname, h in output.items():
+            if (
+                "Deep" in histname
+                and "btag" not in histname
+                and histname in sjets.fields
+            ):
+                if hist_systematics[0] != "nominal":
+                    continue
+                h.fill(
+                    "nominal",
+                    flatten(genflavor),
+                    flatten(sjets[histname]),
+                    weight=flatten(ak.broadcast_arrays(btv_weight, sjets["pt"])[0]),
+                )
+            elif (
+                "PFCands" in objects.fields
+                and "PFCands" in histname
+                and histname.split("_")[1] in objects.PFCands.fields
+            ):
+                if hist_systematics[0] != "nominal":
+                    continue
+                h.fill(
+                    "nominal",
+                    flatten(
+                        ak.broadcast_arrays(genflavor[:, :2], objects.PFCands["pt"])[0]
+                    ),
+                    flatten(objects.PFCands[histname.replace("PFCands_", "")]),
+                    weight=flatten(
+                        ak.broadcast_arrays(btv_weight, objects.PFCands["pt"])[0]
+                    ),
+                )
+
+            elif "btag" in histname:
+                for i in range(2):
+                    sel_jet = sjets[:, i]
+                    if (
+                        str(i) in histname
+                        and histname.replace(f"_{i}", "") in sjets.fields
+                    ):
+                        h.fill(
+                            "noSF",
+                            flav=flatten(genflavor[:, i]),
+                            discr=flatten(sel_jet[histname.replace(f"_{i}", "")]),
+                            weight=btv_weight,
+                        )
+                        if not isRealData and "btag" in self.SF_map.keys():
+                            fill_syst(
+                                h,
+                                hist_systematics,
+                                flav=flatten(
+                                    ak.values_astype(
+                                        genflavor[:, i],
+                                        np.uint8,
+                                    )
+                                ),
+                                discr=flatten(sel_jet[histname.replace(f"_{i}", "")]),
+                                weight=weight,
+                            )
+            elif "mu_" in histname and histname.replace("mu_", "") in smu.fields:
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    flatten(smu[histname.replace("mu_", "")]),
+                    weight=weight,
+                )
+            elif "ele_" in histname and histname.replace("ele_", "") in sel.fields:
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    flatten(sel[histname.replace("ele_", "")]),
+                    weight=weight,
+                )
+            elif "jet" in histname and "dr" not in histname and "njet" != histname:
+                for i in range(2):
+                    sel_jet = sjets[:, i]
+                    if str(i) in histname:
+                        fill_syst(
+                            h,
+                            hist_systematics,
+                            flatten(genflavor[:, i]),
+                            flatten(sel_jet[histname.replace(f"jet{i}_", "")]),
+                            weight=weight,
+                        )
+
+        for i in range(2):
+            fill_syst(
+                output[f"dr_mujet{i}"],
+                hist_systematics,
+                flav=flatten(genflavor[:, i]),
+                dr=flatten(smu.delta_r(sjets[:, i])),
+                weight=weight,
+            )
+        fill_syst(output["njet"], hist_systematics, objects.njet, weight=weight)
+        fill_syst(
+            output["npvs"],
+            hist_systematics,
+            objects.npvs,
+            weight=weight,
+        )
+        if not isRealData:
+            fill_syst(
+                output["pu"],
+                hist_systematics,
+                objects.pu,
+                weight=weight,
+            )
+        return output
+
     def postprocess(self, accumulator):
         return accumulator
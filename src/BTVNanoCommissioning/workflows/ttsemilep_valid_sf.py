@@ -12,19 +12,37 @@ from BTVNanoCommissioning.utils.correction import (
     muSFs,
     puwei,
     btagSFs,
-    JME_shifts,
-    Roccor_shifts,
+    common_shifts,
 )
 from BTVNanoCommissioning.helpers.func import (
+    SelectedEvents,
     flatten,
     update,
     uproot_writeable,
-    dump_lumi,
+    dump_sumw,
+    jet_pfcands,
 )
 from BTVNanoCommissioning.helpers.update_branch import missing_branch
-from BTVNanoCommissioning.utils.histogrammer import histogrammer
-from BTVNanoCommissioning.utils.array_writer import array_writer
-from BTVNanoCommissioning.utils.selection import jet_id, btag_mu_idiso, MET_filters
+from BTVNanoCommissioning.utils.histogrammer import (
+    histogrammer,
+    syst_categories,
+    syst_weights,
+    fill_syst,
+)
+from BTVNanoCommissioning.utils.array_writer import (
+    array_writer,
+    flush_writers,
+    reset_writers,
+)
+from BTVNanoCommissioning.utils.reader import prefiltered
+from BTVNanoCommissioning.utils.trigger import trigger_mask
+from BTVNanoCommissioning.utils.selection import (
+    jet_id,
+    btag_mu_idiso,
+    MET_filters,
+    prefilter_mask,
+    dr_clean,
+)
 import hist
 
 
@@ -48,68 +66,62 @@ class NanoProcessor(processor.ProcessorABC):
         self.noHist = noHist
         self.lumiMask = load_lumi(self._campaign)
         self.chunksize = chunksize
+        self.selection_index = None
+        self.skim = None
+        self.triggers = ["IsoMu24"]
         ## Load corrections
         self.SF_map = load_SF(self._campaign)
+        self.systematics = syst_categories(
+            self.SF_map, self.isSyst, ["PU", "MUO", "BTV"]
+        )
 
     @property
     def accumulator(self):
         return self._accumulator
 
     def process(self, events):
+        # a retried chunk does not keep the arrays of its failed attempt
+        reset_writers()
         isRealData = not hasattr(events, "genWeight")
         dataset = events.metadata["dataset"]
-        events = missing_branch(events)
-        shifts = []
-        if "JME" in self.SF_map.keys():
-            syst_JERC = self.isSyst
-            if self.isSyst == "JERC_split":
-                syst_JERC = "split"
-            shifts = JME_shifts(
-                shifts, self.SF_map, events, self._campaign, isRealData, syst_JERC
-            )
-        else:
-            if int(self._year) < 2020:
-                shifts = [
-                    ({"Jet": events.Jet, "MET": events.MET, "Muon": events.Muon}, None)
-                ]
-            else:
-                shifts = [
-                    (
-                        {
-                            "Jet": events.Jet,
-                            "MET": events.PuppiMET,
-                            "Muon": events.Muon,
-                        },
-                        None,
-                    )
-                ]
-        if "roccor" in self.SF_map.keys():
-            shifts = Roccor_shifts(shifts, self.SF_map, events, isRealData, False)
-        else:
-            shifts[0][0]["Muon"] = events.Muon
+        output = {dataset: dump_sumw(events, self.lumiMask)}
+        if self.skim is not None:
+            self.skim.write_summary(events.metadata, output[dataset])
+        events = missing_branch(
+            prefiltered(events, self.prefilter, self.selection_index)
+        )
+        # sum of weights of the whole chunk, the events are prefiltered
+        sumw = output[dataset]["sumw"]
+        shifts = common_shifts(
+            events, self.SF_map, self._campaign, self._year, isRealData, self.isSyst
+        )
+        output = processor.accumulate(
+            (
+                self.process_shift(update(events, collections), name, sumw)
+                for collections, name in shifts
+            ),
+            output,
+        )
+        # the chunk is only done once its root files are written
+        flush_writers()
+        return output
 
-        return processor.accumulate(
-            self.process_shift(update(events, collections), name)
-            for collections, name in shifts
+    def prefilter(self, events):
+        # shift-independent part of the selection, run before the corrections
+        return prefilter_mask(
+            events,
+            self._campaign,
+            self.lumiMask if not hasattr(events, "genWeight") else None,
+            self.triggers,
+            metfilter=True,
+            nobjects=[(btag_mu_idiso(events, self._campaign), 1)],
         )
 
-    def process_shift(self, events, shift_name):
+    def process_shift(self, events, shift_name, sumw):
         dataset = events.metadata["dataset"]
         isRealData = not hasattr(events, "genWeight")
-        _hist_event_dict = (
-            {"": None} if self.noHist else histogrammer(events, "ttsemilep_sf")
-        )
+        output = {}
 
-        output = {
-            "sumw": processor.defaultdict_accumulator(float),
-            **_hist_event_dict,
-        }
-
-        if shift_name is None:
-            if isRealData:
-                output["sumw"] = len(events)
-            else:
-                output["sumw"] = ak.sum(events.genWeight)
         ####################
         #    Selections    #
         ####################
@@ -117,23 +129,9 @@ class NanoProcessor(processor.ProcessorABC):
         req_lumi = np.ones(len(events), dtype="bool")
         if isRealData:
             req_lumi = self.lumiMask(events.run, events.luminosityBlock)
-        # only dump for nominal case
-        if shift_name is None:
-            output = dump_lumi(events[req_lumi], output)
 
         ## HLT
-        triggers = ["IsoMu24"]
-        checkHLT = ak.Array([hasattr(events.HLT, _trig) for _trig in triggers])
-        if ak.all(checkHLT == False):
-            raise ValueError("HLT paths:", triggers, " are all invalid in", dataset)
-        elif ak.any(checkHLT == False):
-            print(np.array(triggers)[~checkHLT], " not exist in", dataset)
-        trig_arrs = [
-            events.HLT[_trig] for _trig in triggers if hasattr(events.HLT, _trig)
-        ]
-        req_trig = np.zeros(len(events), dtype="bool")
-        for t in trig_arrs:
-            req_trig = req_trig | t
+        req_trig = trigger_mask(events, self.triggers)
 
         ## Muon cuts
         # muon twiki: https://twiki.cern.ch/twiki/bin/view/CMS/SWGuideMuonIdRun2
@@ -144,37 +142,14 @@ class NanoProcessor(processor.ProcessorABC):
         req_muon = ak.count(event_muon.pt, axis=1) == 1
 
         ## Jet cuts
-        event_jet = events.Jet[
-            ak.fill_none(
-                jet_id(events, self._campaign)
-                & (
-                    ak.all(
-                        events.Jet.metric_table(events.Muon) > 0.4,
-                        axis=2,
-                        mask_identity=True,
-                    )
-                ),
-                False,
-                axis=-1,
-            )
-        ]
+        jet_sel = jet_id(events, self._campaign) & (
+            dr_clean(events.Jet, events.Muon, 0.4, mask_identity=True)
+        )
+        event_jet = events.Jet[ak.fill_none(jet_sel, False, axis=-1)]
         req_jets = ak.num(event_jet.pt) >= 4
 
         ## store jet index for PFCands, create mask on the jet index
-        jetindx = ak.mask(
-            ak.local_index(events.Jet.pt),
-            (
-                jet_id(events, self._campaign)
-                & (
-                    ak.all(
-                        events.Jet.metric_table(events.Muon) > 0.4,
-                        axis=2,
-                        mask_identity=True,
-                    )
-                )
-            )
-            == 1,
-        )
+        jetindx = ak.mask(ak.local_index(events.Jet.pt), jet_sel == 1)
         jetindx = ak.pad_none(jetindx, 4)
         jetindx = jetindx[:, :4]
 
@@ -196,15 +171,29 @@ class NanoProcessor(processor.ProcessorABC):
         event_level = ak.fill_none(
             req_trig & req_jets & req_muon & req_MET & req_lumi & req_metfilter, False
         )
-        if len(events[event_level]) == 0:
+        selev = SelectedEvents(
+            events,
+            event_level,
+            ["PV.npvs"] if isRealData else ["PV.npvs", "genWeight", "Pileup.nTrueInt"],
+        )
+        if len(selev) == 0:
+            if not self.noHist:
+                output.update(
+                    histogrammer(
+                        events,
+                        "ttsemilep_sf",
+                        ["nominal"] if isRealData else self.systematics,
+                    )
+                )
             if self.isArray:
                 array_writer(
                     self,
-                    events[event_level],
+                    selev.events,
                     events,
                     "nominal",
                     dataset,
                     isRealData,
+                    sumw,
                     empty=True,
                 )
             return {dataset: output}
@@ -219,32 +208,21 @@ class NanoProcessor(processor.ProcessorABC):
         smet = MET[event_level]
         # Find the PFCands associate with selected jets. Search from jetindex->JetPFCands->PFCand
         if "PFCands" in events.fields:
-            jetindexall = collections.defaultdict(dict)
-            spfcands = collections.defaultdict(dict)
-            for i in range(4):
-                jetindexall[i] = jetindx[:, i]
-                spfcands[i] = events[event_level].PFCands[
-                    events[event_level]
-                    .JetPFCands[
-                        events[event_level].JetPFCands.jetIdx
-                        == jetindexall[i][event_level]
-                    ]
-                    .pFCandsIdx
-                ]
+            spfcands = jet_pfcands(selev, jetindx[event_level])
 
         ####################
         # Weight & Geninfo #
         ####################
-        weights = Weights(len(events[event_level]), storeIndividual=True)
+        weights = Weights(len(selev), storeIndividual=True)
         if not isRealData:
-            weights.add("genweight", events[event_level].genWeight)
+            weights.add("genweight", selev["genWeight"])
             par_flav = (sjets.partonFlavour == 0) & (sjets.hadronFlavour == 0)
             genflavor = ak.values_astype(sjets.hadronFlavour + 1 * par_flav, int)
             if len(self.SF_map.keys()) > 0:
                 syst_wei = True if self.isSyst != False else False
                 if "PU" in self.SF_map.keys():
                     puwei(
-                        events[event_level].Pileup.nTrueInt,
+                        selev["Pileup.nTrueInt"],
                         self.SF_map,
                         weights,
                         syst_wei,
@@ -274,129 +252,58 @@ class NanoProcessor(processor.ProcessorABC):
         ####################
         #  Fill histogram  #
         ####################
-        for syst in systematics:
-            if self.isSyst == False and syst != "nominal":
-                break
-            if self.noHist:
-                break
-
-            weight = (
-                weights.weight()
-                if syst == "nominal" or syst == shift_name
-                else weights.weight(modifier=syst)
+        hist_systematics = [
+            syst for syst in systematics if self.isSyst != False or syst == "nominal"
+        ]
+        if len(hist_systematics) > 0 and (not self.noHist or self.skim is not None):
+            # objects the histograms are filled from, also stored in the skim
+            objects = ak.zip(
+                {
+                    "Jet": sjets,
+                    "Muon": smu,
+                    "MET": smet,
+                    "njet": nseljet,
+                    "genflavor": genflavor,
+                    "npvs": selev["PV.npvs"],
+                    "btv_weight": weights.partial_weight(exclude=exclude_btv),
+                    **({"PFCands": spfcands} if "PFCands" in events.fields else {}),
+                    **({} if isRealData else {"pu": selev["Pileup.nTrueInt"]}),
+                },
+                depth_limit=1,
             )
-            for histname, h in output.items():
-                if (
-                    "Deep" in histname
-                    and "btag" not in histname
-                    and histname in events.Jet.fields
-                ):
-                    h.fill(
-                        syst,
-                        flatten(genflavor),
-                        flatten(sjets[histname]),
-                        weight=flatten(
-                            ak.broadcast_arrays(
-                                weights.partial_weight(exclude=exclude_btv), sjets["pt"]
-                            )[0]
-                        ),
-                    )
-                elif (
-                    "PFCands" in histname
-                    and "PFCands" in events.fields
-                    and histname.split("_")[1] in events.PFCands.fields
-                ):
-                    for i in range(4):
-                        h.fill(
-                            syst,
-                            flatten(
-                                ak.broadcast_arrays(
-                                    genflavor[:, i],
-                                    spfcands[i]["pt"],
-                                )[0]
-                            ),
-                            flatten(spfcands[i][histname.replace("PFCands_", "")]),
-                            weight=flatten(
-                                ak.broadcast_arrays(
-                                    weights.partial_weight(exclude=exclude_btv),
-                                    spfcands[i]["pt"],
-                                )[0]
-                            ),
-                        )
-                elif "btag" in histname:
-                    for i in range(4):
-                        sel_jet = sjets[:, i]
-                        if (
-                            str(i) in histname
-                            and histname.replace(f"_{i}", "") in events.Jet.fields
-                        ):
-                            h.fill(
-                                syst="noSF",
-                                flav=genflavor[:, i],
-                                discr=sel_jet[histname.replace(f"_{i}", "")],
-                                weight=weight,
-                            )
-                            if (
-                                not isRealData
-                                and "btag" in self.SF_map.keys()
-                                and "_b" not in histname
-                                and "_bb" not in histname
-                                and "_lepb" not in histname
-                            ):
-                                h.fill(
-                                    syst=syst,
-                                    flav=genflavor[:, i],
-                                    discr=sel_jet[histname.replace(f"_{i}", "")],
-                                    weight=weight,
-                                )
-                elif "mu_" in histname and histname.replace("mu_", "") in smu.fields:
-                    h.fill(
-                        syst,
-                        flatten(smu[histname.replace("mu_", "")]),
-                        weight=weight,
-                    )
-                elif "jet" in histname and "dr" not in histname and "njet" != histname:
-                    for i in range(4):
-                        sel_jet = sjets[:, i]
-                        if str(i) in histname:
-                            h.fill(
-                                syst,
-                                flatten(genflavor[:, i]),
-                                flatten(sel_jet[histname.replace(f"jet{i}_", "")]),
-                                weight=weight,
-                            )
-
-            for i in range(4):
-                output[f"dr_mujet{i}"].fill(
-                    syst,
-                    flav=flatten(genflavor[:, i]),
-                    dr=flatten(smu.delta_r(sjets[:, i])),
-                    weight=weight,
+            # weights of all the systematics, each histogram is filled once
+            weight = syst_weights(weights, hist_systematics, shift_name)
+            if self.skim is not None:
+                self.skim.write(
+                    events.metadata,
+                    shift_name,
+                    objects,
+                    weight,
+                    hist_systematics,
+                    isRealData,
                 )
-            output["njet"].fill(syst, nseljet, weight=weight)
-            output["MET_pt"].fill(syst, flatten(smet.pt), weight=weight)
-            output["MET_phi"].fill(syst, flatten(smet.phi), weight=weight)
-            output["npvs"].fill(
-                syst,
-                events[event_level].PV.npvs,
-                weight=weight,
-            )
-            if not isRealData:
-                output["pu"].fill(
-                    syst,
-                    events[event_level].Pileup.nTrueInt,
-                    weight=weight,
+            if not self.noHist:
+                output.update(
+                    self.fill_histograms(objects, weight, hist_systematics, isRealData)
                 )
+        elif not self.noHist:
+            output.update(
+                histogrammer(
+                    events,
+                    "ttsemilep_sf",
+                    ["nominal"] if isRealData else self.systematics,
+                )
+            )
         #######################
         #  Create root files  #
         #######################
         if self.isArray:
             # Keep the structure of events and pruned the object size
-            pruned_ev = events[event_level]
+            pruned_ev = selev.events
             pruned_ev["SelJet"] = sjets
             pruned_ev["Muon"] = smu
             if "PFCands" in events.fields:
-                pruned_ev.PFCands = spfcands
+                pruned_ev.PFCands = ak.flatten(spfcands, axis=2)
             # Add custom variables
             if not isRealData:
                 pruned_ev["weight"] = weights.weight()
@@ -407,8 +314,120 @@ class NanoProcessor(processor.ProcessorABC):
 
             for i in range(4):
                 pruned_ev[f"dr_mujet{i}"] = smu.delta_r(sjets[:, i])
-            array_writer(self, pruned_ev, events, systematics[0], dataset, isRealData)
+            array_writer(
+                self, pruned_ev, events, systematics[0], dataset, isRealData, sumw
+            )
         return {dataset: output}
 
+    def fill_histograms(self, objects, weight, hist_systematics, isRealData):
+        """histograms of the selected objects of a shift, from process_shift or the skim"""
+        output = histogrammer(
+            objects, "ttsemilep_sf", ["nominal"] if isRealData else self.systematics
+        )
+        sjets, smu, genflavor = objects.Jet, objects.Muon, objects.genflavor
+        btv_weight = objects.btv_weight
+        for histname, h in output.items():
+            if (
+                "Deep" in histname
+                and "btag" not in histname
+                and histname in sjets.fields
+            ):
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    flatten(genflavor),
+                    flatten(sjets[histname]),
+                    weight=btv_weight,
+                    counts=ak.num(sjets),
+                )
+            elif (
+                "PFCands" in histname
+                and "PFCands" in objects.fields
+                and histname.split("_")[1] in objects.PFCands.fields
+            ):
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    flatten(ak.broadcast_arrays(genflavor, objects.PFCands["pt"])[0]),
+                    flatten(objects.PFCands[histname.replace("PFCands_", "")]),
+                    weight=btv_weight,
+                    counts=ak.sum(ak.num(objects.PFCands, axis=2), axis=1),
+                )
+            elif "btag" in histname:
+                for i in range(4):
+                    sel_jet = sjets[:, i]
+                    if (
+                        str(i) in histname
+                        and histname.replace(f"_{i}", "") in sjets.fields
+                    ):
+                        h.fill(
+                            syst="noSF",
+                            flav=genflavor[:, i],
+                            discr=sel_jet[histname.replace(f"_{i}", "")],
+                            weight=weight[0],
+                        )
+                        if (
+                            not isRealData
+                            and "btag" in self.SF_map.keys()
+                            and "_b" not in histname
+                            and "_bb" not in histname
+                            and "_lepb" not in histname
+                        ):
+                            fill_syst(
+                                h,
+                                hist_systematics,
+                                flav=genflavor[:, i],
+                                discr=sel_jet[histname.replace(f"_{i}", "")],
+                                weight=weight,
+                            )
+            elif "mu_" in histname and histname.replace("mu_", "") in smu.fields:
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    flatten(smu[histname.replace("mu_", "")]),
+                    weight=weight,
+                )
+            elif "jet" in histname and "dr" not in histname and "njet" != histname:
+                for i in range(4):
+                    sel_jet = sjets[:, i]
+                    if str(i) in histname:
+                        fill_syst(
+                            h,
+                            hist_systematics,
+                            flatten(genflavor[:, i]),
+                            flatten(sel_jet[histname.replace(f"jet{i}_", "")]),
+                            weight=weight,
+                        )
+
+        for i in range(4):
+            fill_syst(
+                output[f"dr_mujet{i}"],
+                hist_systematics,
+                flav=flatten(genflavor[:, i]),
+                dr=flatten(smu.delta_r(sjets[:, i])),
+                weight=weight,
+            )
+        fill_syst(output["njet"], hist_systematics, objects.njet, weight=weight)
+        fill_syst(
+            output["MET_pt"], hist_systematics, flatten(objects.MET.pt), weight=weight
+        )
+        fill_syst(
+            output["MET_phi"], hist_systematics, flatten(objects.MET.phi), weight=weight
+        )
+        fill_syst(
+            output["npvs"],
+            hist_systematics,
+            objects.npvs,
+            weight=weight,
+        )
+        if not isRealData:
+            fill_syst(
+                output["pu"],
+                hist_systematics,
+                objects.pu,
+                weight=weight,
+            )
+        return output
+
     def postprocess(self, accumulator):
         return accumulator
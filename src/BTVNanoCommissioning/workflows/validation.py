@@ -1,4 +1,4 @@
-import collections, awkward as ak, numpy as np
+import awkward as ak, numpy as np
 import os
 import uproot
 
@@ -14,25 +14,37 @@ from BTVNanoCommissioning.utils.correction import (
     load_SF,
     puwei,
     btagSFs,
-    JME_shifts,
-    Roccor_shifts,
+    common_shifts,
 )
 
 from BTVNanoCommissioning.helpers.func import (
+    SelectedEvents,
     flatten,
     update,
-    dump_lumi,
+    dump_sumw,
 )
 from BTVNanoCommissioning.helpers.update_branch import missing_branch
 
-from BTVNanoCommissioning.utils.histogrammer import histogrammer
-from BTVNanoCommissioning.utils.array_writer import array_writer
+from BTVNanoCommissioning.utils.histogrammer import (
+    histogrammer,
+    syst_categories,
+    syst_weights,
+    fill_syst,
+)
+from BTVNanoCommissioning.utils.array_writer import (
+    array_writer,
+    flush_writers,
+    reset_writers,
+)
+from BTVNanoCommissioning.utils.reader import prefiltered
 from BTVNanoCommissioning.utils.selection import (
     jet_id,
     mu_idiso,
     ele_mvatightid,
     btag_wp,
     btag_wp_dict,
+    dr_clean,
+    prefilter_mask,
 )
 
 
@@ -56,68 +68,55 @@ class NanoProcessor(processor.ProcessorABC):
         self.noHist = noHist
         self.lumiMask = load_lumi(self._campaign)
         self.chunksize = chunksize
+        self.selection_index = None
+        self.skim = None
         ## Load corrections
         self.SF_map = load_SF(self._campaign)
+        self.systematics = syst_categories(self.SF_map, self.isSyst, ["PU", "BTV"])
 
     @property
     def accumulator(self):
         return self._accumulator
 
     def process(self, events):
+        # a retried chunk does not keep the arrays of its failed attempt
+        reset_writers()
         isRealData = not hasattr(events, "genWeight")
         dataset = events.metadata["dataset"]
-        events = missing_branch(events)
-        shifts = []
-        if "JME" in self.SF_map.keys():
-            syst_JERC = self.isSyst
-            if self.isSyst == "JERC_split":
-                syst_JERC = "split"
-            shifts = JME_shifts(
-                shifts, self.SF_map, events, self._campaign, isRealData, syst_JERC
-            )
-        else:
-            if int(self._year) < 2020:
-                shifts = [
-                    ({"Jet": events.Jet, "MET": events.MET, "Muon": events.Muon}, None)
-                ]
-            else:
-                shifts = [
-                    (
-                        {
-                            "Jet": events.Jet,
-                            "MET": events.PuppiMET,
-                            "Muon": events.Muon,
-                        },
-                        None,
-                    )
-                ]
-        if "roccor" in self.SF_map.keys():
-            shifts = Roccor_shifts(shifts, self.SF_map, events, isRealData, False)
-        else:
-            shifts[0][0]["Muon"] = events.Muon
+        output = {dataset: dump_sumw(events, self.lumiMask)}
+        if self.skim is not None:
+            self.skim.write_summary(events.metadata, output[dataset])
+        events = missing_branch(
+            prefiltered(events, self.prefilter, self.selection_index)
+        )
+        # sum of weights of the whole chunk, the events are prefiltered
+        sumw = output[dataset]["sumw"]
+        shifts = common_shifts(
+            events, self.SF_map, self._campaign, self._year, isRealData, self.isSyst
+        )
+        output = processor.accumulate(
+            (
+                self.process_shift(update(events, collections), name, sumw)
+                for collections, name in shifts
+            ),
+            output,
+        )
+        # the chunk is only done once its root files are written
+        flush_writers()
+        return output
 
-        return processor.accumulate(
-            self.process_shift(update(events, collections), name)
-            for collections, name in shifts
+    def prefilter(self, events):
+        # shift-independent part of the selection, run before the corrections
+        return prefilter_mask(
+            events,
+            self._campaign,
+            self.lumiMask if not hasattr(events, "genWeight") else None,
         )
 
-    def process_shift(self, events, shift_name):
+    def process_shift(self, events, shift_name, sumw):
         dataset = events.metadata["dataset"]
         isRealData = not hasattr(events, "genWeight")
-        _hist_event_dict = (
-            {"": None} if self.noHist else histogrammer(events, "validation")
-        )
-
-        output = {
-            "sumw": processor.defaultdict_accumulator(float),
-            **_hist_event_dict,
-        }
-
-        if shift_name is None:
-            if isRealData:
-                output["sumw"] = len(events)
-            else:
-                output["sumw"] = ak.sum(events.genWeight)
+        output = {}
 
         ####################
         #    Selections    #
@@ -126,90 +125,54 @@ class NanoProcessor(processor.ProcessorABC):
         req_lumi = np.ones(len(events), dtype="bool")
         if isRealData:
             req_lumi = self.lumiMask(events.run, events.luminosityBlock)
-        # only dump for nominal case
-        if shift_name is None:
-            output = dump_lumi(events[req_lumi], output)
-
-        ## HLT
-        triggers = ["IsoMu24"]
-        checkHLT = ak.Array([hasattr(events.HLT, _trig) for _trig in triggers])
-        if ak.all(checkHLT == False):
-            raise ValueError("HLT paths:", triggers, " are all invalid in", dataset)
-        elif ak.any(checkHLT == False):
-            print(np.array(triggers)[~checkHLT], " not exist in", dataset)
-        trig_arrs = [
-            events.HLT[_trig] for _trig in triggers if hasattr(events.HLT, _trig)
-        ]
-        req_trig = np.zeros(len(events), dtype="bool")
-        for t in trig_arrs:
-            req_trig = req_trig | t
 
         ## Jet cuts
         event_jet = events.Jet[
             jet_id(events, self._campaign)
-            & (ak.all(events.Jet.metric_table(events.Muon) > 0.4, axis=2))
-            & (ak.all(events.Jet.metric_table(events.Electron) > 0.4, axis=2))
+            & (dr_clean(events.Jet, events.Muon, 0.4))
+            & (dr_clean(events.Jet, events.Electron, 0.4))
         ]
         req_jets = ak.num(event_jet.pt) >= 2
 
-        ## store jet index for PFCands, create mask on the jet index
-        jetindx = ak.mask(
-            ak.local_index(events.Jet.pt),
-            (
-                jet_id(events, self._campaign)
-                & (ak.all(events.Jet.metric_table(events.Muon) > 0.4, axis=2))
-                & (ak.all(events.Jet.metric_table(events.Electron) > 0.4, axis=2))
-            )
-            == 1,
-        )
-        jetindx = ak.pad_none(jetindx, 2)
-        jetindx = jetindx[:, :2]
-
         event_level = ak.fill_none(req_jets & req_lumi, False)
-        if len(events[event_level]) == 0:
+        selev = SelectedEvents(
+            events,
+            event_level,
+            [] if isRealData else ["genWeight", "Pileup.nTrueInt"],
+        )
+        if len(selev) == 0:
+            if not self.noHist:
+                output.update(
+                    histogrammer(
+                        events,
+                        "validation",
+                        ["nominal"] if isRealData else self.systematics,
+                    )
+                )
             return {dataset: output}
         ####################
         # Selected objects #
         ####################
         sjets = event_jet[event_level]
         sjets = sjets[:, :2]
-        # Find the PFCands associate with selected jets. Search from jetindex->JetPFCands->PFCand
-        if "PFCands" in events.fields:
-            jetindx0 = jetindx[:, 0]
-            jetindx1 = jetindx[:, 1]
-            spfcands = collections.defaultdict(dict)
-            spfcands[0] = events[event_level].PFCands[
-                events[event_level]
-                .JetPFCands[
-                    events[event_level].JetPFCands.jetIdx == jetindx0[event_level]
-                ]
-                .pFCandsIdx
-            ]
-            spfcands[1] = events[event_level].PFCands[
-                events[event_level]
-                .JetPFCands[
-                    events[event_level].JetPFCands.jetIdx == jetindx1[event_level]
-                ]
-                .pFCandsIdx
-            ]
 
         ####################
         # Weight & Geninfo #
         ####################
 
-        weights = Weights(len(events[event_level]), storeIndividual=True)
+        weights = Weights(len(selev), storeIndividual=True)
         if not isRealData:
-            weights.add("genweight", events[event_level].genWeight)
+            weights.add("genweight", selev["genWeight"])
             par_flav = (sjets.partonFlavour == 0) & (sjets.hadronFlavour == 0)
             genflavor = ak.values_astype(sjets.hadronFlavour + 1 * par_flav, int)
             genweiev = ak.flatten(
-                ak.broadcast_arrays(events[event_level].genWeight, sjets["pt"])[0]
+                ak.broadcast_arrays(selev["genWeight"], sjets["pt"])[0]
             )
             if len(self.SF_map.keys()) > 0:
                 syst_wei = True if self.isSyst == True else False
                 if "PU" in self.SF_map.keys():
                     puwei(
-                        events[event_level].Pileup.nTrueInt,
+                        selev["Pileup.nTrueInt"],
                         self.SF_map,
                         weights,
                         syst_wei,
@@ -237,140 +200,48 @@ class NanoProcessor(processor.ProcessorABC):
         ####################
         #  Fill histogram  #
         ####################
-        for syst in systematics:
-            if self.isSyst == False and syst != "nominal":
-                break
-            if self.noHist:
-                break
-            weight = (
-                weights.weight()
-                if syst == "nominal" or syst == shift_name
-                else weights.weight(modifier=syst)
+        hist_systematics = [
+            syst for syst in systematics if self.isSyst != False or syst == "nominal"
+        ]
+        if len(hist_systematics) > 0 and (not self.noHist or self.skim is not None):
+            # objects the histograms are filled from, also stored in the skim
+            objects = ak.zip(
+                {
+                    "Jet": sjets,
+                    "genflavor": genflavor,
+                    "btv_weight": weights.partial_weight(exclude=exclude_btv),
+                },
+                depth_limit=1,
+            )
+            # weights of all the systematics, each histogram is filled once
+            weight = syst_weights(weights, hist_systematics, shift_name)
+            if self.skim is not None:
+                self.skim.write(
+                    events.metadata,
+                    shift_name,
+                    objects,
+                    weight,
+                    hist_systematics,
+                    isRealData,
+                )
+            if not self.noHist:
+                output.update(
+                    self.fill_histograms(objects, weight, hist_systematics, isRealData)
+                )
+        elif not self.noHist:
+            output.update(
+                histogrammer(
+                    events,
+                    "validation",
+                    ["nominal"] if isRealData else self.systematics,
+                )
             )
-            for histname, h in output.items():
-                if (
-                    "Deep" in histname
-                    and "btag" not in histname
-                    and histname in events.Jet.fields
-                ):
-                    h.fill(
-                        syst,
-                        flatten(genflavor),
-                        flatten(sjets[histname]),
-                        weight=flatten(
-                            ak.broadcast_arrays(
-                                weights.partial_weight(exclude=exclude_btv), sjets["pt"]
-                            )[0]
-                        ),
-                    )
-                elif "WP" in histname:
-                    jet = sjets[:, 0]
-
-                    for tagger in btag_wp_dict[self._campaign].keys():
-                        if "bjet" in histname:
-                            for wp in btag_wp_dict[self._campaign][tagger]["b"].keys():
-                                wp_weight = weight[
-                                    btag_wp(
-                                        jet,
-                                        self._campaign,
-                                        tagger,
-                                        "b",
-                                        wp,
-                                    )
-                                    & (jet.hadronFlavour == 5)
-                                ]
-                                wp_jet = jet[
-                                    btag_wp(
-                                        jet,
-                                        self._campaign,
-                                        tagger,
-                                        "b",
-                                        wp,
-                                    )
-                                    & (jet.hadronFlavour == 5)
-                                ]
-
-                                if "discr" in histname:
-                                    h.fill(
-                                        wp,
-                                        tagger,
-                                        wp_jet[f"btag{tagger}B"],
-                                        weight=wp_weight,
-                                    )
-                                else:
-                                    h.fill(
-                                        wp,
-                                        tagger,
-                                        wp_jet[histname.replace("bjet_WP_", "")],
-                                        weight=wp_weight,
-                                    )
-                        elif "cjet" in histname:
-                            for wp in btag_wp_dict[self._campaign][tagger]["c"].keys():
-                                wp_weight = weight[
-                                    btag_wp(
-                                        jet,
-                                        self._campaign,
-                                        tagger,
-                                        "c",
-                                        wp,
-                                    )
-                                    & (jet.hadronFlavour == 4)
-                                ]
-                                wp_jet = jet[
-                                    btag_wp(
-                                        jet,
-                                        self._campaign,
-                                        tagger,
-                                        "c",
-                                        wp,
-                                    )
-                                    & (jet.hadronFlavour == 4)
-                                ]
-
-                                if "discr" in histname:
-                                    h.fill(
-                                        wp,
-                                        tagger,
-                                        wp_jet[f"btag{tagger}CvL"],
-                                        wp_jet[f"btag{tagger}CvB"],
-                                        weight=wp_weight,
-                                    )
-                                else:
-                                    h.fill(
-                                        wp,
-                                        tagger,
-                                        wp_jet[histname.replace("cjet_WP_", "")],
-                                        weight=wp_weight,
-                                    )
-                elif "jet" in histname:
-                    for i in range(2):
-                        if histname.replace(f"jet{i}_", "") not in sjets.fields:
-                            continue
-                        jet = sjets[:, i]
-                        h.fill(
-                            syst,
-                            flatten(genflavor[:, i]),
-                            flatten(jet[histname.replace(f"jet{i}_", "")]),
-                            weight=weight,
-                        )
-                elif "btag" in histname:
-                    for i in range(2):
-                        if histname.replace(f"_{i}", "") not in sjets.fields:
-                            continue
-                        # print(histname.replace(f"_{i}", ""))
-                        jet = sjets[:, i]
-                        h.fill(
-                            "noSF",
-                            flav=flatten(genflavor[:, i]),
-                            discr=jet[histname.replace(f"_{i}", "")],
-                            weight=weight,
-                        )
         #######################
         #  Create root files  #
         #######################
         if self.isArray:
             # Keep the structure of events and pruned the object size
-            pruned_ev = events[event_level]
+            pruned_ev = selev.events
             pruned_ev["SelJet"] = sjets
 
             # Add custom variables
@@ -380,8 +251,135 @@ class NanoProcessor(processor.ProcessorABC):
                     pruned_ev[f"{ind_wei}_weight"] = weights.partial_weight(
                         include=[ind_wei]
                     )
-            array_writer(self, pruned_ev, events, systematics[0], dataset, isRealData)
+            array_writer(
+                self, pruned_ev, events, systematics[0], dataset, isRealData, sumw
+            )
         return {dataset: output}
 
+    def fill_histograms(self, objects, weight, hist_systematics, isRealData):
+        """histograms of the selected objects of a shift, from process_shift or the skim"""
+        output = histogrammer(
+            objects, "validation", ["nominal"] if isRealData else self.systematics
+        )
+        sjets, genflavor = objects.Jet, objects.genflavor
+        for histname, h in output.items():
+            if (
+                "Deep" in histname
+                and "btag" not in histname
+                and histname in sjets.fields
+            ):
+                fill_syst(
+                    h,
+                    hist_systematics,
+                    flatten(genflavor),
+                    flatten(sjets[histname]),
+                    weight=objects.btv_weight,
+                    counts=ak.num(sjets),
+                )
+            elif "WP" in histname:
+                jet = sjets[:, 0]
+
+                for tagger in btag_wp_dict[self._campaign].keys():
+                    if "bjet" in histname:
+                        for wp in btag_wp_dict[self._campaign][tagger]["b"].keys():
+                            wp_weight = weight[0][
+                                btag_wp(
+                                    jet,
+                                    self._campaign,
+                                    tagger,
+                                    "b",
+                                    wp,
+                                )
+                                & (jet.hadronFlavour == 5)
+                            ]
+                            wp_jet = jet[
+                                btag_wp(
+                                    jet,
+                                    self._campaign,
+                                    tagger,
+                                    "b",
+                                    wp,
+                                )
+                                & (jet.hadronFlavour == 5)
+                            ]
+
+                            if "discr" in histname:
+                                h.fill(
+                                    wp,
+                                    tagger,
+                                    wp_jet[f"btag{tagger}B"],
+                                    weight=wp_weight,
+                                )
+                            else:
+                                h.fill(
+                                    wp,
+                                    tagger,
+                                    wp_jet[histname.replace("bjet_WP_", "")],
+                                    weight=wp_weight,
+                                )
+                    elif "cjet" in histname:
+                        for wp in btag_wp_dict[self._campaign][tagger]["c"].keys():
+                            wp_weight = weight[0][
+                                btag_wp(
+                                    jet,
+                                    self._campaign,
+                                    tagger,
+                                    "c",
+                                    wp,
+                                )
+                                & (jet.hadronFlavour == 4)
+                            ]
+                            wp_jet = jet[
+                                btag_wp(
+                                    jet,
+                                    self._campaign,
+                                    tagger,
+                                    "c",
+                                    wp,
+                                )
+                                & (jet.hadronFlavour == 4)
+                            ]
+
+                            if "discr" in histname:
+                                h.fill(
+                                    wp,
+                                    tagger,
+                                    wp_jet[f"btag{tagger}CvL"],
+                                    wp_jet[f"btag{tagger}CvB"],
+                                    weight=wp_weight,
+                                )
+                            else:
+                                h.fill(
+                                    wp,
+                                    tagger,
+                                    wp_jet[histname.replace("cjet_WP_", "")],
+                                    weight=wp_weight,
+                                )
+            elif "jet" in histname:
+                for i in range(2):
+                    if histname.replace(f"jet{i}_", "") not in sjets.fields:
+                        continue
+                    jet = sjets[:, i]
+                    fill_syst(
+                        h,
+                        hist_systematics,
+                        flatten(genflavor[:, i]),
+                        flatten(jet[histname.replace(f"jet{i}_", "")]),
+                        weight=weight,
+                    )
+            elif "btag" in histname:
+                for i in range(2):
+                    if histname.replace(f"_{i}", "") not in sjets.fields:
+                        continue
+                    # print(histname.replace(f"_{i}", ""))
+                    jet = sjets[:, i]
+                    h.fill(
+                        "noSF",
+                        flav=flatten(genflavor[:, i]),
+                        discr=jet[histname.replace(f"_{i}", "")],
+                        weight=weight[0],
+                    )
+        return output
+
     def postprocess(self, accumulator):
         return accumulator
@@ -0,0 +1,194 @@
+import awkward as ak
+import numpy as np
+import pytest
+import uproot
+from coffea.nanoevents import NanoAODSchema, NanoEventsFactory
+
+from BTVNanoCommissioning.helpers.BTA_helper import GenPartIndex
+
+
+def is_from_GSP(GenPart):
+    """the previous loop over GenPart.parent, as reference"""
+    QGP = (
+        (GenPart.genPartIdxMother >= 0)
+        & (GenPart.genPartIdxMother2 == -1)
+        & (abs(GenPart.parent.pdgId) == 21)
+        & (
+            (abs(GenPart.parent.pdgId) == abs(GenPart.pdgId))
+            | abs(GenPart.parent.pdgId)
+            == 21
+        )
+        & ~(
+            (abs(GenPart.pdgId) == abs(GenPart.parent.pdgId))
+            & (GenPart.parent.status >= 21)
+            & (GenPart.parent.status <= 29)
+        )
+    )
+    rest_QGP = ak.mask(GenPart, ~QGP)
+    restGenPart = rest_QGP.parent
+    while ak.any(ak.is_none(restGenPart.parent.pdgId, axis=-1) == False):
+        mask_forbad = (
+            (restGenPart.genPartIdxMother >= 0)
+            & (restGenPart.genPartIdxMother2 == -1)
+            & (
+                (abs(restGenPart.parent.pdgId) == abs(restGenPart.pdgId))
+                | abs(restGenPart.parent.pdgId)
+                == 21
+            )
+            & ~(
+                (abs(restGenPart.pdgId) == abs(GenPart.parent.pdgId))
+                & (restGenPart.parent.status >= 21)
+                & (restGenPart.parent.status <= 29)
+            )
+        )
+        mask_forbad = ak.fill_none(mask_forbad, False)
+        QGP = (mask_forbad & ak.fill_none((abs(restGenPart.pdgId == 21)), False)) | QGP
+
+        rest_QGP = ak.mask(restGenPart, (~QGP) & (mask_forbad))
+        restGenPart = rest_QGP.parent
+        if ak.all(restGenPart.parent.pdgId == True):
+            break
+
+    return ak.fill_none(QGP, False)
+
+
+_fix = lambda x: ak.fill_none(x, 0)
+is_heavy_hadron = lambda p, pid: (abs(_fix(p.pdgId)) // 100 == pid) | (
+    abs(_fix(p.pdgId)) // 1000 == pid
+)
+is_lep = (
+    lambda p: (abs(_fix(p.pdgId)) == 11)
+    | (abs(_fix(p.pdgId)) == 13)
+    | (abs(_fix(p.pdgId)) == 15)
+)
+is_WZ = lambda p: (abs(_fix(p.pdgId)) == 23) | (abs(_fix(p.pdgId)) == 24)
+
+
+def take(values, index):
+    """values[index] for an index of dim (event, particle, ...)"""
+    taken = ak.flatten(values[ak.flatten(index, axis=2)])
+    return ak.unflatten(
+        ak.unflatten(taken, ak.flatten(ak.num(index, axis=2))), ak.num(index)
+    )
+
+
+@pytest.fixture(scope="module")
+def GenPart(tmp_path_factory):
+    """random decay trees, mothers before their daughters, every pt different"""
+    rng = np.random.default_rng(42)
+    counts = rng.integers(0, 30, 200)
+    n = counts.sum()
+    local = np.arange(n) - np.repeat(np.cumsum(counts) - counts, counts)
+    mother = np.where(local > 0, (rng.random(n) * local).astype(int), -1)
+    mother[rng.random(n) < 0.05] = -1
+    # enough gluons and heavy quarks for the gluon splitting chains
+    pdgIds = [21] * 6 + [4, -4, 5, -5] * 2 + [511, -521, 5122, 421, -413, 4122]
+    pdgIds += [13, -13, 11, 15, 211, -321, 310, 3122, 23, 24, 2212]
+    unflatten = lambda values, dtype: ak.unflatten(values.astype(dtype), counts)
+    branches = {
+        "pt": unflatten(0.5 + 0.01 * rng.permutation(n), np.float32),
+        "eta": unflatten(rng.uniform(-3, 3, n), np.float32),
+        "phi": unflatten(rng.uniform(-3, 3, n), np.float32),
+        "mass": unflatten(np.zeros(n), np.float32),
+        "pdgId": unflatten(rng.choice(pdgIds, n), np.int32),
+        "status": unflatten(rng.choice([1, 2, 21, 23, 29, 51, 71], n), np.int32),
+        # isLastCopy
+        "statusFlags": unflatten(np.where(rng.random(n) < 0.8, 1 << 13, 0), np.int32),
+        "genPartIdxMother": unflatten(mother, np.int32),
+        "genPartIdxMother2": unflatten(
+            np.where(rng.random(n) < 0.1, mother, -1), np.int32
+        ),
+    }
+    path = str(tmp_path_factory.mktemp("genpart") / "nano.root")
+    with uproot.recreate(path) as fout:
+        fout["Events"] = {"GenPart": ak.zip(branches)}
+    return NanoEventsFactory.from_root(path, schemaclass=NanoAODSchema).events().GenPart
+
+
+def test_from_GSP(GenPart):
+    """gluon splitting flag of the b and c quarks, as the loop over .parent"""
+    genparts = GenPartIndex(GenPart)
+    for pid in [4, 5]:
+        sel = (abs(GenPart.pdgId) == pid) & GenPart.hasFlags("isLastCopy")
+        expected = is_from_GSP(GenPart[sel])
+        assert ak.any(expected)
+        assert genparts.from_GSP(sel).tolist() == expected.tolist()
+
+
+def test_daughters(GenPart):
+    """D/B hadron and V0 daughters, as the .children chains"""
+    genparts = GenPartIndex(GenPart)
+    isDhadron = is_heavy_hadron(GenPart, 4)
+    isBhadron = is_heavy_hadron(GenPart, 5)
+    children = GenPart.children
+    assert (
+        genparts.n_daughters(isDhadron).tolist()
+        == ak.sum(is_heavy_hadron(children, 4), axis=-1).tolist()
+    )
+    assert (genparts.n_daughters(abs(GenPart.pdgId) == 13) > 0).tolist() == ak.any(
+        abs(children.pdgId) == 13, axis=-1
+    ).tolist()
+
+    # final D hadrons within three generations of the B hadrons
+    isfinalD = isDhadron & (genparts.n_daughters(isDhadron) == 0)
+    bsel = isBhadron & GenPart.hasFlags("isLastCopy")
+    bhad_ch1G = GenPart[bsel].children
+    bhad_ch2G = bhad_ch1G.children
+    bhad_ch3G = bhad_ch2G.children
+    bhad_ch4G = bhad_ch3G.children
+    final = lambda ch, gch: ch.pt[
+        is_heavy_hadron(ch, 4) & ~ak.any(is_heavy_hadron(gch, 4), axis=-1)
+    ]
+    expected = ak.concatenate(
+        [
+            final(bhad_ch1G, bhad_ch2G),
+            ak.flatten(final(bhad_ch2G, bhad_ch3G), axis=3),
+            ak.flatten(ak.flatten(final(bhad_ch3G, bhad_ch4G), axis=4), axis=3),
+        ],
+        axis=2,
+    )
+    chad_index = genparts.descendants(bsel, isfinalD, 3)
+    assert ak.sum(ak.num(chad_index, axis=2)) > 0
+    assert take(GenPart[isfinalD].pt, chad_index).tolist() == expected.tolist()
+
+    # charged daughters of the V0
+    is_charged = lambda p: (
+        (abs(p.pdgId) == 211)
+        | (abs(p.pdgId) == 213)
+        | (abs(p.pdgId) == 321)
+        | (abs(p.pdgId) == 323)
+        | is_lep(p)
+    ) & (p.pt > 1.0)
+    sel = ((abs(GenPart.pdgId) == 310) | (abs(GenPart.pdgId) == 3122)) & (
+        GenPart.hasFlags("isLastCopy")
+    )
+    V0_ch = GenPart[sel].children
+    charged = is_charged(GenPart)
+    assert (
+        take(GenPart[charged].pt, genparts.descendants(sel, charged, 1)).tolist()
+        == V0_ch[is_charged(V0_ch)].pt.tolist()
+    )
+
+
+def test_first_ancestor(GenPart):
+    """lepton mothers within a few generations, as the .parent chains"""
+    genparts = GenPartIndex(GenPart)
+    sel = is_lep(GenPart) & GenPart.hasFlags("isLastCopy") & (GenPart.pt > 3.0)
+    parents = [GenPart[sel].parent]
+    for _ in range(3):
+        parents.append(parents[-1].parent)
+    for is_mother, generations in [
+        (lambda p: abs(_fix(p.pdgId)) == 15, 1),
+        (is_WZ, 2),
+        (lambda p: is_heavy_hadron(p, 4), 2),
+        (lambda p: is_heavy_hadron(p, 5), 4),
+    ]:
+        # pt of the closest parent passing, -1 if none
+        expected = ak.zeros_like(GenPart[sel].pt) - 1
+        for parent in reversed(parents[:generations]):
+            expected = ak.where(is_mother(parent), _fix(parent.pt), expected)
+        mask = is_mother(GenPart)
+        ancestor = genparts.first_ancestor(sel, mask, generations)
+        assert ak.any(ancestor >= 0)
+        found = ak.fill_none(GenPart[mask].pt[ak.mask(ancestor, ancestor >= 0)], -1)
+        assert found.tolist() == expected.tolist()
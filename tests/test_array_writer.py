@@ -0,0 +1,104 @@
+import glob
+
+import awkward as ak
+import numpy as np
+import pytest
+import uproot
+
+from BTVNanoCommissioning.utils.array_writer import (
+    WriterPolicy,
+    WriterPool,
+    cast_branches,
+    truncate_mantissa,
+)
+
+
+def branches(start):
+    return {"Events": {"event": ak.Array(np.arange(start, start + 5))}}
+
+
+def written(outdir):
+    return sorted(
+        event
+        for path in glob.glob(f"{outdir}/*.root")
+        for event in uproot.open(path)["Events"]["event"].array().tolist()
+    )
+
+
+def test_retried_chunk(tmp_path):
+    """the arrays staged by a failed attempt of a chunk are not written with its retry"""
+    pool = WriterPool()
+    appender = pool.appender(str(tmp_path), 1024**3, WriterPolicy())
+    # first attempt, fails after its first shift
+    pool.reset()
+    pool.append("chunkA", appender, branches(0))
+    # retry on the same thread, two shifts
+    pool.reset()
+    pool.append("chunkA", appender, branches(0))
+    pool.append("chunkA", appender, branches(100))
+    pool.flush()
+    pool.close()
+    assert written(tmp_path) == list(range(5)) + list(range(100, 105))
+
+
+def rounded(values, bits):
+    """float values rounded to bits mantissa bits, halfway cases away from zero"""
+    mantissa, exponent = np.frexp(values.astype(np.float64))
+    scale = 2.0 ** (bits + 1)
+    mantissa = np.sign(mantissa) * np.floor(np.abs(mantissa) * scale + 0.5) / scale
+    return np.ldexp(mantissa, exponent).astype(np.float32)
+
+
+@pytest.mark.parametrize("bits", [1, 7, 10, 22])
+def test_truncate_mantissa(bits):
+    """normal float32 values, also halfway between two kept values and rounding up the exponent"""
+    rng = np.random.default_rng(bits)
+    values = np.concatenate(
+        [
+            rng.standard_normal(10000) * 10.0 ** rng.uniform(-20, 20, 10000),
+            [0.0, -0.0, 1 + 2.0 ** -(bits + 1), -(1 + 2.0 ** -(bits + 1))],
+            [2 - 2.0**-23, -(2 - 2.0**-23)],
+        ]
+    ).astype(np.float32)
+    np.testing.assert_array_equal(
+        truncate_mantissa(values, bits), rounded(values, bits)
+    )
+    special = np.array([np.nan, np.inf, -np.inf], dtype=np.float32)
+    np.testing.assert_array_equal(truncate_mantissa(special, bits), special)
+
+
+def test_cast_branches():
+    """first matching rule of the same kind, downcast only, ints checked to fit"""
+    branches = {
+        "Jet": ak.zip(
+            {
+                "pt": ak.Array([[31.2345678, 20.0], [], [45.1]]),
+                "nConstituents": ak.Array([[12, 250], [], [3]]),
+                "isTagged": ak.Array([[1, 0], [], [1]]),
+            }
+        ),
+        "event": np.array([1, 2, 3], dtype=np.uint64),
+        "MET_pt": np.array([10.5, 20.25, 30.125], dtype=np.float32),
+    }
+    dtypes = [
+        ("Jet_pt", "float32", 7),
+        ("Jet_pt", "float16"),
+        ("Jet_nConstituents", "uint8"),
+        ("Jet_is*", "bool"),
+        ("event", "uint32"),
+        ("MET_pt", "float64"),
+    ]
+    out = cast_branches(branches, dtypes)
+    pt = ak.to_numpy(ak.flatten(out["Jet"].pt))
+    assert pt.dtype == np.float32
+    np.testing.assert_array_equal(pt, rounded(np.array([31.2345678, 20.0, 45.1]), 7))
+    assert ak.to_list(out["Jet"].nConstituents) == [[12, 250], [], [3]]
+    assert ak.to_numpy(ak.flatten(out["Jet"].nConstituents)).dtype == np.uint8
+    assert ak.to_list(out["Jet"].isTagged) == [[True, False], [], [True]]
+    assert ak.to_numpy(out["event"]).dtype == np.uint32
+    # not upcast
+    assert ak.to_numpy(out["MET_pt"]).dtype == np.float32
+    with pytest.raises(ValueError):
+        cast_branches({"event": np.array([2**40], dtype=np.uint64)}, dtypes)
+    with pytest.raises(ValueError):
+        cast_branches({"Jet_isTagged": np.array([2])}, dtypes)
@@ -0,0 +1,27 @@
+import awkward as ak
+
+from BTVNanoCommissioning.helpers.func import writeable_plan, writeable_signature
+
+
+def test_writeable_signature_types():
+    """a field which is no longer flat or 1-d jagged changes the signature and the plan"""
+    events = ak.zip(
+        {
+            "run": [1, 1, 2],
+            "SelJet": ak.zip({"pt": [[30.0, 20.0], [], [40.0]], "flav": [5, 0, 4]}),
+        },
+        depth_limit=1,
+    )
+    nested = ak.zip(
+        {
+            "run": events.run,
+            "SelJet": ak.zip(
+                {"pt": ak.unflatten(events.SelJet.pt, 1, axis=1), "flav": [5, 0, 4]}
+            ),
+        },
+        depth_limit=1,
+    )
+    include = ["run", "SelJet_pt", "SelJet_flav"]
+    assert writeable_signature(events) == writeable_signature(events[1:])
+    assert writeable_signature(events) != writeable_signature(nested)
+    assert writeable_plan(events, include) != writeable_plan(nested, include)
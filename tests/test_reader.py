@@ -0,0 +1,129 @@
+import os, subprocess, sys
+
+import awkward as ak
+import numpy as np
+import pytest
+import uproot
+from coffea.nanoevents import NanoEventsFactory, PFNanoAODSchema
+
+from BTVNanoCommissioning.utils import reader
+
+NEVENTS, BASKET = 1000, 100
+
+
+@pytest.fixture(scope="module")
+def nanofile(tmp_path_factory):
+    """NanoAOD-like file, written in baskets of BASKET entries"""
+    path = str(tmp_path_factory.mktemp("reader") / "nano.root")
+    rng = np.random.default_rng(1)
+    with uproot.recreate(path) as fout:
+        for start in range(0, NEVENTS, BASKET):
+            njet = rng.poisson(3, BASKET)
+            nmu = rng.poisson(1, BASKET)
+            chunk = {
+                "Jet": ak.zip(
+                    {
+                        "pt": ak.unflatten(
+                            rng.exponential(40, njet.sum()).astype(np.float32), njet
+                        ),
+                        "eta": ak.unflatten(
+                            rng.uniform(-2.5, 2.5, njet.sum()).astype(np.float32), njet
+                        ),
+                    }
+                ),
+                "Muon": ak.zip(
+                    {
+                        "pt": ak.unflatten(
+                            rng.exponential(20, nmu.sum()).astype(np.float32), nmu
+                        ),
+                        "jetIdx": ak.unflatten(
+                            rng.integers(-1, 3, nmu.sum()).astype(np.int32), nmu
+                        ),
+                    }
+                ),
+                "event": np.arange(start, start + BASKET, dtype=np.uint64),
+                "MET_pt": rng.exponential(30, BASKET).astype(np.float32),
+            }
+            if start == 0:
+                fout["Events"] = chunk
+            else:
+                fout["Events"].extend(chunk)
+    return path
+
+
+def open_chunk(path, start, stop):
+    return NanoEventsFactory.from_root(
+        path,
+        schemaclass=PFNanoAODSchema,
+        entry_start=start,
+        entry_stop=stop,
+        metadata={
+            "dataset": "test",
+            "filename": path,
+            "entrystart": start,
+            "entrystop": stop,
+        },
+    ).events()
+
+
+def as_list(events):
+    return {
+        "event": ak.to_list(events.event),
+        "MET": ak.to_list(events.MET.pt),
+        "Jet": ak.to_list(events.Jet[["pt", "eta"]]),
+        "Muon": ak.to_list(events.Muon[["pt", "jetIdx"]]),
+        "Muon_jet": ak.to_list(events.Muon.matched_jet.pt),
+    }
+
+
+@pytest.mark.parametrize(
+    "start, stop, fraction",
+    [
+        (0, NEVENTS, 0.05),  # sparse, a few baskets are read
+        (150, 730, 0.2),  # chunk not aligned on the baskets
+        (150, 730, 0.8),  # more than max_fraction selected, events[mask]
+    ],
+)
+def test_read_selected(nanofile, monkeypatch, start, stop, fraction):
+    sources = []
+    selected_source = reader.SelectedSource
+
+    def spy(*args):
+        sources.append(selected_source(*args))
+        return sources[-1]
+
+    monkeypatch.setattr(reader, "SelectedSource", spy)
+
+    events = open_chunk(nanofile, start, stop)
+
+    def no_open(*args, **kwargs):
+        raise AssertionError("the file opened by the events factory is not reused")
+
+    monkeypatch.setattr(uproot, "open", no_open)
+    mask = np.random.default_rng(2).uniform(size=len(events)) < fraction
+    # both the first and the last entry of a basket
+    mask[[0, BASKET - start % BASKET - 1]] = True
+    selected = reader.read_selected(events, mask)
+    assert len(sources) == (1 if fraction < 0.5 else 0)
+    assert as_list(selected) == as_list(events[mask])
+
+
+def test_selected_source_uuid(nanofile):
+    """the uuid does not depend on the hash seed of the interpreter"""
+    code = (
+        "import uproot, numpy as np;"
+        "from BTVNanoCommissioning.utils.reader import SelectedSource;"
+        f"tree = uproot.open({nanofile!r})['Events'];"
+        "print(SelectedSource(tree, np.arange(5, 50, 3), 'file').uuid)"
+    )
+    uuids = {
+        subprocess.run(
+            [sys.executable, "-c", code],
+            env={**os.environ, "PYTHONHASHSEED": seed},
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        for seed in ["1", "2"]
+    }
+    assert len(uuids) == 1
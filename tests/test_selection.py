@@ -0,0 +1,72 @@
+import awkward as ak
+import numpy as np
+
+from BTVNanoCommissioning.utils.selection import ele_mvatightid, jet_id, softmu_mask
+
+
+def f4(values):
+    return ak.values_astype(ak.Array(values), np.float32)
+
+
+def i4(values):
+    return ak.values_astype(ak.Array(values), np.int32)
+
+
+def test_id_cuts_boundaries():
+    """the compiled id_cuts give the awkward expressions, also on the thresholds and for NaN"""
+    events = ak.zip(
+        {
+            "Jet": ak.zip(
+                {
+                    "pt": f4([[20, 20.5, 50], [], [51, 19, np.nan]]),
+                    "eta": f4([[2.5, -2.5, 2.50001], [], [0, -3, 1]]),
+                    "jetId": i4([[5, 4, 6], [], [5, 6, 6]]),
+                    "puId": i4([[7, 7, 6], [], [0, 7, 7]]),
+                }
+            ),
+            "Electron": ak.zip(
+                {
+                    "eta": f4([[1.4442, -1.566, 1.567, 2.5, np.nan]]),
+                    "mvaIso_WP80": [[True, True, True, True, True]],
+                }
+            ),
+            "Muon": ak.zip(
+                {
+                    "pt": f4([[10, 24.9, 25, 10]]),
+                    "eta": f4([[2.39, 0, 0, 0]]),
+                    "tightId": [[True, True, True, False]],
+                    "pfRelIso04_all": f4([[0.21, 0.3, 0.3, 0.3]]),
+                    "dxy": f4([[1, 0, 1, 1]]),
+                    "dxyErr": f4([[0.5, 0, 1, 1]]),
+                    "jetIdx": i4([[0, 1, 1, 1]]),
+                }
+            ),
+        },
+        depth_limit=1,
+    )
+    jet, ele, mu = events.Jet, events.Electron, events.Muon
+    expected = {
+        "jet_id": (jet.pt > 20) & (abs(jet.eta) <= 2.5) & (jet.jetId >= 5),
+        "jet_id_puid": (jet.pt > 20)
+        & (abs(jet.eta) <= 2.5)
+        & (jet.jetId >= 5)
+        & ((jet.pt > 50) | (jet.puId >= 7)),
+        "ele_mvatightid": (
+            (abs(ele.eta) < 1.4442) | ((abs(ele.eta) < 2.5) & (abs(ele.eta) > 1.566))
+        )
+        & (ele.mvaIso_WP80 > 0.5),
+        "softmu_mask": (mu.pt < 25)
+        & (abs(mu.eta) < 2.4)
+        & (mu.tightId > 0.5)
+        & (mu.pfRelIso04_all > 0.2)
+        & (abs(mu.dxy / mu.dxyErr) > 1)
+        & (mu.jetIdx != -1),
+    }
+    masks = {
+        "jet_id": jet_id(events, "Summer22"),
+        "jet_id_puid": jet_id(events, "Rereco17_94X"),
+        "ele_mvatightid": ele_mvatightid(events, "Summer22"),
+        "softmu_mask": softmu_mask(events, "Summer22", dxySigCut=1),
+    }
+    for name, mask in masks.items():
+        assert mask.tolist() == expected[name].tolist(), name
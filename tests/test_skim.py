@@ -0,0 +1,150 @@
+import os
+
+import awkward as ak
+import hist
+import numpy as np
+import pytest
+import uproot
+from coffea import processor
+from coffea.nanoevents import PFNanoAODSchema
+
+from BTVNanoCommissioning.utils.skim import SkimStore
+from BTVNanoCommissioning.workflows import workflows
+
+NEVENTS, CHUNK = 3000, 1000
+# the correction files of the campaign are read relative to the repository
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="module")
+def nanofile(tmp_path_factory):
+    """NanoAOD-like simulation with semileptonic ttbar-like events"""
+    path = str(tmp_path_factory.mktemp("skim") / "nano.root")
+    rng = np.random.default_rng(1)
+    njet = rng.poisson(5, NEVENTS)
+    nmu = rng.poisson(1.5, NEVENTS)
+
+    def collection(counts, **fields):
+        return ak.zip({k: ak.unflatten(v, counts) for k, v in fields.items()})
+
+    def uniform(low, high, n):
+        return rng.uniform(low, high, n).astype(np.float32)
+
+    nj, nm = njet.sum(), nmu.sum()
+    jet = collection(
+        njet,
+        pt=(rng.exponential(40, nj) + 15).astype(np.float32),
+        eta=uniform(-2.4, 2.4, nj),
+        phi=uniform(-np.pi, np.pi, nj),
+        mass=uniform(2, 15, nj),
+        jetId=np.full(nj, 6, np.int32),
+        puId=np.full(nj, 7, np.int32),
+        hadronFlavour=rng.choice([0, 4, 5], nj).astype(np.int32),
+        partonFlavour=rng.choice([0, 1, 4, 5, 21], nj).astype(np.int32),
+        rawFactor=uniform(0, 0.2, nj),
+        area=uniform(0.4, 0.6, nj),
+        neEmEF=uniform(0, 0.5, nj),
+        chEmEF=uniform(0, 0.5, nj),
+        **{
+            f"btag{tagger}": uniform(0, 1, nj)
+            for tagger in ["DeepFlavB", "DeepFlavCvL", "DeepFlavCvB", "DeepFlavQG"]
+        },
+    )
+    muon = collection(
+        nmu,
+        pt=(rng.exponential(25, nm) + 3).astype(np.float32),
+        eta=uniform(-2.4, 2.4, nm),
+        phi=uniform(-np.pi, np.pi, nm),
+        mass=np.full(nm, 0.106, np.float32),
+        charge=rng.choice([-1, 1], nm).astype(np.int32),
+        tightId=rng.random(nm) < 0.9,
+        pfRelIso04_all=rng.exponential(0.1, nm).astype(np.float32),
+        dxy=uniform(-0.02, 0.02, nm),
+        dz=uniform(-0.05, 0.05, nm),
+        jetIdx=np.full(nm, -1, np.int32),
+    )
+    with uproot.recreate(path) as fout:
+        fout["Events"] = {
+            "run": np.ones(NEVENTS, np.uint32),
+            "luminosityBlock": np.ones(NEVENTS, np.uint32),
+            "event": np.arange(NEVENTS, dtype=np.uint64),
+            "genWeight": rng.choice([-100.0, 100.0], NEVENTS, p=[0.2, 0.8]),
+            "Jet": jet,
+            "Muon": muon,
+            **{
+                met: ak.zip(
+                    {
+                        "pt": rng.exponential(40, NEVENTS).astype(np.float32),
+                        "phi": uniform(-np.pi, np.pi, NEVENTS),
+                    }
+                )
+                for met in ["MET", "PuppiMET"]
+            },
+            "PV": ak.zip({"npvs": rng.integers(5, 60, NEVENTS).astype(np.int32)}),
+            "Rho": ak.zip({"fixedGridRhoFastjetAll": uniform(5, 40, NEVENTS)}),
+            "Pileup": ak.zip(
+                {"nTrueInt": rng.integers(10, 60, NEVENTS).astype(np.int32)}
+            ),
+            "HLT_IsoMu24": rng.random(NEVENTS) < 0.5,
+            **{
+                f"Flag_{name}": np.ones(NEVENTS, bool)
+                for name in [
+                    "goodVertices",
+                    "globalSuperTightHalo2016Filter",
+                    "EcalDeadCellTriggerPrimitiveFilter",
+                    "BadPFMuonFilter",
+                    "BadPFMuonDzFilter",
+                    "hfNoisyHitsFilter",
+                    "eeBadScFilter",
+                    "ecalBadCalibFilter",
+                ]
+            },
+        }
+    return path
+
+
+def ttsemilep(outdir):
+    return workflows["ttsemilep_sf"](
+        "2022", "Summer23BPix", outdir, "weight_only", False, False, CHUNK
+    )
+
+
+@pytest.mark.parametrize("format", SkimStore.formats)
+def test_skim_round_trip(nanofile, tmp_path, monkeypatch, format):
+    """the histograms refilled from the skim are those filled by the workflow"""
+    if format == "parquet":
+        try:
+            import pyarrow.parquet
+        except ImportError as error:
+            pytest.skip(f"pyarrow cannot be imported: {error}")
+    monkeypatch.chdir(REPO)
+    proc = ttsemilep(str(tmp_path))
+    proc.skim = SkimStore(str(tmp_path / "skim"), format)
+    direct = processor.run_uproot_job(
+        {"TT": [nanofile]},
+        "Events",
+        proc,
+        processor.iterative_executor,
+        {"schema": PFNanoAODSchema},
+        chunksize=CHUNK,
+    )["TT"]
+    refilled = SkimStore(str(tmp_path / "skim")).run(ttsemilep(str(tmp_path)))
+    assert list(refilled) == ["TT"]
+    refilled = refilled["TT"]
+
+    assert direct["njet"].sum(flow=True).value > 0
+    assert len(direct["njet"].axes["syst"]) > 1  # the weight variations
+    assert set(refilled) == set(direct)
+    for name, value in direct.items():
+        if isinstance(value, hist.Hist):
+            np.testing.assert_array_equal(
+                refilled[name].values(flow=True), value.values(flow=True)
+            )
+            np.testing.assert_array_equal(
+                refilled[name].variances(flow=True), value.variances(flow=True)
+            )
+        else:  # sum of weights and lumi blocks of the chunks
+            np.testing.assert_array_equal(
+                getattr(refilled[name], "value", refilled[name]),
+                getattr(value, "value", value),
+            )
@@ -0,0 +1,90 @@
+import os, pickle, zlib
+
+from BTVNanoCommissioning.utils.storage import (
+    LocalStorage,
+    OutputIndex,
+    UploadQueue,
+    adler32,
+    retry_uploads,
+)
+
+
+def output(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as fout:
+        fout.write(content)
+    return str(path)
+
+
+class CorruptingStorage(LocalStorage):
+    """local destination whose copies lose their last byte"""
+
+    def put(self, local, path):
+        super().put(local, path)
+        with open(self.url(path), "r+b") as fout:
+            fout.truncate(os.path.getsize(local) - 1)
+
+
+class FailingStorage(LocalStorage):
+    """local destination which cannot be reached"""
+
+    def put(self, local, path):
+        raise OSError("destination unreachable")
+
+
+def test_output_index(tmp_path):
+    """the index built from the listing of the destination, also once shipped to a worker"""
+    destination = LocalStorage(str(tmp_path / "dest"))
+    for path in ["TT/hists_1.coffea", "TT/sub/hists_2.coffea"]:
+        destination.put(output(tmp_path / "local" / "hists.coffea", b"hists"), path)
+    index = pickle.loads(pickle.dumps(OutputIndex(destination).build()))
+    assert len(index) == 2
+    assert "TT/hists_1.coffea" in index and "TT/sub/hists_2.coffea" in index
+    assert "TT/hists_3.coffea" not in index
+    # a file produced after build() is only seen by an index asking the destination
+    destination.put(str(tmp_path / "local" / "hists.coffea"), "TT/hists_3.coffea")
+    assert "TT/hists_3.coffea" not in index
+    assert "TT/hists_3.coffea" in OutputIndex(destination)
+
+
+def test_adler32(tmp_path):
+    """checksum read in blocks, that of the copy at the destination"""
+    content = os.urandom(3000)
+    local = output(tmp_path / "local" / "arrays.root", content)
+    assert adler32(local, block=1024) == zlib.adler32(content)
+    destination = LocalStorage(str(tmp_path / "dest"))
+    destination.put(local, "TT/arrays.root")
+    assert destination.checksum("TT/arrays.root") == adler32(local)
+
+
+def test_corrupted_copy(tmp_path):
+    """an upload whose copy does not match the local file fails and keeps the file and its journal entry"""
+    local = output(tmp_path / "local" / "arrays.root", os.urandom(3000))
+    queue = UploadQueue(str(tmp_path / "journal"), retries=1, backoff=0)
+    future = queue.submit(
+        local, CorruptingStorage(str(tmp_path / "dest")), "TT/arrays.root"
+    )
+    queue.close()
+    assert "checksum mismatch" in str(future.exception())
+    assert os.path.exists(local)
+    assert len(os.listdir(tmp_path / "journal")) == 1
+
+
+def test_retry_uploads(tmp_path):
+    """a failed upload stays in the journal and is completed by retry_uploads"""
+    content = os.urandom(3000)
+    local = output(tmp_path / "local" / "arrays.root", content)
+    journal = str(tmp_path / "journal")
+    queue = UploadQueue(journal, retries=0, backoff=0)
+    future = queue.submit(
+        local, FailingStorage(str(tmp_path / "dest")), "TT/arrays.root"
+    )
+    queue.close()
+    assert isinstance(future.exception(), OSError)
+    assert os.path.exists(local) and len(os.listdir(journal)) == 1
+
+    assert retry_uploads(journal, retries=0, backoff=0) == []
+    with open(tmp_path / "dest" / "TT" / "arrays.root", "rb") as fin:
+        assert fin.read() == content
+    assert not os.path.exists(local)
+    assert os.listdir(journal) == []
@@ -0,0 +1,33 @@
+import awkward as ak
+import numpy as np
+import pytest
+
+from BTVNanoCommissioning.utils import trigger
+
+
+class Chunk:
+    """events of a chunk with its metadata, as given by NanoEvents"""
+
+    def __init__(self, filename, **paths):
+        self.array = ak.zip({"HLT": ak.zip(paths)}, depth_limit=1)
+        self.fields = self.array.fields
+        self.metadata = {"filename": filename, "dataset": "test"}
+
+    def __getitem__(self, key):
+        return self.array[key]
+
+    def __len__(self):
+        return len(self.array)
+
+
+def test_required_after_optional():
+    """a path missing in the file raises when required, also after an optional call"""
+    chunk = Chunk("required_after_optional.root", IsoMu27=np.array([1, 0, 1], bool))
+    assert not trigger.trigger_mask(chunk, ["IsoMu24"], required=False).any()
+    with pytest.raises(ValueError):
+        trigger.trigger_mask(chunk, ["IsoMu24"])
+    assert trigger.trigger_mask(chunk, ["IsoMu24", "IsoMu27"]).tolist() == [
+        True,
+        False,
+        True,
+    ]